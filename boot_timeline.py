@@ -0,0 +1,55 @@
+# boot_timeline.py - 启动时间线
+# 记录启动各阶段的结束时刻和耗时, 供 /debug/boot 查看; ticks_ms 从上电开始计, 第一次记录之前的部分算作固件启动
+# lazy() 返回延迟导入的模块代理, 第一次访问属性时才导入, 导入耗时也记在这里
+import time
+
+phases = []      # (阶段, 结束时刻ms, 耗时ms)
+lazy_loads = {}  # 模块名 -> (导入时刻ms, 导入耗时ms)
+_last = 0
+
+def mark(name):
+    global _last
+    now = time.ticks_ms()
+    phases.append((name, now, time.ticks_diff(now, _last)))
+    _last = now
+
+def mark_once(name):
+    """只记录第一次, 比如第一个响应发出"""
+    for p in phases:
+        if p[0] == name:
+            return
+    mark(name)
+
+class _Lazy:
+    def __init__(self, name):
+        self.name = name
+        self.module = None       # 导入之前为 None
+
+    def __getattr__(self, attr):
+        mod = self.module
+        if mod is None:
+            t = time.ticks_ms()
+            mod = self.module = __import__(self.name)
+            lazy_loads[self.name] = (t, time.ticks_diff(time.ticks_ms(), t))
+        return getattr(mod, attr)
+
+def lazy(name):
+    return _Lazy(name)
+
+def report():
+    return {'phases': [{'name': n, 'at_ms': at, 'ms': ms} for n, at, ms in phases],
+            'lazy_imports': {k: {'at_ms': v[0], 'ms': v[1]} for k, v in lazy_loads.items()}}
+
+# 测试代码
+if __name__ == "__main__":
+    mark('start')
+    time.sleep_ms(50)
+    mark('work')
+    mark_once('work')
+    j = lazy('json')
+    assert j.module is None
+    assert j.dumps([1]) == '[1]' and j.module is not None
+    r = report()
+    print(r)
+    assert [p['name'] for p in r['phases']] == ['start', 'work'] and r['phases'][1]['ms'] >= 50
+    assert 'json' in r['lazy_imports']
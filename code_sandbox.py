@@ -0,0 +1,660 @@
+# code_sandbox.py - 终端代码的执行预算(超时与内存配额)
+# MicroPython 没有 settrace, 定时器回调也打断不了工作线程里的代码, 所以在编译前改写源码:
+#   while 条件:      ->  while _sb_tick() and (条件):
+#   for x in 可迭代:  ->  for x in _sb_guard(可迭代):      (推导式里的 for 同样处理)
+#   def f(...): 函数体   ->  def f(...): _sb_tick(); 函数体      (函数体另起一行时插在第一条语句前)
+#   lambda x: 表达式    ->  lambda x: _sb_tick() and (表达式)
+#   import time / from time import sleep  ->  time = (_sb_time) / sleep = (_sb_time.sleep)
+# 每次循环和每次函数调用(包括没有循环的递归)都经过预算检查, 超时或超出内存配额时抛出 SandboxStop 结束用户代码; 行号不变, 报错位置仍然准确
+# 已知的缺口: 内置函数自己完成的迭代(sum(range(10**8))、sorted、字符串乘法等)不经过改写后的代码,
+# 只有在回到用户代码的下一个循环检查时才会停下, 这期间不受超时限制
+# 内存配额只是尽力而为: 堆用量只在上面这些检查点上采样, 一次性的大分配([0]*10**8、"a"*10**9、bytearray(10**6))
+# 在分配时不受配额限制, 堆不够时由 MicroPython 抛出 MemoryError; 之后没有检查点的代码也不会因超额停下
+import gc
+import time
+
+VERSION = b'sb3'            # 改写规则变化时修改, 让旧的编译缓存失效
+DEFAULT_TIMEOUT_MS = 10000
+HEAP_QUOTA = 48 * 1024      # 检查点上允许的堆增长(字节), 按 gc.mem_alloc() 相对开始时的增量计算; 见上面的说明, 不是硬限制
+CHECK_EVERY = 16            # 每多少次循环或函数调用检查一次时间和内存, 必须是2的幂
+
+TICK = '_sb_tick'
+GUARD = '_sb_guard'
+TIME = '_sb_time'
+_OPEN = '([{'
+_CLOSE = ')]}'
+_ITER_END = (':', 'if', 'for', 'async') + tuple(_CLOSE)
+_LAMBDA_END = (',', ';', ':', 'for', 'async') + tuple(_CLOSE)
+_PREFIXES = ('r', 'b', 'f', 'u', 'rb', 'br', 'fr', 'rf')
+
+class SandboxStop(BaseException):
+    """预算用尽; 继承 BaseException, 用户代码里的 except Exception 拦不住"""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+def _mem_alloc():
+    return gc.mem_alloc() if hasattr(gc, 'mem_alloc') else 0
+
+def _string_end(src, i):
+    """i 指向引号, 返回字符串结束后的位置"""
+    q = src[i]
+    triple = src[i:i + 3] == q * 3
+    i += 3 if triple else 1
+    n = len(src)
+    while i < n:
+        c = src[i]
+        if c == '\\':
+            i += 2
+        elif triple and src[i:i + 3] == q * 3:
+            return i + 3
+        elif not triple and c == q:
+            return i + 1
+        elif not triple and c == '\n':
+            return i
+        else:
+            i += 1
+    return n
+
+def _digits(src, i, chars):
+    n = len(src)
+    while i < n and (src[i] in chars or src[i] == '_'):
+        i += 1
+    return i
+
+def _number_end(src, i):
+    """i 指向数字或小数点, 返回数字结束后的位置; 后面不跟数字的小数点不算进来, 1..__class__ 里的属性仍会被检查"""
+    if src[i] == '0' and src[i + 1:i + 2] in ('x', 'X', 'o', 'O', 'b', 'B'):
+        return _digits(src, i + 2, '0123456789abcdefABCDEF')
+    i = _digits(src, i, '0123456789')
+    if src[i:i + 1] == '.' and src[i + 1:i + 2].isdigit():
+        i = _digits(src, i + 1, '0123456789')
+    if src[i:i + 1] in ('e', 'E'):
+        k = i + 2 if src[i + 1:i + 2] in ('+', '-') else i + 1
+        if src[k:k + 1].isdigit():
+            i = _digits(src, k, '0123456789')
+    if src[i:i + 1] in ('j', 'J'):
+        i += 1
+    return i
+
+def tokenize(src):
+    """粗粒度分词, 只区分改写需要的几类: name op str num comment nl ws"""
+    out = []
+    i = 0
+    n = len(src)
+    while i < n:
+        c = src[i]
+        j = i + 1
+        if c == '\n':
+            kind = 'nl'
+        elif c in ' \t\r\f' or (c == '\\' and src[i + 1:i + 2] == '\n'):
+            kind = 'ws'
+            if c == '\\':
+                j = i + 2
+        elif c == '#':
+            kind = 'comment'
+            while j < n and src[j] != '\n':
+                j += 1
+        elif c in '\'"':
+            kind = 'str'
+            j = _string_end(src, i)
+        elif c.isalpha() or c == '_' or ord(c) > 127:
+            while j < n and (src[j].isalpha() or src[j].isdigit() or src[j] == '_' or ord(src[j]) > 127):
+                j += 1
+            kind = 'name'
+            if j < n and src[j] in '\'"' and src[i:j].lower() in _PREFIXES:
+                kind = 'str'
+                j = _string_end(src, j)
+        elif c.isdigit() or (c == '.' and src[j:j + 1].isdigit()):
+            kind = 'num'
+            j = _number_end(src, i)
+        else:
+            kind = 'op'
+            if c == ':' and src[j:j + 1] == '=':
+                j += 1
+        out.append((kind, src[i:j]))
+        i = j
+    return out
+
+# 校验: 名字与属性按白名单检查, 不通过时给出行列位置
+MODULE_ATTRS = {
+    'machine': ('Pin', 'PWM', 'ADC', 'DAC', 'I2C', 'SoftI2C', 'SPI', 'SoftSPI', 'UART', 'Timer', 'RTC',
+                'Signal', 'TouchPad', 'freq', 'unique_id', 'time_pulse_us', 'reset_cause'),
+    'gc': ('collect', 'mem_free', 'mem_alloc'),
+    'time': ('sleep', 'sleep_ms', 'sleep_us', 'ticks_ms', 'ticks_us', 'ticks_diff', 'ticks_add',
+             'time', 'time_ns', 'localtime', 'mktime'),
+    'uos': ('listdir', 'stat', 'statvfs', 'uname', 'getcwd'),
+    'math': None,        # None: 除下划线开头以外的属性都可以用
+    'random': None,
+    'struct': None,
+    'json': ('dumps', 'loads'),
+}
+MODULE_ALIASES = {'utime': 'time', 'urandom': 'random', 'ustruct': 'struct', 'ujson': 'json', 'os': 'uos'}
+DENIED_NAMES = ('getattr', 'setattr', 'delattr', 'eval', 'exec', 'execfile', 'compile', 'open', 'input',
+                'globals', 'locals', 'vars', 'dir', 'breakpoint')   # MicroPython 的 exec 不理会 __builtins__, 只能在这里拦
+
+def _module_of(name):
+    name = MODULE_ALIASES.get(name, name)
+    return name if name in MODULE_ATTRS else None
+
+def _significant(src, line=1, col=1):
+    """去掉空白和注释, 给每个记号标上行列(从1开始)"""
+    out = []
+    for kind, text in tokenize(src):
+        if kind not in ('ws', 'comment'):
+            out.append((kind, text, line, col))
+        k = text.rfind('\n')
+        if k >= 0:
+            line += text.count('\n')
+            col = len(text) - k
+        else:
+            col += len(text)
+    return out
+
+def _fstring_parts(text, line, col):
+    """取出 f 字符串里 {} 中的表达式及其位置"""
+    q = 0
+    while text[q] not in '\'"':
+        q += 1
+    parts = []
+    i = q
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '{' and text[i + 1:i + 2] == '{':
+            i += 2
+            continue
+        if c == '{':
+            depth = 1
+            j = i + 1
+            while j < n and depth:
+                if text[j] == '{':
+                    depth += 1
+                elif text[j] == '}':
+                    depth -= 1
+                j += 1
+            before = text[:i + 1]
+            k = before.rfind('\n')
+            pos = (line + before.count('\n'), len(before) - k if k >= 0 else col + len(before))
+            parts.append((text[i + 1:j - 1], pos))
+            i = j
+            continue
+        i += 1
+    return parts
+
+def _check_import(sig, i, aliases):
+    """检查一条 import/from 语句, 返回 (下一个位置, 错误)"""
+    n = len(sig)
+    kind, text, line, col = sig[i]
+
+    def dotted(i):
+        parts = [sig[i][1]]
+        i += 1
+        while i + 1 < n and sig[i][1] == '.':
+            parts.append(sig[i + 1][1])
+            i += 2
+        return '.'.join(parts), i
+
+    if text == 'import':
+        i += 1
+        while i < n:
+            name, j = dotted(i)
+            mod = _module_of(name)
+            if mod is None:
+                return i, (sig[i][2], sig[i][3], "不允许导入模块 " + name)
+            local = name
+            if j + 1 < n and sig[j][1] == 'as':
+                local = sig[j + 1][1]
+                j += 2
+            aliases[local] = mod
+            if j < n and sig[j][1] == ',':
+                i = j + 1
+                continue
+            return j, None
+        return i, None
+    i += 1
+    if i >= n:
+        return i, None
+    name, i = dotted(i)
+    mod = _module_of(name)
+    if mod is None:
+        return i, (line, col, "不允许导入模块 " + name)
+    allowed = MODULE_ATTRS[mod]
+    i += 1                       # import
+    level = 0                    # 括号里的名字可以跨行, 一直检查到右括号
+    while i < n and (level or (sig[i][0] != 'nl' and sig[i][1] != ';')):
+        kind, text, l, c = sig[i]
+        if text == '(':
+            level += 1
+        elif text == ')':
+            level -= 1
+        elif text == '*':
+            return i, (l, c, "不允许 import *")
+        if kind == 'name' and text != 'as' and sig[i - 1][1] != 'as':
+            if text.startswith('_') or (allowed is not None and text not in allowed):
+                return i, (l, c, "不允许使用 %s.%s" % (mod, text))
+        i += 1
+    return i, None
+
+def validate(src, line=1, col=1, aliases=None):
+    """检查用户代码, 通过返回 None, 否则返回 (行, 列, 原因)"""
+    sig = _significant(src, line, col)
+    if aliases is None:
+        aliases = {'machine': 'machine', 'gc': 'gc', 'time': 'time', 'uos': 'uos'}
+    n = len(sig)
+    i = 0
+    while i < n:
+        kind, text, line, col = sig[i]
+        prev = sig[i - 1][1] if i else ''
+        if kind == 'str':
+            prefix = text[:len(text) - len(text.lstrip('rRbBfFuU'))].lower()
+            if 'f' in prefix:
+                for expr, (l, c) in _fstring_parts(text, line, col):
+                    for t in tokenize(expr):
+                        if t[1] in ('for', 'while', 'lambda'):
+                            return l, c, "f字符串里不允许使用 " + t[1]
+                    err = validate(expr, l, c, aliases)
+                    if err:
+                        return err
+        elif kind == 'name':
+            if prev == '.':
+                if text.startswith('_'):
+                    return line, col, "不允许访问属性 " + text
+                base = sig[i - 2] if i >= 2 else None
+                if base and base[0] == 'name' and (i < 3 or sig[i - 3][1] != '.') and base[1] in aliases:
+                    mod = aliases[base[1]]
+                    allowed = MODULE_ATTRS[mod]
+                    if allowed is not None and text not in allowed:
+                        return line, col, "不允许使用 %s.%s" % (mod, text)
+            elif text in ('import', 'from') and (not i or sig[i - 1][0] == 'nl' or prev in (';', ':')):
+                i, err = _check_import(sig, i, aliases)
+                if err:
+                    return err
+                continue
+            elif text.startswith('__') or text.startswith('_sb_') or text in DENIED_NAMES:
+                return line, col, "不允许使用 " + text
+            elif text in aliases and (i + 1 >= n or sig[i + 1][1] != '.'):
+                return line, col, "模块 %s 只能通过属性使用" % text
+        i += 1
+    return None
+
+def _split(names):
+    groups = [[]]
+    for t in names:
+        if t == ',':
+            groups.append([])
+        else:
+            groups[-1].append(t)
+    return [g for g in groups if g]
+
+def _route_time(toks, i):
+    """toks[i] 是语句开头的 import/from; 语句导入了 time/utime 时改写成从 _sb_time 取, 返回 (新文本, 语句结束位置), 否则返回 None"""
+    n = len(toks)
+    j = i
+    level = 0
+    lines = 0
+    names = []
+    while j < n:
+        kind, text = toks[j]
+        if level == 0 and (kind in ('nl', 'comment') or text == ';'):
+            break
+        if text == '(':
+            level += 1
+        elif text == ')':
+            level -= 1
+        elif kind in ('name', 'op'):
+            if text.startswith('_sb_'):
+                raise ValueError("禁止使用的名称: " + text)
+            names.append(text)
+        lines += text.count('\n')
+        j += 1
+    lhs = []
+    rhs = []
+    keep = []
+    if names[0] == 'import':
+        for g in _split(names[1:]):
+            name = ''.join(g[:g.index('as')] if 'as' in g else g)
+            if _module_of(name) == 'time':
+                lhs.append(g[-1] if 'as' in g else name)
+                rhs.append(TIME)
+            else:
+                keep.append(name + (' as ' + g[-1] if 'as' in g else ''))
+    elif 'import' in names and _module_of(''.join(names[1:names.index('import')])) == 'time':
+        for g in _split(names[names.index('import') + 1:]):
+            lhs.append(g[-1])
+            rhs.append(TIME + '.' + g[0])
+    if not lhs:
+        return None
+    # 续行留在括号里, 后面的行号不变
+    stmt = '%s = (%s%s)' % (', '.join(lhs), ', '.join(rhs), '\n' * lines)
+    if keep:
+        stmt = 'import %s; %s' % (', '.join(keep), stmt)
+    return stmt, j
+
+def _close(out, p):
+    """补上 p 对应的右括号; 可迭代对象是不带括号的元组(for x in 1, 2:)时外面再包一层"""
+    # 右括号紧跟在表达式后面, 不放到空白和行尾注释之后
+    pos = len(out)
+    while pos > p[2] and (out[pos - 1].isspace() or out[pos - 1][:1] == '#'):
+        pos -= 1
+    if p[3]:
+        out.insert(pos, '))')
+        out.insert(p[2], '(')
+    else:
+        out.insert(pos, ')')
+
+def instrument(src):
+    """改写源码, 在每个循环和函数上挂预算检查, time 的导入换成代理; 用户代码里出现 _sb_ 开头的名字时抛出 ValueError"""
+    out = []
+    depth = 0
+    pending = []     # 待补右括号: [类型, 括号深度, 左括号在 out 里的位置, 是否出现顶层逗号]
+    want_in = []     # 等待与 for 配对的 in 所在深度
+    want_colon = []  # 等待 lambda 参数表结束的冒号: (括号深度, 当时 pending 的长度)
+    in_def = False   # 在 def 头部, 等待结束的冒号
+    tick_body = False  # 函数体的第一条语句前要插入检查
+    prev = ''
+    skip_ws = False
+    stmt = True      # 是否在语句开头
+    toks = tokenize(src)
+    n = len(toks)
+    i = 0
+    while i < n:
+        kind, text = toks[i]
+        i += 1
+        if skip_ws:
+            skip_ws = False
+            if kind == 'ws':
+                continue
+        if tick_body and kind not in ('ws', 'nl', 'comment'):
+            # 递归没有循环也要受预算限制: 每次调用函数都检查一次
+            out.append(TICK + '(); ')
+            tick_body = False
+        if kind in ('name', 'op'):
+            if stmt and text in ('import', 'from'):
+                r = _route_time(toks, i - 1)
+                if r:
+                    out.append(r[0])
+                    i = r[1]
+                    stmt = False
+                    prev = text
+                    continue
+            colon = text == ':' and want_colon and want_colon[-1][0] == depth
+            while colon and len(pending) > want_colon[-1][1]:
+                # 参数默认值里的 lambda 到这里结束
+                _close(out, pending.pop())
+            while not colon and pending and pending[-1][1] == depth:
+                end = pending[-1][0]
+                end = text == ':' if end == 'while' else text in (_LAMBDA_END if end == 'lambda' else _ITER_END)
+                if not end:
+                    break
+                _close(out, pending.pop())
+            if kind == 'name' and text.startswith('_sb_'):
+                raise ValueError("禁止使用的名称: " + text)
+            if text == 'while':
+                out.append('while ' + TICK + '() and (')
+                pending.append(['while', depth, len(out), False])
+                skip_ws = True
+            elif text == 'for' and prev != 'async':
+                out.append(text)
+                want_in.append(depth)
+            elif text == 'in' and want_in and want_in[-1] == depth:
+                want_in.pop()
+                out.append('in ' + GUARD + '(')
+                pending.append(['iter', depth, len(out), False])
+                skip_ws = True
+            elif colon:
+                want_colon.pop()
+                out.append(': ' + TICK + '() and (')
+                pending.append(['lambda', depth, len(out), False])
+                skip_ws = True
+            elif text == ':' and in_def and depth == 0:
+                in_def = False
+                tick_body = True
+                out.append(text)
+            else:
+                if text == ',' and pending and pending[-1][1] == depth:
+                    pending[-1][3] = True
+                elif text == 'lambda':
+                    want_colon.append((depth, len(pending)))
+                elif text == 'def':
+                    in_def = True
+                out.append(text)
+                if text in _OPEN:
+                    depth += 1
+                elif text in _CLOSE:
+                    depth -= 1
+            prev = text
+            stmt = depth == 0 and text in (';', ':')
+        else:
+            if kind == 'nl' and depth == 0:
+                # 语法不完整时也不把括号带到下一行
+                while pending:
+                    _close(out, pending.pop())
+                want_in = []
+                want_colon = []
+                stmt = True
+            out.append(text)
+    while pending:
+        _close(out, pending.pop())
+    return ''.join(out)
+
+class _Time:
+    """给用户代码的 time: sleep 不会睡过截止时间, 其余属性照旧; 会话里跨次执行沿用同一个代理, 每次换上新的预算"""
+    def __init__(self, budget):
+        self._budget = budget
+
+    def sleep(self, s):
+        self._budget.sleep_us(int(s * 1000000))
+
+    def sleep_ms(self, ms):
+        self._budget.sleep_us(ms * 1000)
+
+    def sleep_us(self, us):
+        self._budget.sleep_us(us)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class Budget:
+    """一次执行的预算, 同时记录耗时和检查点上观察到的峰值内存"""
+    def __init__(self, timeout_ms=DEFAULT_TIMEOUT_MS, heap_quota=HEAP_QUOTA):
+        self.timeout_ms = timeout_ms
+        self.heap_quota = heap_quota
+        self.ticks = 0
+        self.peak = 0
+        self.run_ms = 0
+        self.stopped = None
+
+    def start(self):
+        gc.collect()
+        self.base = _mem_alloc()
+        self.t0 = time.ticks_ms()
+        self.deadline = time.ticks_add(self.t0, self.timeout_ms)
+
+    def check(self):
+        if self.stopped:
+            raise SandboxStop(self.stopped)
+        if time.ticks_diff(time.ticks_ms(), self.deadline) > 0:
+            self.stopped = "执行超时(%d 毫秒)" % self.timeout_ms
+            raise SandboxStop(self.stopped)
+        used = _mem_alloc() - self.base
+        if used > self.heap_quota:
+            # 先回收垃圾, 只有真正占着的内存才算超额
+            gc.collect()
+            used = _mem_alloc() - self.base
+            if used > self.heap_quota:
+                self.peak = max(self.peak, used)
+                self.stopped = "超出内存配额(%d 字节)" % self.heap_quota
+                raise SandboxStop(self.stopped)
+        if used > self.peak:
+            self.peak = used
+
+    def tick(self):
+        self.ticks += 1
+        if not self.ticks & (CHECK_EVERY - 1) or self.stopped:
+            self.check()
+        return True
+
+    def guard(self, iterable):
+        for x in iterable:
+            self.tick()
+            yield x
+
+    def sleep_us(self, us):
+        left = time.ticks_diff(self.deadline, time.ticks_ms()) * 1000
+        us = max(0, min(us, left + 1000))
+        if us >= 1000:
+            time.sleep_ms(us // 1000)
+            us %= 1000
+        time.sleep_us(us)
+        self.check()
+
+    def finish(self):
+        self.run_ms = time.ticks_diff(time.ticks_ms(), self.t0)
+        used = _mem_alloc() - self.base
+        if used > self.peak:
+            self.peak = used
+
+    def growth(self):
+        """开始执行以来堆的增长, 调用前先 gc.collect() 就是执行后留下来的内存"""
+        return _mem_alloc() - self.base if hasattr(self, 'base') else 0
+
+    def report(self):
+        return {"run_ms": self.run_ms, "peak_bytes": self.peak, "loops": self.ticks, "stopped": self.stopped}
+
+    def summary(self):
+        return "耗时 %d 毫秒, 峰值内存 %d 字节" % (self.run_ms, self.peak)
+
+def run(compiled, env, budget, expr=False):
+    """在预算内执行改写过的代码对象, expr 为真时按表达式求值并返回结果; 预算用尽时抛出 SandboxStop"""
+    env[TICK] = budget.tick
+    env[GUARD] = budget.guard
+    proxy = env.get(TIME)
+    if not isinstance(proxy, _Time):
+        proxy = env[TIME] = _Time(budget)
+    proxy._budget = budget
+    env['time'] = proxy
+    budget.start()
+    try:
+        if expr:
+            return eval(compiled, env)
+        exec(compiled, env)
+    finally:
+        budget.finish()
+
+def run_source(src, env=None, timeout_ms=DEFAULT_TIMEOUT_MS, heap_quota=HEAP_QUOTA):
+    """改写、编译并执行, 返回 (预算, 结束原因或None)"""
+    budget = Budget(timeout_ms, heap_quota)
+    try:
+        run(compile(instrument(src), '<sandbox>', 'exec'), env if env is not None else {}, budget)
+    except SandboxStop as e:
+        return budget, e.reason
+    return budget, None
+
+# 测试代码: 死循环、递归、被吞掉的超时、内存炸弹和正常代码
+if __name__ == "__main__":
+    src = "s = 'while x: for y in z'  # for a in b\nwhile n := f(): pass\nr = [i*j for i in range(3) for j in (1, 2) if i]\nfor k, v in d.items(): print(k)\n"
+    print(instrument(src))
+    assert "'while x: for y in z'  # for a in b" in instrument(src)
+    assert "while _sb_tick() and (n := f()):" in instrument(src)
+    assert "for i in _sb_guard(range(3)) for j in _sb_guard((1, 2)) if i]" in instrument(src)
+    assert [t[1] for t in tokenize("1..real+0x1fe-2.5e-3j") if t[0] == 'num'] == ['1', '0x1fe', '2.5e-3j']
+    assert instrument("for x in 1, 2:\n    pass\n") == "for x in _sb_guard((1, 2)):\n    pass\n"
+    assert instrument("for x in *a, *b: pass\n") == "for x in _sb_guard((*a, *b)): pass\n"
+    assert instrument("def f(n): return n\n") == "def f(n): _sb_tick(); return n\n"
+    assert instrument("def f():\n    # c\n    return 1\n") == "def f():\n    # c\n    _sb_tick(); return 1\n"
+    assert instrument("k = lambda a: a  # c\n") == "k = lambda a: _sb_tick() and (a)  # c\n"
+    assert instrument("g = lambda: lambda: 1\n") == "g = lambda: _sb_tick() and (lambda: _sb_tick() and (1))\n"
+    assert instrument("import math, utime as t\n") == "import math; t = (_sb_time)\n"
+    assert instrument("if 1: from time import (sleep,\n  sleep_us as us)\nx\n") == \
+        "if 1: sleep, us = (_sb_time.sleep, _sb_time.sleep_us\n)\nx\n"
+
+    budget, stop = run_source("n = 0\nfor i in range(100):\n    n += i\nassert n == 4950\n")
+    assert stop is None, stop
+    budget, stop = run_source("while True:\n    pass\n", timeout_ms=300)
+    assert stop and budget.run_ms < 1000, (stop, budget.run_ms)
+    print("死循环:", stop, budget.summary())
+    budget, stop = run_source("while True:\n    try:\n        for i in range(10): pass\n    except Exception:\n        pass\n", timeout_ms=300)
+    assert stop, "except Exception 不应拦住超时"
+    for src in ("time.sleep(5)\n", "import time\ntime.sleep(3)\n", "import utime as t\nt.sleep_ms(3000)\n",
+                "from time import sleep\nsleep(3)\n", "def f():\n    import time\n    time.sleep_us(3000000)\nf()\n"):
+        budget, stop = run_source(src, {}, timeout_ms=300)
+        assert stop and budget.run_ms < 1000, (src, stop, budget.run_ms)
+    budget, stop = run_source("for x in 1, 2:\n    y = x\nassert y == 2\n")
+    assert stop is None, stop
+    # 没有循环的递归
+    for src in ("def f(n): return f(n-1)+f(n-1) if n else 1\nf(40)\n",
+                "f = lambda n: f(n-1)+f(n-1) if n else 1\nf(40)\n"):
+        budget, stop = run_source(src, timeout_ms=300)
+        assert stop and budget.run_ms < 1000, (src, stop, budget.run_ms)
+    budget, stop = run_source("g = lambda f=lambda: 1: f()\ndef h(a,\n      b=2):\n    return a * b\nassert g() * h(3) == 6\n")
+    assert stop is None, stop
+    if hasattr(gc, 'mem_alloc'):
+        budget, stop = run_source("keep = []\nwhile True:\n    keep.append(bytearray(512))\n", heap_quota=16 * 1024)
+        assert stop and budget.peak > 16 * 1024, (stop, budget.peak)
+        print("内存炸弹:", stop, budget.summary())
+        budget, stop = run_source("x = [bytearray(256) for i in range(1000)]\n", heap_quota=16 * 1024)
+        assert stop, "推导式里的分配也要受配额限制"
+    try:
+        instrument("_sb_tick = lambda: True\n")
+        assert False
+    except ValueError:
+        pass
+
+    # 校验器: 应接受与应拒绝的代码, 以及与旧的子串黑名单的耗时对比
+    accepted = [
+        "print('del x; format(y)')\n",
+        "p = machine.Pin(2, machine.Pin.OUT)\np.value(1)\n",
+        "import math\nprint(math.sqrt(2), format(3.14159, '.2f'))\n",
+        "from machine import Pin, PWM\npwm = PWM(Pin(5))\n",
+        "import utime as t\nt.sleep_ms(1)\n",
+        "for i in range(3):\n    print(f\"计数: {i}\")\n",
+        "class A(object):\n    def f(self):\n        return self.x\n",
+        "print(gc.mem_free(), time.ticks_ms(), uos.listdir())\n",
+        "x = 1_000 + 0x1F + 0b1_0 + 1.5e-3 + .5 + 2J + 1. + 3e+2\n",
+    ]
+    rejected = [
+        ("getattr(gc, 'collect')()\n", 1, 1),
+        ("x = 1\nmachine.mem32[0x60004000] = 0\n", 2, 9),
+        ("m = machine\n", 1, 5),
+        ("import machine as m\nm.reset()\n", 2, 3),
+        ("from machine import mem32\n", 1, 21),
+        ("import sys\n", 1, 8),
+        ("print(().__class__)\n", 1, 10),
+        ("uos.remove('boot.py')\n", 1, 5),
+        ("print(f\"{open('boot.py')}\")\n", 1, 10),
+        ("from math import *\n", 1, 18),
+        ("__builtins__\n", 1, 1),
+        ("from machine import (Pin,\n    mem32)\nmem32[0x60004000] = 0\n", 2, 5),
+        ("from uos import (listdir,\n    remove)\n", 2, 5),
+        ("ga = 1..__class__.__base__.__subclasses__\nprint(len(ga()))\n", 1, 9),
+        ("print(0x1f.__class__)\n", 1, 12),
+        ("print(1.5.__class__)\n", 1, 11),
+        ("x = 1e5.__class__\n", 1, 9),
+        ("x = 1j.__class__\n", 1, 8),
+    ]
+    for src in accepted:
+        assert validate(src) is None, (src, validate(src))
+    for src, line, col in rejected:
+        err = validate(src)
+        assert err and err[:2] == (line, col), (src, err)
+        print("拒绝 %r -> 第%d行第%d列 %s" % (src.strip(), err[0], err[1], err[2]))
+
+    old = ("import os", "import sys", "__import__", "eval(", "exec(", "compile(", "open(", "rm ", "del ", "format(")
+    corpus = [src for src in accepted] + [src for src, l, c in rejected]
+    n = 50
+    t = time.ticks_us()
+    for i in range(n):
+        for src in corpus:
+            for k in old:
+                if k in src:
+                    break
+    t_old = time.ticks_diff(time.ticks_us(), t)
+    t = time.ticks_us()
+    for i in range(n):
+        for src in corpus:
+            validate(src)
+    t_new = time.ticks_diff(time.ticks_us(), t)
+    print("每段代码: 子串黑名单 %d us, 白名单校验 %d us (结果按哈希缓存后只校验一次)"
+          % (t_old // (n * len(corpus)), t_new // (n * len(corpus))))
+    print("沙箱测试通过")
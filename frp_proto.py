@@ -0,0 +1,29 @@
+# frp_proto.py - FRP隧道多路复用帧格式(设备端与服务端共用)
+# 认证仍是一行JSON; 认证通过后控制连接上只传帧:
+#   类型(1字节) 流ID(2字节) 负载长度(2字节), 大端, 后跟负载
+# 每个流每个方向有独立的发送窗口, 接收方把数据交付后用 WINDOW 帧归还额度, 慢的流不会挡住其他流
+# 服务端发往设备的窗口从 0 开始: 设备接受这个流(连上本地服务)时才用 WINDOW 帧给出 INITIAL_WINDOW,
+# 设备的流已满时新流在设备端排队, 访客的数据留在服务端等待, 不会被重置
+import struct
+
+HDR_FMT = '>BHH'
+HDR_SIZE = 5
+
+OPEN = 1      # 服务端 -> 设备: 新的远程访客, 负载为空
+DATA = 2      # 双向: 流数据
+CLOSE = 3     # 双向: 流结束, 收到后把已缓存的数据交付完就关闭
+WINDOW = 4    # 双向: 归还发送额度, 负载为4字节无符号整数
+PING = 5      # 设备 -> 服务端: 心跳, 流ID为0, 负载为4字节发送时刻(毫秒)
+PONG = 6      # 服务端 -> 设备: 原样带回 PING 的负载, 用来计算往返时延
+
+INITIAL_WINDOW = 4096   # 每个流每个方向的初始窗口(字节)
+MAX_FRAME = 2048        # 单个 DATA 帧的最大负载
+
+def pack_header(buf, offset, ftype, sid, length):
+    struct.pack_into(HDR_FMT, buf, offset, ftype, sid, length)
+
+def frame(ftype, sid, payload=b''):
+    return struct.pack(HDR_FMT, ftype, sid, len(payload)) + payload
+
+def window_frame(sid, increment):
+    return frame(WINDOW, sid, struct.pack('>I', increment))
@@ -0,0 +1,322 @@
+# frp_server.py - 本地测试用的FRP服务端(在电脑上用CPython运行, 不上传到设备)
+# 用法: python frp_server.py [--port 7000] [--public 8080] [--token xxx]
+# 设备连上控制端口并认证后, 浏览器访问公共端口, 每个访客连接对应控制连接上的一个流
+# 故障注入: --drop N 每条控制连接N秒后强行断开; --mute N 认证N秒后不再回应也不再读取(模拟链路假死)
+# 压测: python frp_server.py --bench 4  设备端隧道代码也在本进程里跑, 经本机回环测单流吞吐(MB/s)、隧道线程每MB的CPU时间
+#   以及 1/4/16 个并发流的总吞吐
+# 重连检查: python frp_server.py --check [--drop 2]  控制连接反复被断开, 检查自动重连和字节计数
+import argparse
+import asyncio
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+
+import frp_proto as proto
+
+class Stream:
+    def __init__(self, sid, writer):
+        self.sid = sid
+        self.writer = writer               # 浏览器连接
+        self.send_window = 0                 # 设备接受这个流时给出初始窗口
+        self.window_open = asyncio.Event()
+        self.inbox = asyncio.Queue()       # 设备发来的数据, None 表示设备关闭了流
+        self.closed = False
+
+class Session:
+    """一条已认证的设备控制连接"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.streams = {}
+        self.next_sid = 1
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def close_stream(self, st, notify):
+        if st.closed:
+            return
+        st.closed = True
+        st.window_open.set()
+        st.inbox.put_nowait(None)
+        if notify:
+            self.send(proto.frame(proto.CLOSE, st.sid))
+        self.streams.pop(st.sid, None)
+
+    async def read_frames(self):
+        try:
+            while True:
+                hdr = await self.reader.readexactly(proto.HDR_SIZE)
+                ftype, sid, length = struct.unpack(proto.HDR_FMT, hdr)
+                payload = await self.reader.readexactly(length) if length else b''
+                if ftype == proto.PING:
+                    self.send(proto.frame(proto.PONG, 0, payload))
+                    continue
+                st = self.streams.get(sid)
+                if st is None:
+                    continue
+                if ftype == proto.DATA:
+                    st.inbox.put_nowait(payload)
+                elif ftype == proto.WINDOW:
+                    st.send_window += struct.unpack('>I', payload)[0]
+                    st.window_open.set()
+                elif ftype == proto.CLOSE:
+                    self.close_stream(st, False)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        for st in list(self.streams.values()):
+            self.close_stream(st, False)
+
+    async def visitor(self, reader, writer):
+        sid = self.next_sid
+        self.next_sid = self.next_sid % 0xFFFF + 1
+        st = Stream(sid, writer)
+        self.streams[sid] = st
+        self.send(proto.frame(proto.OPEN, sid))
+        down = asyncio.ensure_future(self._to_browser(st))
+        try:
+            # 浏览器 -> 设备, 不超过设备给的窗口
+            while not st.closed:
+                if st.send_window <= 0:
+                    st.window_open.clear()
+                    await st.window_open.wait()
+                    continue
+                data = await reader.read(min(st.send_window, proto.MAX_FRAME))
+                if not data or st.closed:
+                    break
+                st.send_window -= len(data)
+                self.send(proto.frame(proto.DATA, sid, data))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.close_stream(st, True)
+        await down
+        writer.close()
+
+    async def _to_browser(self, st):
+        # 设备 -> 浏览器, 写出并排空后再归还窗口, 慢的浏览器只会卡住自己的流
+        while True:
+            data = await st.inbox.get()
+            if data is None:
+                st.writer.close()    # 让 visitor 的读取随之结束
+                return
+            try:
+                st.writer.write(data)
+                await st.writer.drain()
+            except ConnectionError:
+                self.close_stream(st, True)
+                return
+            if not st.closed:
+                self.send(proto.window_frame(st.sid, len(data)))
+
+async def serve(port=7000, public=0, token='', drop=0, mute=0):
+    servers = {}
+
+    async def on_control(reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            auth = json.loads(await reader.readline())
+        except ValueError:
+            writer.close()
+            return
+        if auth.get('type') != 'auth' or auth.get('token', '') != token or not auth.get('mux'):
+            print("认证失败:", peer)
+            writer.write(b'{"type":"auth_fail"}\n')
+            writer.close()
+            return
+        writer.write(b'{"type":"auth_ok"}\n')
+        pport = public or auth.get('remote_port', 8080)
+        sess = Session(reader, writer)
+        old = servers.pop(pport, None)
+        if old:
+            old.close()
+        pub = servers[pport] = await asyncio.start_server(sess.visitor, '0.0.0.0', pport)
+        print("设备 %s 已认证(%s), 公共端口 %d" % (auth.get('device_id'), peer[0], pport))
+        task = asyncio.ensure_future(sess.read_frames())
+        if mute:
+            await asyncio.sleep(mute)
+            print("故障注入: 控制连接假死")
+            task.cancel()
+            await asyncio.sleep(3600)
+        elif drop:
+            await asyncio.wait([task], timeout=drop)
+            if not task.done():
+                print("故障注入: 断开控制连接")
+                writer.transport.abort()
+        await asyncio.gather(task, return_exceptions=True)
+        pub.close()
+        if servers.get(pport) is pub:
+            del servers[pport]
+        print("设备已断开:", peer[0])
+
+    srv = await asyncio.start_server(on_control, '0.0.0.0', port)
+    print("控制端口 %d 等待设备连接" % port)
+    async with srv:
+        await srv.serve_forever()
+
+# ---- 压测: 设备端的隧道代码也在本进程里跑, 控制连接和访客都走本机回环 ----
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _device_tunnel(ctrl_port, local_port, public_port):
+    """在电脑上启动设备端隧道: 补上 MicroPython 的 time.ticks_* 和 network/machine 模块, 返回 tunnel"""
+    if not hasattr(time, 'ticks_ms'):
+        t0 = time.monotonic()
+        time.ticks_ms = lambda: int((time.monotonic() - t0) * 1000)
+        time.ticks_diff = lambda a, b: a - b
+        time.ticks_add = lambda a, b: a + b
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    sys.modules.setdefault('network', types.ModuleType('network'))
+    machine = sys.modules.setdefault('machine', types.ModuleType('machine'))
+    machine.unique_id = lambda: b'loopback'
+    import frp_tunnel
+    t = frp_tunnel.tunnel
+    t.config.update(server='127.0.0.1', port=ctrl_port, token='', local_port=local_port, remote_port=public_port)
+    # 隧道线程里每轮轮询都会调用 _alive, 顺便记下线程CPU时间
+    t.cpu = 0.0
+    alive = t._alive
+    def _alive():
+        t.cpu = time.thread_time()
+        return alive()
+    t._alive = _alive
+    t.running = t.thread_alive = True
+    threading.Thread(target=t.tunnel_thread, daemon=True).start()
+    for i in range(100):
+        if t.state == frp_tunnel.UP:
+            break
+        time.sleep(0.05)
+    time.sleep(0.2)      # 等服务端开好公共端口
+    return t
+
+def _blob_server(size):
+    """设备上Web服务的替身: 读完请求头后回 size 字节正文再关闭, 返回端口"""
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(64)
+    body = bytes(size)
+
+    def one(c):
+        with c:
+            data = b''
+            while b'\r\n\r\n' not in data:
+                d = c.recv(1024)
+                if not d:
+                    return
+                data += d
+            c.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % size + body)
+
+    def loop():
+        while True:
+            c, addr = srv.accept()
+            threading.Thread(target=one, args=(c,), daemon=True).start()
+    threading.Thread(target=loop, daemon=True).start()
+    return srv.getsockname()[1]
+
+def _fetch(port):
+    """访客: 经公共端口取一次, 返回收到的字节数"""
+    s = socket.create_connection(('127.0.0.1', port), timeout=30)
+    s.sendall(b'GET / HTTP/1.0\r\n\r\n')
+    n = 0
+    while True:
+        d = s.recv(65536)
+        if not d:
+            break
+        n += len(d)
+    s.close()
+    return n
+
+def bench(size):
+    ctrl, public = _free_port(), _free_port()
+    threading.Thread(target=lambda: asyncio.run(serve(ctrl, public)), daemon=True).start()
+    time.sleep(0.2)
+    t = _device_tunnel(ctrl, _blob_server(size), public)
+    _fetch(public)       # 预热
+    cpu, wall = t.cpu, time.perf_counter()
+    n = _fetch(public)
+    wall = time.perf_counter() - wall
+    mb = n / 1e6
+    print("单流: %.1f MB 用时 %.2f 秒, %.2f MB/s, 隧道线程CPU %.0f 毫秒/MB" % (mb, wall, mb / wall, (t.cpu - cpu) * 1000 / mb))
+    # 多个访客同时访问, 超过设备 MAX_STREAMS 的在设备端排队
+    for k in (1, 4, 16):
+        got = []
+        def visitor():
+            try:
+                got.append(_fetch(public))
+            except OSError:
+                got.append(0)
+        threads = [threading.Thread(target=visitor) for i in range(k)]
+        wall = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        wall = time.perf_counter() - wall
+        ok = sum(1 for n in got if n > size)
+        print("%2d 个并发流: 成功 %2d, 合计 %.2f MB/s" % (k, ok, sum(got) / 1e6 / wall))
+    return t, public
+
+def check(drop, cycles=3):
+    """故障注入检查: 控制连接每 drop 秒被断开一次, 隧道应自动重连, 字节计数只增不减也不重复"""
+    ctrl, public = _free_port(), _free_port()
+    threading.Thread(target=lambda: asyncio.run(serve(ctrl, public, drop=drop)), daemon=True).start()
+    time.sleep(0.2)
+    t = _device_tunnel(ctrl, _blob_server(1000), public)
+    last = t.get_status()
+    fetched = states = 0
+    deadline = time.monotonic() + cycles * (drop + 1.5) + 2
+    while t.reconnects < cycles and time.monotonic() < deadline:
+        try:
+            if _fetch(public):
+                fetched += 1
+        except OSError:
+            pass
+        st = t.get_status()
+        assert st['bytes_in'] >= last['bytes_in'] and st['bytes_out'] >= last['bytes_out'], (last, st)
+        if not st['connected']:
+            states += 1
+            # 断开期间计数保持不变(以前会把刚结束的连接再算一遍)
+            assert st['streams'] == 0, st
+            assert last['connected'] or st['bytes_out'] == last['bytes_out'], (last, st)
+        last = st
+        time.sleep(0.1)
+    assert t.reconnects >= cycles and states, (t.reconnects, states)
+    time.sleep(1.5)      # 等最后一次重连完成
+    st = t.get_status()
+    assert st['state'] == 'up' and _fetch(public), st
+    # 每次访问: 访客请求 18 字节进, 1000 字节正文加响应头出
+    print("重连检查通过: 断开重连 %d 次, 最近一次 %d 毫秒, 成功访问 %d 次, 收 %d 字节, 发 %d 字节"
+          % (st['reconnects'], st['reconnect_ms'], fetched + 1, st['bytes_in'], st['bytes_out']))
+
+def main():
+    ap = argparse.ArgumentParser(description="FRP多路复用测试服务端")
+    ap.add_argument('--port', type=int, default=7000, help="设备控制端口")
+    ap.add_argument('--public', type=int, default=0, help="公共端口, 默认使用设备认证时给出的 remote_port")
+    ap.add_argument('--token', default='', help="认证token")
+    ap.add_argument('--drop', type=float, default=0, help="故障注入: 控制连接存活秒数")
+    ap.add_argument('--mute', type=float, default=0, help="故障注入: 认证后多少秒开始假死")
+    ap.add_argument('--bench', type=float, default=0, metavar='MB', help="本机回环压测: 每次访问取多少MB")
+    ap.add_argument('--check', action='store_true', help="本机回环故障注入检查, 配合 --drop(默认2秒)")
+    args = ap.parse_args()
+    if args.bench:
+        bench(int(args.bench * 1e6))
+        return
+    if args.check:
+        check(args.drop or 2)
+        return
+    asyncio.run(serve(args.port, args.public, args.token, args.drop, args.mute))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -4,17 +4,324 @@ FRP_PORT_DEFAULT   = 80          # 默认端口
 FRP_TOKEN_DEFAULT  = ""            # 默认token
 
 import socket
+import select
+import errno
 import _thread
 import time
 import json
+import random
 import network
 import machine
 
+import struct
+import frp_proto as proto
+
+POLL_MS = 200
+MAX_STREAMS = 8         # 同时存在的远程会话上限, 每个会话占用 INITIAL_WINDOW 字节接收缓冲和一个本地套接字
+MAX_WAITING = 32        # 超出上限的会话排队等待, 队列也满时才拒绝
+CTRL_BUF = 8192         # 控制连接收发缓冲区
+CTRL_RESERVE = 256      # 发送缓冲区为控制帧预留的空间
+
+HEARTBEAT_MS = 5000     # 心跳间隔
+DEGRADED_RTT_MS = 1000  # 往返时延超过此值或丢失一次心跳视为链路变差
+DEAD_MS = 15000         # 这么久没收到服务器任何数据就判定链路已断, 主动重连
+BACKOFF_MIN_MS = 1000   # 重连退避: 从1秒起每次翻倍, 最长60秒, 再乘以0.5~1的随机系数
+BACKOFF_MAX_MS = 60000
+
+# 隧道状态
+CONNECTING = 'connecting'
+UP = 'up'
+DEGRADED = 'degraded'
+DOWN = 'down'
+
+# start_frp 失败的原因
+NO_WIFI = "请先连接WiFi"
+STOPPING = "上一个隧道线程尚未退出, 请稍后重试"
+
+def _would_block(e):
+    return e.args and e.args[0] == errno.EAGAIN
+
+def _recv_into(sock, buf):
+    # MicroPython 的 socket 可能只有 readinto, 非阻塞无数据时返回 None
+    if hasattr(sock, 'recv_into'):
+        return sock.recv_into(buf)
+    n = sock.readinto(buf)
+    if n is None:
+        raise OSError(errno.EAGAIN)
+    return n
+
+class _Stream:
+    """一个远程会话: 对应一条到本地Web服务器的连接"""
+    def __init__(self, sid, sock):
+        self.sid = sid
+        self.sock = sock
+        self.send_window = proto.INITIAL_WINDOW   # 还能发往服务器的字节数
+        self.buf = bytearray(proto.INITIAL_WINDOW) # 服务器发来、尚未写给本地连接的数据
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.consumed = 0        # 已交付本地、尚未归还给服务器的窗口
+        self.local_eof = False
+        self.remote_closed = False
+
+    def pending(self):
+        return self.end > self.start
+
+class Mux:
+    """设备端多路复用: 一个线程用 select.poll 同时服务控制连接和所有本地连接"""
+    def __init__(self, ctrl, local_port, alive, counters=None):
+        self.ctrl = ctrl
+        self.local_port = local_port
+        self.alive = alive
+        self.counters = counters or self     # 字节数直接累加到这里, 断线重连后也不重复计算
+        self.rx = bytearray(CTRL_BUF)
+        self.rx_mv = memoryview(self.rx)
+        self.rx_len = 0
+        self.tx = bytearray(CTRL_BUF)
+        self.tx_mv = memoryview(self.tx)
+        self.tx_start = 0
+        self.tx_end = 0
+        self.backlog = []        # 发送缓冲区满时暂存的控制帧
+        self.streams = {}
+        self.waiting = []        # 排队中的流ID, 有空位时按顺序接受
+        self.poller = select.poll()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_rx = time.ticks_ms()
+        self.last_ping = time.ticks_add(self.last_rx, -HEARTBEAT_MS)   # 连上后立即测一次时延
+        self.ping_out = False    # 已发出心跳、尚未收到回应
+        self.rtt = -1
+
+    def degraded(self):
+        late = self.ping_out and time.ticks_diff(time.ticks_ms(), self.last_ping) > HEARTBEAT_MS
+        return late or self.rtt > DEGRADED_RTT_MS
+
+    def _heartbeat(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.last_rx) > DEAD_MS:
+            raise OSError("心跳超时")
+        if not self.ping_out and time.ticks_diff(now, self.last_ping) >= HEARTBEAT_MS:
+            self.last_ping = now
+            self.ping_out = True
+            self._queue(proto.frame(proto.PING, 0, struct.pack('>I', now & 0xFFFFFFFF)))
+
+    # ---- 控制连接发送 ----
+    def _tx_room(self):
+        if self.tx_start and self.tx_start == self.tx_end:
+            self.tx_start = self.tx_end = 0
+        elif self.tx_start and CTRL_BUF - self.tx_end < proto.HDR_SIZE + proto.MAX_FRAME:
+            n = self.tx_end - self.tx_start
+            self.tx[0:n] = self.tx_mv[self.tx_start:self.tx_end]
+            self.tx_start = 0
+            self.tx_end = n
+        return CTRL_BUF - self.tx_end
+
+    def _queue(self, data):
+        if self.backlog or self._tx_room() < len(data):
+            self.backlog.append(data)
+            return
+        self.tx[self.tx_end:self.tx_end + len(data)] = data
+        self.tx_end += len(data)
+
+    def _flush(self):
+        while self.backlog and self._tx_room() >= len(self.backlog[0]):
+            data = self.backlog.pop(0)
+            self.tx[self.tx_end:self.tx_end + len(data)] = data
+            self.tx_end += len(data)
+        if self.tx_end > self.tx_start:
+            try:
+                n = self.ctrl.send(self.tx_mv[self.tx_start:self.tx_end])
+            except OSError as e:
+                if _would_block(e):
+                    return
+                raise
+            self.tx_start += n
+
+    # ---- 控制连接接收 ----
+    def _read_ctrl(self):
+        try:
+            n = _recv_into(self.ctrl, self.rx_mv[self.rx_len:])
+        except OSError as e:
+            if _would_block(e):
+                return True
+            raise
+        if not n:
+            return False
+        self.last_rx = time.ticks_ms()
+        self.rx_len += n
+        off = 0
+        while self.rx_len - off >= proto.HDR_SIZE:
+            ftype, sid, length = struct.unpack_from(proto.HDR_FMT, self.rx, off)
+            if length > proto.MAX_FRAME:
+                raise ValueError("帧过长")
+            end = off + proto.HDR_SIZE + length
+            if end > self.rx_len:
+                break
+            self._on_frame(ftype, sid, self.rx_mv[off + proto.HDR_SIZE:end])
+            off = end
+        if off:
+            rest = self.rx_len - off
+            self.rx[0:rest] = self.rx_mv[off:self.rx_len]
+            self.rx_len = rest
+        return True
+
+    def _on_frame(self, ftype, sid, payload):
+        if ftype == proto.PONG:
+            if len(payload) == 4:
+                sent = struct.unpack_from('>I', payload, 0)[0]
+                self.rtt = time.ticks_diff(self.last_rx, sent)
+                self.ping_out = False
+            return
+        st = self.streams.get(sid)
+        if ftype == proto.DATA:
+            if st is None or st.remote_closed:
+                return
+            n = len(payload)
+            if st.end + n > len(st.buf):
+                k = st.end - st.start
+                st.buf[0:k] = st.mv[st.start:st.end]
+                st.start, st.end = 0, k
+                if k + n > len(st.buf):
+                    print("流 %d 超出窗口, 关闭" % sid)
+                    self._close(st, True)
+                    return
+            st.buf[st.end:st.end + n] = payload
+            st.end += n
+            self.counters.bytes_in += n
+        elif ftype == proto.OPEN:
+            self._open(sid)
+        elif ftype == proto.CLOSE:
+            if st is not None:
+                st.remote_closed = True
+            elif sid in self.waiting:
+                self.waiting.remove(sid)
+        elif ftype == proto.WINDOW:
+            if st is not None and len(payload) == 4:
+                st.send_window += struct.unpack_from('>I', payload, 0)[0]
+
+    # ---- 本地连接 ----
+    def _open(self, sid):
+        if sid in self.streams or sid in self.waiting:
+            return
+        if len(self.streams) >= MAX_STREAMS:
+            # 服务端在收到窗口之前不会发数据, 排队的流不占缓冲区
+            if len(self.waiting) < MAX_WAITING:
+                self.waiting.append(sid)
+            else:
+                self._queue(proto.frame(proto.CLOSE, sid))
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(2)
+            sock.connect(('127.0.0.1', self.local_port))
+            sock.setblocking(False)
+        except Exception as e:
+            print("连接本地服务失败:", e)
+            sock.close()
+            self._queue(proto.frame(proto.CLOSE, sid))
+            return
+        self.streams[sid] = _Stream(sid, sock)
+        self.poller.register(sock, select.POLLIN)
+        self._queue(proto.window_frame(sid, proto.INITIAL_WINDOW))
+
+    def _close(self, st, notify):
+        if notify:
+            self._queue(proto.frame(proto.CLOSE, st.sid))
+        try: self.poller.unregister(st.sock)
+        except: pass
+        try: st.sock.close()
+        except: pass
+        self.streams.pop(st.sid, None)
+        if self.waiting:
+            self._open(self.waiting.pop(0))
+
+    def _service(self, st):
+        # 本地 -> 服务器: 直接收进发送缓冲区, 在数据前面补上帧头
+        if not st.local_eof and st.send_window > 0:
+            room = self._tx_room() - CTRL_RESERVE - proto.HDR_SIZE
+            want = min(st.send_window, proto.MAX_FRAME, room)
+            if want > 0 and not self.backlog:
+                pos = self.tx_end + proto.HDR_SIZE
+                try:
+                    n = _recv_into(st.sock, self.tx_mv[pos:pos + want])
+                except OSError as e:
+                    if not _would_block(e):
+                        self._close(st, True)
+                        return
+                    n = -1
+                if n == 0:
+                    st.local_eof = True
+                    self._close(st, True)
+                    return
+                if n > 0:
+                    proto.pack_header(self.tx, self.tx_end, proto.DATA, st.sid, n)
+                    self.tx_end = pos + n
+                    st.send_window -= n
+                    self.counters.bytes_out += n
+        # 服务器 -> 本地: 写出缓存的数据, 攒够半个窗口再归还额度
+        if st.pending():
+            try:
+                n = st.sock.send(st.mv[st.start:st.end])
+            except OSError as e:
+                if not _would_block(e):
+                    self._close(st, True)
+                    return
+                n = 0
+            st.start += n
+            st.consumed += n
+            if st.start == st.end:
+                st.start = st.end = 0
+            if st.consumed >= proto.INITIAL_WINDOW // 2 or (st.consumed and not st.pending()):
+                self._queue(proto.window_frame(st.sid, st.consumed))
+                st.consumed = 0
+        if st.remote_closed and not st.pending():
+            self._close(st, False)
+
+    def run(self):
+        """运行到控制连接断开或 alive() 为假; 返回 True 表示服务器断开"""
+        self.ctrl.setblocking(False)
+        self.poller.register(self.ctrl, select.POLLIN)
+        try:
+            while self.alive():
+                self._heartbeat()
+                out = self.tx_end > self.tx_start or self.backlog
+                self.poller.modify(self.ctrl, select.POLLIN | (select.POLLOUT if out else 0))
+                for st in self.streams.values():
+                    flags = 0
+                    if not st.local_eof and st.send_window > 0:
+                        flags |= select.POLLIN
+                    if st.pending():
+                        flags |= select.POLLOUT
+                    self.poller.modify(st.sock, flags)
+                if not self.poller.poll(POLL_MS):
+                    continue
+                if not self._read_ctrl():
+                    return True
+                for st in list(self.streams.values()):
+                    self._service(st)
+                self._flush()
+            return False
+        finally:
+            self.waiting = []
+            for st in list(self.streams.values()):
+                self._close(st, False)
+            try: self.poller.unregister(self.ctrl)
+            except: pass
+
 class FRPTunnel:
     def __init__(self):
         self.running = False
         self.client_socket = None
         self.thread_id = None
+        self.thread_alive = False
+        self.mux = None
+        self.state = DOWN
+        self.last_error = ''
+        self.reconnects = 0
+        self.bytes_in = 0        # 所有连接累计, 由 Mux 直接累加
+        self.bytes_out = 0
+        self.down_since = None   # 断开时刻, 用来计算重连耗时
+        self.reconnect_ms = -1   # 最近一次从断开到恢复的耗时
         self.config = {
             'server': FRP_SERVER_DEFAULT,
             'port': FRP_PORT_DEFAULT,
@@ -57,107 +364,129 @@ class FRPTunnel:
                 'device_id': str(machine.unique_id()),
                 'token': self.config['token'],
                 'local_port': self.config['local_port'],
-                'remote_port': self.config['remote_port']
+                'remote_port': self.config['remote_port'],
+                'mux': 1
             }
             auth_json = json.dumps(auth_data)
-            self.client_socket.send(auth_json.encode() + b'\n')
-            response = self.client_socket.recv(1024)
-            print(f"服务器响应: {response.decode()}")
+            self.client_socket.sendall(auth_json.encode() + b'\n')
+            # 逐字节读到换行, 不把紧随其后的帧读走
+            response = b''
+            while not response.endswith(b'\n') and len(response) < 1024:
+                c = self.client_socket.recv(1)
+                if not c: raise OSError("服务器关闭了连接")
+                response += c
+            print(f"服务器响应: {response.decode().strip()}")
+            if json.loads(response).get('type') != 'auth_ok':
+                raise OSError("认证失败")
             return True
         except Exception as e:
             print(f"连接FRP服务器失败: {e}")
-            self.stop()
+            self.last_error = str(e)
+            self._close_socket()
             return False
+
+    def _close_socket(self):
+        if self.client_socket:
+            try: self.client_socket.close()
+            except: pass
+            self.client_socket = None
     
     def tunnel_thread(self):
-        print("FRP隧道线程启动")
-        if not self.connect_to_server():
-            return
-        local_socket = None
         try:
-            local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            local_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            local_socket.bind(('0.0.0.0', self.config['local_port']))
-            local_socket.listen(1)
-            local_socket.settimeout(1)
-            print(f"本地监听端口: {self.config['local_port']}")
-            while self.running:
+            self._tunnel_loop()
+        finally:
+            self.thread_alive = False
+
+    def _tunnel_loop(self):
+        # 监督循环: 连接失败或链路断开后按指数退避加随机抖动重连, 直到 stop()
+        print("FRP隧道线程启动")
+        attempt = 0
+        while self.running:
+            self.state = CONNECTING
+            if self.connect_to_server():
+                attempt = 0
+                if self.down_since is not None:
+                    self.reconnects += 1
+                    self.reconnect_ms = time.ticks_diff(time.ticks_ms(), self.down_since)
+                    self.down_since = None
+                self.state = UP
+                self.mux = Mux(self.client_socket, self.config['local_port'], self._alive, self)
                 try:
-                    local_conn, local_addr = local_socket.accept()
-                    print(f"本地连接: {local_addr}")
-                    conn_msg = {
-                        'type': 'new_connection',
-                        'client_id': str(local_addr)
-                    }
-                    self.client_socket.send(json.dumps(conn_msg).encode() + b'\n')
-                    local_conn.settimeout(5)
-                    self.client_socket.settimeout(5)
-                    try:
-                        while True:
-                            data = local_conn.recv(1024)
-                            if not data: break
-                            self.client_socket.send(data)
-                        while True:
-                            data = self.client_socket.recv(1024)
-                            if not data: break
-                            local_conn.send(data)
-                    except Exception as e:
-                        print(f"数据转发错误: {e}")
-                    try:
-                        local_conn.close()
-                    except: pass
-                except socket.timeout:
-                    continue
+                    if self.mux.run():
+                        self.last_error = "服务器断开"
                 except Exception as e:
-                    print(f"接受连接错误: {e}")
-                    time.sleep(1)
-        except Exception as e:
-            print(f"隧道错误: {e}")
-        finally:
-            if local_socket:
-                try: local_socket.close()
-                except: pass
-            if self.client_socket:
-                try: self.client_socket.close()
-                except: pass
-            print("FRP隧道线程结束")
-    
+                    self.last_error = str(e)
+                self.mux = None
+                self._close_socket()
+            if not self.running:
+                break
+            if self.state != CONNECTING or self.down_since is None:
+                self.down_since = time.ticks_ms()
+            self.state = DOWN
+            delay = min(BACKOFF_MAX_MS, BACKOFF_MIN_MS << min(attempt, 6))
+            delay = delay // 2 + delay * random.getrandbits(8) // 512
+            attempt += 1
+            print("FRP链路断开(%s), %d 毫秒后重连" % (self.last_error, delay))
+            while self.running and delay > 0:
+                time.sleep_ms(100)
+                delay -= 100
+        self.state = DOWN
+        self.mux = None
+        print("FRP隧道线程结束")
+
+    def _alive(self):
+        # 每轮轮询都会调用, 顺便更新链路状态
+        if self.running:
+            self.state = DEGRADED if self.mux.degraded() else UP
+        return self.running
+
     def start(self, server, port, token):
-        if self.running: return True
+        """启动隧道线程, 成功返回 None, 否则返回原因; 不等待, 由调用方决定是否稍后重试"""
+        if self.running: return None
+        # 隧道线程是常驻的, 不进工作线程池; 上一个线程退出前不再新建, 保证最多只有一个
+        if self.thread_alive:
+            return STOPPING
         self.config['server'] = server
         self.config['port'] = port
         self.config['token'] = token
         self.save_config()
         self.running = True
+        self.thread_alive = True
         self.thread_id = _thread.start_new_thread(self.tunnel_thread, ())
-        return True
+        return None
     
     def stop(self):
+        # 只通知隧道线程退出, 由它自己关闭套接字
         self.running = False
-        if self.client_socket:
-            try: self.client_socket.close()
-            except: pass
-            self.client_socket = None
-        time.sleep(1)
         print("FRP隧道已停止")
         return True
-    
+
     def get_status(self):
+        mux = self.mux
         status = {
             'running': self.running,
+            'state': self.state,
             'config': self.config,
-            'connected': self.client_socket is not None
+            'connected': self.state in (UP, DEGRADED),
+            'streams': len(mux.streams) if mux else 0,
+            'rtt_ms': mux.rtt if mux else -1,
+            'reconnects': self.reconnects,
+            'reconnect_ms': self.reconnect_ms,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'last_error': self.last_error
         }
         return status
 
 tunnel = FRPTunnel()
 
 def start_frp(server=None, port=None, token=None):
+    """成功返回 None, 否则返回原因"""
     print(f"启动FRP隧道: {server or tunnel.config['server']}:{port or tunnel.config['port']}")
     wlan = network.WLAN(network.STA_IF)
     if not wlan.isconnected():
         print("错误: 请先连接WiFi")
-        return False
+        return NO_WIFI
     s = server or tunnel.config['server']
     p = port   or tunnel.config['port']
     t = token  if token is not None else tunnel.config['token']
@@ -0,0 +1,134 @@
+# gpio_bank.py - 批量GPIO读写
+# Pin 对象按 (引脚, 模式) 缓存, 模式没变就不再重新配置; ESP32-S3 上批量写用 W1TS/W1TC 寄存器每组一次写完,
+# 批量读一次取回 GPIO_IN 寄存器, 其他芯片退回逐个 Pin.value()
+try:
+    import machine
+    import uos
+except ImportError:
+    machine = None      # 在电脑上运行时只用到 __main__ 里的请求测试
+
+GPIO_BASE = 0x60004000  # ESP32-S3 GPIO 寄存器
+_W1TS = (GPIO_BASE + 0x08, GPIO_BASE + 0x14)    # 置位: GPIO0-31, GPIO32-48
+_W1TC = (GPIO_BASE + 0x0C, GPIO_BASE + 0x18)    # 清零
+_IN = (GPIO_BASE + 0x3C, GPIO_BASE + 0x40)      # 输入电平
+MAX_PIN = 48
+
+def _is_s3():
+    try:
+        return 'ESP32S3' in uos.uname().machine.replace('-', '').upper()
+    except:
+        return False
+
+USE_REGS = machine is not None and hasattr(machine, 'mem32') and _is_s3()
+OUT = machine.Pin.OUT if machine else 1
+IN = machine.Pin.IN if machine else 0
+
+_cache = {}     # (引脚, 模式) -> Pin
+modes = {}      # 引脚 -> 当前模式
+pins = {}       # 引脚 -> 最近使用的 Pin, 推送状态时读取电平
+
+def get_pin(pin, mode):
+    """取缓存的 Pin; 引脚当前是别的模式时才重新配置"""
+    if not 0 <= pin <= MAX_PIN:
+        raise ValueError("无效的引脚: %d" % pin)
+    p = _cache.get((pin, mode))
+    if p is None:
+        p = machine.Pin(pin, mode)
+        _cache[(pin, mode)] = p
+    elif modes.get(pin) != mode:
+        p.init(mode)
+    modes[pin] = mode
+    pins[pin] = p
+    return p
+
+def write_many(values):
+    """values: {引脚: 0/1}, 引脚配置为输出后一次写入"""
+    items = [(int(pin), 1 if int(v) else 0) for pin, v in values.items()]
+    for pin, v in items:
+        get_pin(pin, OUT)
+    if USE_REGS:
+        hi = [0, 0]
+        lo = [0, 0]
+        for pin, v in items:
+            (hi if v else lo)[pin >> 5] |= 1 << (pin & 31)
+        for b in (0, 1):
+            if hi[b]:
+                machine.mem32[_W1TS[b]] = hi[b]
+            if lo[b]:
+                machine.mem32[_W1TC[b]] = lo[b]
+    else:
+        for pin, v in items:
+            pins[pin].value(v)
+    return dict(items)
+
+def read_many(pin_list):
+    """读取多个引脚; 已配置过的引脚按原模式读取(输出引脚读回当前电平), 没配置过的设为输入"""
+    pin_list = [int(pin) for pin in pin_list]
+    for pin in pin_list:
+        if pin not in modes:
+            get_pin(pin, IN)
+    if USE_REGS:
+        regs = [machine.mem32[_IN[0]], 0]
+        if any(pin >= 32 for pin in pin_list):
+            regs[1] = machine.mem32[_IN[1]]
+        return {pin: (regs[pin >> 5] >> (pin & 31)) & 1 for pin in pin_list}
+    return {pin: pins[pin].value() for pin in pin_list}
+
+def levels():
+    """所有用过的引脚的当前电平"""
+    out = {}
+    for pin in pins:
+        try: out[str(pin)] = pins[pin].value()
+        except: pass
+    return out
+
+def parse_query(args):
+    """紧凑查询格式: set=2:1,4:0&read=5,6"""
+    sets = {}
+    for item in args.get('set', '').split(','):
+        if item:
+            pin, v = item.split(':')
+            sets[int(pin)] = int(v)
+    reads = [int(pin) for pin in args.get('read', '').split(',') if pin]
+    return sets, reads
+
+# 测试代码: 设备上比较逐个读写与批量读写; 在电脑上运行时比较 N 次单引脚请求与一次批量请求
+#   python gpio_bank.py 192.168.4.1
+if __name__ == "__main__":
+    import time
+    test_pins = (4, 5, 6, 7, 15, 16, 17, 18)
+    if machine:
+        n = 200
+        t = time.ticks_us()
+        for i in range(n):
+            for pin in test_pins:
+                machine.Pin(pin, machine.Pin.OUT).value(i & 1)
+        single = time.ticks_diff(time.ticks_us(), t) // n
+        t = time.ticks_us()
+        for i in range(n):
+            write_many({pin: i & 1 for pin in test_pins})
+        batch = time.ticks_diff(time.ticks_us(), t) // n
+        print("写 %d 个引脚: 逐个新建Pin %d us, 批量 %d us (寄存器: %s)" % (len(test_pins), single, batch, USE_REGS))
+        print(read_many(test_pins))
+    else:
+        import sys
+        import socket
+        host = sys.argv[1] if len(sys.argv) > 1 else '192.168.4.1'
+
+        def get(path):
+            s = socket.create_connection((host, 80))
+            s.sendall(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (path, host)).encode())
+            while s.recv(4096):
+                pass
+            s.close()
+
+        t = time.time()
+        for pin in test_pins:
+            get('/gpio/set?pin=%d&value=1' % pin)
+        for pin in test_pins:
+            get('/gpio/read?pin=%d' % pin)
+        single = time.time() - t
+        t = time.time()
+        get('/gpio/batch?set=%s&read=%s' % (','.join('%d:1' % p for p in test_pins), ','.join(map(str, test_pins))))
+        batch = time.time() - t
+        print("%d 个引脚写+读: 单引脚请求 %.1f ms, 批量请求 %.1f ms" % (len(test_pins), single * 1000, batch * 1000))
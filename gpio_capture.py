@@ -0,0 +1,385 @@
+# gpio_capture.py - 高速GPIO/ADC采样
+# 3号硬件定时器按固定采样率采样, 写入预分配的 array('H') 环形缓冲区; 支持边沿/电平触发和触发前后窗口
+# 每个采样点: 数字通道合成一个16位字(第k个数字通道在第k位), 每个ADC通道一个字(read_u16)
+# 结果以紧凑二进制下载或边采边推送; 同一文件里的 decode()/decode_stream() 可在电脑上解析
+#
+# 二进制格式(小端):
+#   头部   '<4sBBBBIII': b'GCAP', 版本, 通道数, 每点字数, 标志, 采样率Hz, 采样点数, 触发点下标(无触发为0xFFFFFFFF)
+#   通道   每个4字节: 类型('d'/'a'), 引脚, 所在字, 位(ADC为0)
+#   数据   采样点数 x 每点字数 个 uint16, 按时间顺序
+# 推送格式: 头部中采样点数为0xFFFFFFFF, 之后是若干块, 每块 '<IH' (首个采样点序号, 点数) + 数据; 序号不连续表示推送跟不上丢了数据
+import struct
+from array import array
+try:
+    import machine
+except ImportError:
+    machine = None
+
+MAGIC = b'GCAP'
+VERSION = 1
+HDR_FMT = '<4sBBBBIII'
+HDR_SIZE = struct.calcsize(HDR_FMT)
+CHUNK_FMT = '<IH'
+CHUNK_SIZE = struct.calcsize(CHUNK_FMT)
+NO_TRIGGER = 0xFFFFFFFF
+STREAMING = 0xFFFFFFFF
+FLAG_STREAM = 1
+
+TIMER_ID = 3             # 0-2 留给波形引擎
+MAX_RATE = 5000          # 定时器回调最高频率(Hz)
+MAX_DIGITAL = 16         # 数字通道上限(一个16位字)
+MAX_BUFFER = 32 * 1024   # 环形缓冲区上限(字节)
+CHUNK_SAMPLES = 256      # 下载/推送时每块的采样点数
+TRIGGERS = ('rising', 'falling', 'high', 'low', 'above', 'below')   # above/below 用于ADC通道, 需要阈值
+
+IDLE, ARMED, RUNNING, DONE = 'idle', 'armed', 'running', 'done'
+
+class HardwareBackend:
+    def pin(self, n):
+        return machine.Pin(n, machine.Pin.IN).value
+
+    def adc(self, n):
+        a = machine.ADC(machine.Pin(n))
+        try: a.atten(machine.ADC.ATTN_11DB)
+        except: pass
+        return a.read_u16
+
+    def timer(self):
+        return machine.Timer(TIMER_ID)
+
+class SimTimer:
+    """模拟定时器: 不自动运行, 由 run(n) 手动推进"""
+    def init(self, freq, mode, callback):
+        self.callback = callback
+        self.active = True
+
+    def run(self, n):
+        for _ in range(n):
+            if not self.active:
+                break
+            self.callback(self)
+
+    def deinit(self):
+        self.active = False
+
+class SimBackend:
+    """模拟引脚: 数字引脚 n 输出周期为 2*(n+1) 个采样点的方波, ADC 输出锯齿波; 用于在电脑上测试"""
+    def __init__(self):
+        self.t = 0
+        self.timers = []
+
+    def pin(self, n):
+        period = 2 * (n + 1)
+        return lambda: 1 if (self.t % period) >= period // 2 else 0
+
+    def adc(self, n):
+        return lambda: (self.t * 1024 + n * 97) & 0xFFFF
+
+    def timer(self):
+        backend = self
+        class _T(SimTimer):
+            def init(self, freq, mode, callback):
+                def tick(t):
+                    callback(t)
+                    backend.t += 1
+                SimTimer.init(self, freq, mode, tick)
+        t = _T()
+        self.timers.append(t)
+        return t
+
+class Capture:
+    def __init__(self, backend=None):
+        self.backend = backend or HardwareBackend()
+        self.state = IDLE
+        self.timer = None
+        self.buf = None
+
+    def start(self, pins=(), adcs=(), rate=1000, depth=1000, trigger=None, post=None, stream=False):
+        """开始采样. trigger: (类型, 引脚, 阈值); post: 触发后采样点数, 默认为半个缓冲区; stream: 持续采样供推送"""
+        self.stop()
+        pins = list(pins)
+        adcs = list(adcs)
+        if not pins and not adcs:
+            raise ValueError("至少需要一个通道")
+        if len(pins) > MAX_DIGITAL:
+            raise ValueError("数字通道最多 %d 个" % MAX_DIGITAL)
+        if not 1 <= rate <= MAX_RATE:
+            raise ValueError("采样率范围 1-%d Hz" % MAX_RATE)
+        words = (1 if pins else 0) + len(adcs)
+        if depth < 2 or depth * words * 2 > MAX_BUFFER:
+            raise ValueError("缓冲区过大, 最多 %d 个采样点" % (MAX_BUFFER // (words * 2)))
+        self.channels = []
+        for k in range(len(pins)):
+            self.channels.append(('d', pins[k], 0, k))
+        for k in range(len(adcs)):
+            self.channels.append(('a', adcs[k], (1 if pins else 0) + k, 0))
+        self.trig = None
+        if trigger:
+            kind, tpin = trigger[0], trigger[1]
+            if kind not in TRIGGERS:
+                raise ValueError("不支持的触发方式")
+            ch = None
+            for c in self.channels:
+                if c[1] == tpin and (c[0] == 'a') == (kind in ('above', 'below')):
+                    ch = c
+            if ch is None:
+                raise ValueError("触发引脚不在采样通道中")
+            self.trig = (kind, ch[2], ch[3], trigger[2] if len(trigger) > 2 else 32768)
+        self.digital = [self.backend.pin(p) for p in pins]
+        self.analog = [self.backend.adc(p) for p in adcs]
+        self.words = words
+        self.depth = depth
+        self.rate = rate
+        self.stream = stream
+        self.post = depth if post is None and not self.trig else (post if post is not None else depth // 2)
+        self.post = max(1, min(self.post, depth))
+        self.buf = None          # 先释放旧缓冲区再分配
+        self.buf = array('H', bytearray(2 * words * depth))
+        self.widx = 0            # 下一个写入位置(采样点)
+        self.total = 0           # 已采样点数
+        self.remaining = self.post
+        self.trig_at = None      # 触发时的采样点序号
+        self.prev = None
+        self.state = ARMED if self.trig else RUNNING
+        if not self.trig:
+            self.trig_at = 0
+        self.timer = self.backend.timer()
+        self.timer.init(freq=rate, mode=machine.Timer.PERIODIC if machine else 1, callback=self._tick)
+        return self.status()
+
+    def _tick(self, t):
+        buf = self.buf
+        i = self.widx * self.words
+        w = 0
+        if self.digital:
+            m = 0
+            bit = 1
+            for get in self.digital:
+                if get():
+                    m |= bit
+                bit <<= 1
+            buf[i] = m
+            w = 1
+        for get in self.analog:
+            buf[i + w] = get()
+            w += 1
+        self.widx += 1
+        if self.widx >= self.depth:
+            self.widx = 0
+        self.total += 1
+        if self.state == ARMED:
+            kind, word, bit, thr = self.trig
+            v = buf[i + word]
+            if kind in ('above', 'below'):
+                v = 1 if (v >= thr) == (kind == 'above') else 0
+            else:
+                v = (v >> bit) & 1
+            prev = self.prev
+            self.prev = v
+            if self.total < self.depth - self.post:
+                pass                 # 触发前的部分还没采满
+            elif (kind == 'rising' and prev == 0 and v) or (kind == 'falling' and prev == 1 and not v) \
+                    or (kind == 'high' and v) or (kind == 'low' and not v) or (kind in ('above', 'below') and v):
+                self.trig_at = self.total - 1
+                self.state = RUNNING
+        if self.state == RUNNING and not self.stream:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.state = DONE
+                t.deinit()
+
+    def busy(self):
+        return self.state in (ARMED, RUNNING)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+        if self.state in (ARMED, RUNNING):
+            self.state = DONE if self.total else IDLE
+
+    def _window(self):
+        """缓冲区里有效数据: (首个采样点序号, 点数)"""
+        n = min(self.total, self.depth)
+        return self.total - n, n
+
+    def status(self):
+        st = {'state': self.state}
+        if self.buf is not None:
+            st.update({'rate': self.rate, 'depth': self.depth, 'samples': self.total,
+                       'channels': ['%s%d' % (c[0], c[1]) for c in self.channels],
+                       'trigger_at': self.trig_at})
+        return st
+
+    def _header(self, n, trig, flags=0):
+        out = struct.pack(HDR_FMT, MAGIC, VERSION, len(self.channels), self.words, flags, self.rate, n, trig)
+        for kind, pin, word, bit in self.channels:
+            out += struct.pack('<BBBB', ord(kind), pin, word, bit)
+        return out
+
+    def _samples(self, first, n):
+        """按时间顺序取出从序号 first 开始的 n 个采样点, 分块生成 bytes"""
+        mv = memoryview(self.buf)
+        while n > 0:
+            pos = first % self.depth
+            k = min(n, CHUNK_SAMPLES, self.depth - pos)
+            yield bytes(mv[pos * self.words:(pos + k) * self.words])
+            first += k
+            n -= k
+
+    def blob(self):
+        """整段下载: 返回 (总字节数, 逐块给出头部和数据的生成器); 数据窗口在调用时确定"""
+        if self.buf is None:
+            raise ValueError("没有采样数据")
+        first, n = self._window()
+        trig = NO_TRIGGER
+        if self.trig and self.trig_at is not None and self.trig_at >= first:
+            trig = self.trig_at - first
+        head = self._header(n, trig)
+        return len(head) + n * self.words * 2, self._blob(head, first, n)
+
+    def _blob(self, head, first, n):
+        yield head
+        for chunk in self._samples(first, n):
+            yield chunk
+
+    def stream_from(self, cursor):
+        """推送用: 返回 (新游标, 数据块列表); 游标落后超过缓冲区时跳过被覆盖的部分"""
+        first, n = self._window()
+        start = max(cursor, first)
+        out = []
+        while start < self.total:
+            k = min(self.total - start, CHUNK_SAMPLES)
+            data = b''.join(self._samples(start, k))
+            out.append(struct.pack(CHUNK_FMT, start, k) + data)
+            start += k
+        return start, out
+
+    def stream_header(self):
+        return self._header(STREAMING, NO_TRIGGER, FLAG_STREAM)
+
+capture = Capture() if machine else None
+
+def parse_query(args):
+    """查询参数: pins=4,5&adc=1&rate=2000&depth=1000&trigger=rising:4&post=500&stream=1
+    ADC阈值触发写成 trigger=above:1:30000"""
+    opts = {'pins': [int(p) for p in args.get('pins', '').split(',') if p],
+            'adcs': [int(p) for p in args.get('adc', '').split(',') if p],
+            'rate': int(args.get('rate', 1000)),
+            'depth': int(args.get('depth', 1000)),
+            'stream': args.get('stream') == '1'}
+    if args.get('trigger'):
+        t = args['trigger'].split(':')
+        opts['trigger'] = (t[0], int(t[1])) + ((int(t[2]),) if len(t) > 2 else ())
+    if 'post' in args:
+        opts['post'] = int(args['post'])
+    return opts
+
+# ---- 电脑端解析 ----
+def _decode_header(data):
+    magic, ver, nch, words, flags, rate, n, trig = struct.unpack_from(HDR_FMT, data, 0)
+    if magic != MAGIC or ver != VERSION:
+        raise ValueError("不是采样数据")
+    channels = []
+    off = HDR_SIZE
+    for _ in range(nch):
+        kind, pin, word, bit = struct.unpack_from('<BBBB', data, off)
+        channels.append((chr(kind), pin, word, bit))
+        off += 4
+    return {'rate': rate, 'words': words, 'samples': n, 'flags': flags,
+            'trigger': None if trig == NO_TRIGGER else trig, 'channels': channels}, off
+
+def _columns(info, raw, count):
+    """把原始字数组拆成每个通道一列"""
+    words = info['words']
+    cols = {}
+    for kind, pin, word, bit in info['channels']:
+        name = '%s%d' % (kind, pin)
+        if kind == 'd':
+            cols[name] = [(raw[s * words + word] >> bit) & 1 for s in range(count)]
+        else:
+            cols[name] = [raw[s * words + word] for s in range(count)]
+    return cols
+
+def decode(data):
+    """解析整段下载的数据, 返回 (头部信息, {通道名: 采样列表})"""
+    info, off = _decode_header(data)
+    n = info['samples']
+    raw = struct.unpack_from('<%dH' % (n * info['words']), data, off)
+    return info, _columns(info, raw, n)
+
+def decode_stream(data):
+    """解析推送数据, 返回 (头部信息, {通道名: 采样列表}, 丢失的采样点数)"""
+    info, off = _decode_header(data)
+    words = info['words']
+    raw = []
+    expect = None
+    lost = 0
+    while off + CHUNK_SIZE <= len(data):
+        first, k = struct.unpack_from(CHUNK_FMT, data, off)
+        off += CHUNK_SIZE
+        if expect is not None and first > expect:
+            lost += first - expect
+        expect = first + k
+        raw.extend(struct.unpack_from('<%dH' % (k * words), data, off))
+        off += k * words * 2
+    n = len(raw) // words
+    return info, _columns(info, raw, n), lost
+
+# 测试代码: 无参数时用模拟引脚测试; 给出文件名时解析下载的采样数据
+#   python gpio_capture.py capture.bin
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            data = f.read()
+        if struct.unpack_from(HDR_FMT, data, 0)[6] == STREAMING:
+            info, cols, lost = decode_stream(data)
+            print("推送数据, 丢失 %d 点" % lost)
+        else:
+            info, cols = decode(data)
+        print(info)
+        names = list(cols)
+        print(','.join(names))
+        for row in zip(*[cols[k] for k in names]):
+            print(','.join(str(v) for v in row))
+    else:
+        sim = SimBackend()
+        cap = Capture(sim)
+        # 无触发: 采满缓冲区后停止
+        cap.start(pins=(0, 1), adcs=(3,), rate=1000, depth=16)
+        sim.timers[-1].run(100)
+        assert cap.state == DONE and cap.total == 16
+        size, chunks = cap.blob()
+        data = b''.join(chunks)
+        assert len(data) == size
+        info, cols = decode(data)
+        print(info['samples'], cols)
+        assert cols['d0'] == [(t % 2) for t in range(16)]
+        assert cols['d1'] == [1 if t % 4 >= 2 else 0 for t in range(16)]
+        # 上升沿触发: 触发前后各保留一部分
+        cap.start(pins=(7,), rate=1000, depth=40, trigger=('rising', 7), post=10)
+        sim.timers[-1].run(1000)
+        info, cols = decode(b''.join(cap.blob()[1]))
+        k = info['trigger']
+        assert cap.state == DONE and cols['d7'][k - 1] == 0 and cols['d7'][k] == 1
+        assert info['samples'] == 40 and info['samples'] - k == 10
+        print("触发位置:", k, cols['d7'])
+        # ADC 阈值触发
+        cap.start(adcs=(2,), rate=1000, depth=20, trigger=('above', 2, 40000), post=5)
+        sim.timers[-1].run(1000)
+        info, cols = decode(b''.join(cap.blob()[1]))
+        assert cols['a2'][info['trigger']] >= 40000
+        # 持续推送: 读得慢时丢掉被覆盖的数据, 解析端能发现
+        cap.start(pins=(0,), rate=1000, depth=64, stream=True)
+        data = cap.stream_header()
+        cursor = 0
+        for step in (50, 30, 200, 10):
+            sim.timers[-1].run(step)
+            cursor, chunks = cap.stream_from(cursor)
+            data += b''.join(chunks)
+        cap.stop()
+        info, cols, lost = decode_stream(data)
+        print("推送: %d 点, 丢失 %d 点" % (len(cols['d0']), lost))
+        assert lost == 200 - 64 and len(cols['d0']) + lost == 290
+        print("采样引擎模拟测试通过")
@@ -0,0 +1,136 @@
+# http_bench.py - HTTP压测(在电脑上用CPython运行, 不上传到设备)
+# 用法: python http_bench.py load|keepalive [--host 192.168.4.1] [--port 80]
+#   load: 分别用 1/8/32 个并发客户端请求 /status, 输出每秒请求数和 p50/p99 延迟
+#   keepalive: 顺序请求 100 次 /status, 比较每次新建连接与保持连接的延迟
+#   不给 --host 时在本机 8080 端口起一份 web_main, machine/network 换成最简单的替身
+import argparse
+import http.client
+import os
+import sys
+import threading
+import time
+import types
+
+class _Dev:
+    OUT, IN, PULL_UP, PERIODIC, ONE_SHOT = 1, 0, 2, 1, 0
+    def __init__(self, *a, **k): pass
+    def __getattr__(self, name): return lambda *a, **k: 0
+
+class _WLAN:
+    def __init__(self, i): pass
+    def active(self, *a): return True
+    def config(self, *a, **k): return b'\0' * 6 if a else None
+    def ifconfig(self, *a): return ('192.168.4.1', '255.255.255.0', '192.168.4.1', '8.8.8.8')
+    def isconnected(self): return False
+    def status(self, *a): return 0
+    def scan(self): return []
+    def connect(self, *a, **k): pass
+    def disconnect(self): pass
+
+def _local_server(port):
+    """在本进程里启动 web_main: 补上 MicroPython 的 time.ticks_*、gc.mem_*, 以及 machine/network/micropython 模块"""
+    import gc, json
+    t0 = time.monotonic()
+    time.ticks_ms = lambda: int((time.monotonic() - t0) * 1000)
+    time.ticks_us = lambda: int((time.monotonic() - t0) * 1000000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    gc.mem_free = lambda: 200000
+    gc.mem_alloc = lambda: 100000
+    sys.modules['uos'] = os
+    sys.modules['ujson'] = json
+    machine = sys.modules['machine'] = types.ModuleType('machine')
+    machine.Pin = machine.PWM = machine.Timer = machine.ADC = _Dev
+    machine.freq = lambda f=None: 240000000
+    machine.unique_id = lambda: b'\x01\x02\x03\x04\x05\x06'
+    machine.reset = lambda: None
+    network = sys.modules['network'] = types.ModuleType('network')
+    network.WLAN = _WLAN
+    network.STA_IF, network.AP_IF = 0, 1
+    for i, name in enumerate(('STAT_IDLE', 'STAT_CONNECTING', 'STAT_GOT_IP', 'STAT_WRONG_PASSWORD',
+                              'STAT_NO_AP_FOUND', 'STAT_CONNECT_FAIL')):
+        setattr(network, name, 1000 + i)
+    mp = sys.modules['micropython'] = types.ModuleType('micropython')
+    mp.const = lambda x: x
+    mp.kbd_intr = lambda c: None
+    mp.schedule = lambda f, a: f(a)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))     # DOCTYPE.html 等按相对路径读
+    import web_main
+    web_main.HTTP_PORT = port
+    threading.Thread(target=web_main.main, daemon=True).start()
+    time.sleep(0.5)
+
+def load(host, port, clients, n):
+    """clients 个线程各自顺序请求, 每次新建连接; 返回 (每秒请求数, 排好序的延迟列表, 失败次数)"""
+    lat = []
+    errors = []
+
+    def client():
+        for i in range(n):
+            t = time.perf_counter()
+            try:
+                c = http.client.HTTPConnection(host, port, timeout=10)
+                c.request('GET', '/status', headers={'Connection': 'close'})
+                c.getresponse().read()
+                c.close()
+            except OSError:
+                errors.append(1)
+                continue
+            lat.append(time.perf_counter() - t)
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    t0 = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return len(lat) / wall, lat, len(errors)
+
+def sequential(host, port, keep, n=100):
+    """顺序请求 n 次, keep 为真时复用连接(服务器关闭时再新建); 返回 (排好序的延迟列表, 新建连接数)"""
+    lat = []
+    opened = 0
+    c = None
+    for i in range(n):
+        t = time.perf_counter()
+        if c is None:
+            c = http.client.HTTPConnection(host, port, timeout=10)
+            opened += 1
+        c.request('GET', '/status', headers={} if keep else {'Connection': 'close'})
+        r = c.getresponse()
+        r.read()
+        if r.will_close:
+            c.close()
+            c = None
+        lat.append(time.perf_counter() - t)
+    if c:
+        c.close()
+    lat.sort()
+    return lat, opened
+
+def main():
+    ap = argparse.ArgumentParser(description="Web服务压测")
+    ap.add_argument('mode', choices=('load', 'keepalive'))
+    ap.add_argument('--host', help="设备地址, 不给时在本机起一份 web_main")
+    ap.add_argument('--port', type=int, default=80)
+    args = ap.parse_args()
+    host, port = args.host, args.port
+    if host is None:
+        host, port = '127.0.0.1', 8080
+        _local_server(port)
+    if args.mode == 'keepalive':
+        for name, keep in (("每次新建连接", False), ("保持连接    ", True)):
+            lat, opened = sequential(host, port, keep)
+            print("%s: 100 次共 %6.1f ms  平均 %5.2f ms  p99 %5.2f ms  新建连接 %d 次" % (
+                name, sum(lat) * 1000, sum(lat) * 10, lat[98] * 1000, opened))
+        return
+    for clients in (1, 8, 32):
+        rps, lat, err = load(host, port, clients, max(10, 320 // clients))
+        print("%2d 个客户端: %7.1f 次/秒  p50 %6.1f ms  p99 %6.1f ms  最大 %6.1f ms  失败 %d" % (
+            clients, rps, lat[len(lat) // 2] * 1000, lat[max(0, len(lat) * 99 // 100 - 1)] * 1000, lat[-1] * 1000, err))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# http_response.py - HTTP响应与流式发送
+# 正文可以是 str/bytes、文件对象、分块生成器或异步数据源(带 pump 方法); 长度未知时用 chunked 编码, 经固定缓冲区写出
+
+REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+BUF_SIZE = 1024
+_buf = bytearray(BUF_SIZE)
+_mv = memoryview(_buf)
+
+class Response:
+    def __init__(self, body=b'', status=200, content_type='text/plain; charset=utf-8', headers=None, length=None, cache_head=False):
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or {}
+        # 反复发送的定长响应可以缓存编码好的响应头
+        self.heads = {} if cache_head else None
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.body = body
+        if length is None and isinstance(body, (bytes, bytearray, memoryview)):
+            length = len(body)
+        self.length = length    # None 表示长度未知, 使用分块编码
+
+def json_response(obj, status=200):
+    import ujson
+    return Response(ujson.dumps(obj), status, 'application/json')
+
+def _head(resp, keep_alive, chunked):
+    out = 'HTTP/1.1 ' + str(resp.status) + ' ' + REASONS.get(resp.status, 'OK') + '\r\n'
+    if resp.status not in (204, 304):
+        out += 'Content-Type: ' + resp.content_type + '\r\n'
+        if resp.length is not None:
+            out += 'Content-Length: ' + str(resp.length) + '\r\n'
+        elif chunked:
+            out += 'Transfer-Encoding: chunked\r\n'
+    for k in resp.headers:
+        out += k + ': ' + str(resp.headers[k]) + '\r\n'
+    if keep_alive:
+        out += 'Connection: keep-alive\r\nKeep-Alive: timeout=' + str(keep_alive) + '\r\n\r\n'
+    else:
+        out += 'Connection: close\r\n\r\n'
+    return out.encode()
+
+async def _emit(writer, data, chunked):
+    # StreamWriter.write 会立即写出或复制未写完的部分, drain 一直写到缓冲清空为止
+    if chunked:
+        writer.write(('%x\r\n' % len(data)).encode())
+        writer.write(data)
+        writer.write(b'\r\n')
+    else:
+        writer.write(data)
+    await writer.drain()
+
+def can_keep_alive(resp, http11):
+    """长度已知或可以分块编码时, 响应结束后连接才能复用"""
+    return resp.length is not None or http11
+
+async def send_response(writer, resp, keep_alive=0, http11=True):
+    """发送响应, 返回写出的正文字节数; keep_alive 为保持连接的空闲秒数, 0 表示发送后关闭"""
+    # HTTP/1.0 客户端不认识 chunked, 长度未知时直接写正文并在结束后关闭连接
+    chunked = resp.length is None and http11
+    if resp.heads is None:
+        writer.write(_head(resp, keep_alive, chunked))
+    else:
+        head = resp.heads.get(keep_alive)
+        if head is None:
+            head = resp.heads[keep_alive] = _head(resp, keep_alive, chunked)
+        writer.write(head)
+    body = resp.body
+    sent = 0
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        if body:
+            writer.write(body)
+        await writer.drain()
+        return len(body)
+    if hasattr(body, 'pump'):
+        # 异步数据源(如SSE推送): 由数据源决定何时写出, 每次写出一块
+        async def write(data):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            await _emit(writer, data, chunked)
+        sent = await body.pump(write)
+    elif hasattr(body, 'readinto'):
+        # 文件: 逐块读入固定缓冲区后写出
+        try:
+            while True:
+                n = body.readinto(_buf)
+                if not n:
+                    break
+                await _emit(writer, _mv[:n], chunked)
+                sent += n
+        finally:
+            body.close()
+    else:
+        # 生成器/可迭代对象: 小块先攒进缓冲区, 大块直接写出
+        used = 0
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            n = len(chunk)
+            if used + n > BUF_SIZE and used:
+                await _emit(writer, _mv[:used], chunked)
+                sent += used
+                used = 0
+            if n >= BUF_SIZE:
+                await _emit(writer, chunk, chunked)
+                sent += n
+            else:
+                _buf[used:used + n] = chunk
+                used += n
+        if used:
+            await _emit(writer, _mv[:used], chunked)
+            sent += used
+    if chunked:
+        writer.write(b'0\r\n\r\n')
+    await writer.drain()
+    return sent
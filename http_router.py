@@ -0,0 +1,415 @@
+# http_router.py - 预编译路由表
+# 启动时构建一次: 精确路径走字典查找, 带参数的路径走前缀树, 每条路由限定请求方法
+# 请求行和请求头读进预分配的缓冲池, 按行边界扫描, 只解码处理函数用得到的请求头
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+MAX_HEADER_LINES = 32
+MAX_BODY = 8192
+
+class Request:
+    """一次HTTP请求, 查询参数只解析一次"""
+    def __init__(self, method, path, query, params=None, headers=None, version='HTTP/1.1', body=b''):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.params = params or {}
+        self.headers = headers or {}
+        self.version = version
+        self.body = body
+
+    def keep_alive(self):
+        """HTTP/1.1 默认保持连接, HTTP/1.0 需要显式 keep-alive"""
+        conn = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in conn
+        return 'keep-alive' in conn
+
+def url_decode(s):
+    """解码URL编码 (+ 和 %XX)"""
+    if '+' in s:
+        s = s.replace('+', ' ')
+    if '%' not in s:
+        return s
+    parts = s.split('%')
+    out = bytearray(parts[0].encode())
+    for part in parts[1:]:
+        try:
+            out.append(int(part[:2], 16))
+            out.extend(part[2:].encode())
+        except ValueError:
+            out.extend(b'%')
+            out.extend(part.encode())
+    try:
+        return bytes(out).decode('utf-8')
+    except:
+        return s
+
+def parse_query(qs):
+    """把 a=1&b=2 解析成字典"""
+    query = {}
+    if not qs:
+        return query
+    for part in qs.split('&'):
+        if not part:
+            continue
+        if '=' in part:
+            k, v = part.split('=', 1)
+            query[url_decode(k)] = url_decode(v)
+        else:
+            query[url_decode(part)] = ''
+    return query
+
+def split_target(target):
+    """把请求目标拆成 (路径, 查询字典)"""
+    i = target.find('?')
+    if i < 0:
+        return target, {}
+    return target[:i], parse_query(target[i + 1:])
+
+def parse_headers(lines):
+    """解析请求头, 键统一为小写"""
+    headers = {}
+    for line in lines:
+        if not line:
+            break
+        i = line.find(':')
+        if i > 0:
+            headers[line[:i].strip().lower()] = line[i + 1:].strip()
+    return headers
+
+class BadRequest(Exception):
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+
+REQ_BUF = 1024           # 池里缓冲区的大小, 绝大多数请求的请求行+请求头都放得下
+MAX_HEAD = 8192          # 请求行+请求头的上限; 超出 REQ_BUF 时(长 Cookie、长查询串)临时换成更大的缓冲区
+POOL_SIZE = 4            # 预分配的缓冲区个数, 同时解析的请求更多时临时分配
+HEADERS = ('connection', 'content-length', 'accept-encoding', 'if-none-match', 'content-type')   # 只解码这些请求头
+
+class BufferPool:
+    def __init__(self, count, size):
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+        self.misses = 0
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.misses += 1
+        return bytearray(self.size)
+
+    def release(self, buf):
+        if len(self.free) < POOL_SIZE:
+            self.free.append(buf)
+
+pool = BufferPool(POOL_SIZE, REQ_BUF)
+
+if hasattr(bytearray, 'find'):
+    def _find(buf, ch, start, end):
+        return buf.find(ch, start, end)
+else:
+    import micropython
+
+    @micropython.viper
+    def _find(buf: ptr8, ch: int, start: int, end: int) -> int:
+        i = start
+        while i < end:
+            if buf[i] == ch:
+                return i
+            i += 1
+        return -1
+
+_WANTED = {}     # 长度 -> 名称; 长度对不上的请求头不用解码就能跳过
+for _h in HEADERS:
+    _WANTED.setdefault(len(_h), []).append(_h)
+
+class Connection:
+    """一条连接的读取端: 流水线请求读多了的部分留到下一次"""
+    def __init__(self, reader):
+        self.reader = reader
+        self.pending = b''
+
+    async def readinto(self, mv, timeout):
+        if hasattr(self.reader, 'readinto'):
+            return await asyncio.wait_for(self.reader.readinto(mv), timeout)
+        data = await asyncio.wait_for(self.reader.read(len(mv)), timeout)     # CPython 的 StreamReader
+        mv[:len(data)] = data
+        return len(data)
+
+def _grow(buf, n, size):
+    """换成 size 字节的新缓冲区, 保留前 n 字节"""
+    out = bytearray(size)
+    out[:n] = memoryview(buf)[:n]
+    return out
+
+def _strip_cr(buf, start, end):
+    if end > start and buf[end - 1] == 13:
+        end -= 1
+    return end
+
+async def read_request(conn, timeout):
+    """读取一个完整请求(请求行+请求头+正文); 请求行和请求头读进池里的缓冲区, 按行边界扫描,
+    只解码需要的请求头; 连接关闭返回None"""
+    pooled = buf = pool.acquire()
+    try:
+        n = len(conn.pending)
+        if n > len(buf):
+            buf = bytearray(n)
+        mv = memoryview(buf)
+        buf[:n] = conn.pending
+        conn.pending = b''
+        # 逐行扫描, 直到空行; scan 之前的内容已经确认不含请求头结束
+        lines = []           # 每行 (起点, 终点), 不含换行
+        pos = 0
+        end = -1
+        while end < 0:
+            nl = _find(buf, 10, pos, n)      # '\n'
+            if nl < 0:
+                if n == len(buf):
+                    if n >= MAX_HEAD:
+                        raise BadRequest(431, "请求头过大")
+                    buf = _grow(buf, n, min(MAX_HEAD, 2 * n))
+                    mv = memoryview(buf)
+                k = await conn.readinto(mv[n:], timeout)
+                if not k:
+                    return None
+                n += k
+                continue
+            stop = _strip_cr(buf, pos, nl)
+            if stop == pos and lines:
+                end = nl + 1
+            elif stop > pos:
+                if len(lines) > MAX_HEADER_LINES:
+                    raise BadRequest(431, "请求头过多")
+                lines.append((pos, stop))
+            pos = nl + 1
+        a, b = lines[0]
+        parts = bytes(mv[a:b]).decode('utf-8', 'ignore').split()
+        if len(parts) < 2:
+            raise BadRequest(400, "请求行无效")
+        headers = {}
+        for i in range(1, len(lines)):
+            a, b = lines[i]
+            c = _find(buf, 58, a, b)         # ':'
+            names = _WANTED.get(c - a)
+            if c < 0 or names is None:
+                continue
+            name = bytes(mv[a:c]).decode().lower()
+            if name in names:
+                c += 1
+                while c < b and buf[c] == 32:
+                    c += 1
+                headers[name] = bytes(mv[c:b]).decode('utf-8', 'ignore').strip()
+        body = b''
+        length = headers.get('content-length')
+        if length:
+            try:
+                length = int(length)
+            except ValueError:
+                raise BadRequest(400, "Content-Length无效")
+            if length > MAX_BODY:
+                raise BadRequest(413, "请求正文过大")
+        else:
+            length = 0
+        have = n - end
+        if length and have >= length:
+            body = bytes(mv[end:end + length])
+        elif length:
+            # 正文超出缓冲区: 已读到的部分先拷过去, 其余直接读进正文
+            body = bytearray(length)
+            k = min(have, length)
+            body[:k] = mv[end:end + k]
+            bmv = memoryview(body)
+            while k < length:
+                got = await conn.readinto(bmv[k:], timeout)
+                if not got:
+                    return None
+                k += got
+        if have > length:
+            conn.pending = bytes(mv[end + length:n])    # 流水线里的下一个请求
+        path, query = split_target(parts[1])
+        version = parts[2] if len(parts) > 2 else 'HTTP/1.0'
+        return Request(parts[0], path, query, None, headers, version, body)
+    finally:
+        pool.release(pooled)
+
+class Router:
+    def __init__(self, fallback=None, not_allowed=None):
+        self.exact = {}      # path -> {method: handler}
+        self.trie = {}       # 段 -> 子节点; ':' -> (参数名, 子节点); None -> {method: handler}
+        self.fallback = fallback
+        self.not_allowed = not_allowed
+
+    def add(self, path, handler, methods=('GET',)):
+        """注册路由, 路径段写成 <name> 表示参数"""
+        if '<' in path:
+            node = self.trie
+            for seg in path.strip('/').split('/'):
+                if seg.startswith('<') and seg.endswith('>'):
+                    if ':' not in node:
+                        node[':'] = (seg[1:-1], {})
+                    node = node[':'][1]
+                else:
+                    node = node.setdefault(seg, {})
+            table = node.setdefault(None, {})
+        else:
+            table = self.exact.setdefault(path, {})
+        for m in methods:
+            table[m] = handler
+
+    def _walk(self, path):
+        node = self.trie
+        params = {}
+        for seg in path.strip('/').split('/'):
+            child = node.get(seg)
+            if child is None:
+                if ':' not in node:
+                    return None, None
+                name, child = node[':']
+                params[name] = url_decode(seg)
+            node = child
+        return node.get(None), params
+
+    def match(self, method, path):
+        """返回 (处理函数, 路径参数); 方法不匹配时返回 not_allowed 并在参数里带上 allow"""
+        table = self.exact.get(path)
+        params = {}
+        if table is None:
+            table, params = self._walk(path)
+            if table is None:
+                return self.fallback, {}
+        handler = table.get(method)
+        if handler is None:
+            return self.not_allowed, {'allow': ', '.join(table)}
+        return handler, params
+
+# 测试代码: 比较路由查找与原来 if/elif 子串匹配链的开销
+if __name__ == "__main__":
+    import time
+
+    def _now_us():
+        if hasattr(time, 'ticks_us'):
+            return time.ticks_us()
+        return int(time.perf_counter() * 1000000)
+
+    def _chain(path):
+        if path == '/' or 'index' in path: return 1
+        elif path.startswith('/status'): return 2
+        elif 'wifi/connect' in path: return 3
+        elif path.startswith('/wifi/disconnect'): return 4
+        elif path.startswith('/wifi/scan'): return 5
+        elif 'cpu_freq' in path: return 6
+        elif path.startswith('/restart'): return 7
+        elif '/gpio/set' in path or '/gpio/read' in path: return 8
+        elif path.startswith('/factory_reset'): return 9
+        elif '/gpio/wave' in path: return 10
+        elif path.startswith('/frp/start'): return 11
+        elif path.startswith('/frp/stop'): return 12
+        elif path.startswith('/frp/config'): return 13
+        return 0
+
+    router = Router(fallback=0)
+    for i, p in enumerate(['/', '/status', '/wifi/connect', '/wifi/disconnect', '/wifi/scan',
+                           '/system/cpu_freq', '/restart', '/gpio/set', '/factory_reset',
+                           '/gpio/wave', '/frp/start', '/frp/stop', '/frp/config']):
+        router.add(p, i + 1)
+    router.add('/gpio/<pin>/level', 14)
+    paths = ['/status', '/gpio/set', '/frp/config', '/gpio/2/level', '/favicon.ico']
+    n = 2000
+    t0 = _now_us()
+    for _ in range(n):
+        for p in paths:
+            _chain(p)
+    t1 = _now_us()
+    for _ in range(n):
+        for p in paths:
+            router.match('GET', p)
+    t2 = _now_us()
+    print("if/elif 链: %.2f us/次" % ((t1 - t0) / (n * len(paths))))
+    print("路由表:     %.2f us/次" % ((t2 - t1) / (n * len(paths))))
+    print(parse_query('ssid=My+Wifi&password=a%26b%E4%B8%AD'))
+
+    # 请求解析: 原来逐行 readline 的做法 vs 缓冲池+按行边界扫描, 比较吞吐和每个请求分配的字节数
+    import gc
+
+    class _Stream:
+        def __init__(self, data):
+            self.data = data
+            self.pos = 0
+
+        async def readline(self):
+            i = self.data.find(b'\n', self.pos)
+            i = len(self.data) if i < 0 else i + 1
+            line = self.data[self.pos:i]
+            self.pos = i
+            return line
+
+        async def readexactly(self, n):
+            out = self.data[self.pos:self.pos + n]
+            self.pos += n
+            return out
+
+        async def readinto(self, buf):
+            k = min(len(buf), len(self.data) - self.pos)
+            buf[:k] = self.data[self.pos:self.pos + k]
+            self.pos += k
+            return k
+
+    async def _read_lines(reader, timeout):
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        parts = line.decode('utf-8', 'ignore').split()
+        lines = []
+        while True:
+            h = await asyncio.wait_for(reader.readline(), timeout)
+            if h == b'\r\n' or h == b'\n':
+                break
+            lines.append(h.decode('utf-8', 'ignore'))
+        headers = parse_headers(lines)
+        length = int(headers.get('content-length', 0))
+        body = await asyncio.wait_for(reader.readexactly(length), timeout) if length else b''
+        path, query = split_target(parts[1])
+        return Request(parts[0], path, query, None, headers, parts[2], body)
+
+    sample = (b'POST /term/exec?session=ab12 HTTP/1.1\r\nHost: 192.168.4.1\r\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n'
+              b'Accept: */*\r\nAccept-Language: zh-CN,zh;q=0.9\r\nAccept-Encoding: gzip, deflate\r\n'
+              b'Content-Type: text/plain\r\nContent-Length: 24\r\nConnection: keep-alive\r\n\r\nfor i in range(3): print(i)'[:-3])
+
+    async def _bench(name, fn, wrap):
+        n = 300
+        if hasattr(gc, 'mem_alloc'):
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            req = await fn(wrap(_Stream(sample)), 1)
+            per = gc.mem_alloc() - before
+            gc.enable()
+        else:
+            req = await fn(wrap(_Stream(sample)), 1)
+            per = -1
+        assert req.path == '/term/exec' and req.headers['content-length'] == '24' and len(req.body) == 24
+        t = _now_us()
+        for _ in range(n):
+            await fn(wrap(_Stream(sample)), 1)
+        print("%s: %.1f us/次, 分配 %d 字节/次" % (name, (_now_us() - t) / n, per))
+
+    async def _main():
+        await _bench("逐行读取    ", _read_lines, lambda s: s)
+        await _bench("缓冲池+扫描 ", read_request, Connection)
+        # 超出池缓冲区的请求头换大缓冲区继续读, 超过 MAX_HEAD 才返回 431
+        big = b'GET /term/exec?code=' + b'x' * 1500 + b' HTTP/1.1\r\nCookie: ' + b'c' * 1500 + b'\r\nConnection: close\r\n\r\n'
+        conn = Connection(_Stream(big + big))
+        for i in range(2):      # 第二个是流水线里读多了的部分, 也超过池缓冲区
+            req = await read_request(conn, 1)
+            assert len(req.query['code']) == 1500 and req.headers['connection'] == 'close'
+        try:
+            await read_request(Connection(_Stream(b'GET / HTTP/1.1\r\nCookie: ' + b'c' * MAX_HEAD + b'\r\n\r\n')), 1)
+            assert False
+        except BadRequest as e:
+            assert e.status == 431
+        print("长请求头: %d 字节通过, 超过 %d 字节返回 431" % (len(big), MAX_HEAD))
+
+    asyncio.run(_main())
@@ -1,4 +1,6 @@
 # boot.py - 启动配置
+import boot_timeline
+boot_timeline.mark('firmware')
 import gc
 import machine
 import time
@@ -14,9 +16,7 @@ print(f"初始内存: {gc.mem_free()} bytes")
 # 设置CPU频率
 machine.freq(240000000)  # 240 MHz
 print(f"CPU频率: {machine.freq() // 1000000} MHz")
-
-# 等待系统稳定
-time.sleep(1)
+boot_timeline.mark('boot')
 
 # 导入主程序
 try:
@@ -0,0 +1,166 @@
+# mem_manager.py - 自适应垃圾回收
+# 不再每个连接结束都 gc.collect(): gc.threshold() 让分配累计到一定量时由运行时自动回收,
+# 请求结束时只在空闲堆低于水位时回收, 没有连接在处理时再顺便回收一次; 主动回收的耗时都记下来
+# 仪表盘的事件推送一直开着, 长时间推送的连接不算"在处理", 否则空闲回收永远等不到
+import gc
+import time
+from array import array
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+THRESHOLD_DIV = 8        # 分配累计到堆总量的 1/8 时自动回收
+LOW_WATER_PCT = 25       # 空闲堆低于总量的这个比例时, 请求结束后立即回收
+IDLE_COLLECT = True      # 空闲时回收
+IDLE_MS = 500            # 没有连接超过这么久才算空闲
+IDLE_MIN_BYTES = 8192    # 上次回收后分配不到这么多就不必在空闲时回收
+HISTORY = 16             # 保留最近几次回收的耗时
+
+ADAPTIVE, ALWAYS = 'adaptive', 'always'
+policy = ADAPTIVE        # ALWAYS: 每个请求结束都回收(原来的做法, 用于对比)
+
+active = 0               # 正在处理的连接数, 不含长时间推送的连接
+_idle_since = time.ticks_ms()
+_last_alloc = 0          # 上次回收后的已用堆
+counts = {}              # 回收原因 -> 次数
+total_us = 0
+max_us = 0
+history = array('I', [0] * HISTORY)
+_hpos = 0
+
+def heap_total():
+    return gc.mem_free() + gc.mem_alloc()
+
+def setup():
+    """设置自动回收阈值, 启动时调用一次"""
+    if hasattr(gc, 'threshold'):
+        gc.threshold(heap_total() // THRESHOLD_DIV)
+    collect('boot')
+
+def collect(reason):
+    """计时回收一次, 返回耗时(微秒)"""
+    global total_us, max_us, _hpos, _last_alloc
+    t = time.ticks_us()
+    gc.collect()
+    us = time.ticks_diff(time.ticks_us(), t)
+    _last_alloc = gc.mem_alloc()
+    counts[reason] = counts.get(reason, 0) + 1
+    total_us += us
+    if us > max_us:
+        max_us = us
+    history[_hpos] = us
+    _hpos = (_hpos + 1) % HISTORY
+    return us
+
+def begin():
+    """连接开始"""
+    global active
+    active += 1
+
+def _leave():
+    global active, _idle_since
+    active -= 1
+    if active <= 0:
+        active = 0
+        _idle_since = time.ticks_ms()
+
+def stream():
+    """连接开始长时间推送(事件流、采样推送), 不再算作正在处理"""
+    _leave()
+
+def end(streamed=False):
+    """连接结束, 需要时回收; streamed: 已经调用过 stream(). 返回回收耗时(微秒), 没有回收返回 0"""
+    if not streamed:
+        _leave()
+    if policy == ALWAYS:
+        return collect('always')
+    return maybe_collect()
+
+def maybe_collect():
+    """空闲堆低于水位时回收"""
+    if gc.mem_free() * 100 < heap_total() * LOW_WATER_PCT:
+        return collect('low_water')
+    return 0
+
+async def idle_collector():
+    """没有连接在处理、且上次回收后又分配了不少内存时回收一次"""
+    while True:
+        await asyncio.sleep(IDLE_MS / 1000)
+        if IDLE_COLLECT and policy == ADAPTIVE and active == 0 \
+                and time.ticks_diff(time.ticks_ms(), _idle_since) >= IDLE_MS \
+                and gc.mem_alloc() - _last_alloc >= IDLE_MIN_BYTES:
+            collect('idle')
+
+def stats():
+    n = sum(counts.values())
+    recent = [history[(_hpos + i) % HISTORY] for i in range(HISTORY)]
+    return {'policy': policy, 'collections': counts, 'total_us': total_us, 'max_us': max_us,
+            'avg_us': total_us // n if n else 0, 'recent_us': [us for us in recent if us],
+            'threshold': gc.threshold() if hasattr(gc, 'threshold') else -1,
+            'free': gc.mem_free(), 'total': heap_total(), 'active': active}
+
+# 测试代码: 比较每次回收与自适应回收下的请求吞吐和 p99 延迟
+#   设备上: 模拟请求的分配模式; 电脑上: python mem_manager.py 192.168.4.1 通过 /debug/gc 切换策略后压测 /status
+if __name__ == "__main__":
+    import sys
+
+    def report(name, lat_us, elapsed_us):
+        lat_us.sort()
+        p99 = lat_us[len(lat_us) * 99 // 100 - 1]
+        print("%-8s %6d 次/秒  p50 %6d us  p99 %6d us" % (
+            name, len(lat_us) * 1000000 // max(1, elapsed_us), lat_us[len(lat_us) // 2], p99))
+
+    if len(sys.argv) > 1 and sys.implementation.name != 'micropython':
+        import socket
+        host = sys.argv[1]
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+        def get(path):
+            s = socket.create_connection((host, 80))
+            s.sendall(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (path, host)).encode())
+            while s.recv(4096):
+                pass
+            s.close()
+
+        for name in (ALWAYS, ADAPTIVE):
+            get('/debug/gc?policy=' + name)
+            lat = []
+            t0 = time.perf_counter()
+            for i in range(n):
+                t = time.perf_counter()
+                get('/status')
+                lat.append(int((time.perf_counter() - t) * 1000000))
+            report(name, lat, int((time.perf_counter() - t0) * 1000000))
+    else:
+        def fake_request():
+            # 大致相当于一次请求: 解析请求行和请求头, 拼一个小响应
+            headers = {}
+            for i in range(8):
+                headers['x-header-%d' % i] = 'value %d' % i
+            body = ('{"ok": %d}' % len(headers)).encode()
+            return [body, 'HTTP/1.1 200 OK\r\n'.encode()]
+
+        setup()
+        begin()
+        begin()
+        stream()
+        assert active == 1, "推送中的连接不算在处理"
+        end()
+        assert active == 0
+        end(True)
+        assert active == 0
+        n = 500
+        for name in (ALWAYS, ADAPTIVE):
+            policy = name
+            gc.collect()
+            lat = []
+            t0 = time.ticks_us()
+            for i in range(n):
+                t = time.ticks_us()
+                begin()
+                fake_request()
+                end()
+                lat.append(time.ticks_diff(time.ticks_us(), t))
+            report(name, lat, time.ticks_diff(time.ticks_us(), t0))
+        print(stats())
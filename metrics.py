@@ -0,0 +1,121 @@
+# metrics.py - 请求指标
+# 每个路由(按处理函数区分, 标签数量固定)记录请求数、状态码、延迟直方图、发送字节数、GC耗时和请求期间的堆增长
+# /metrics 以 Prometheus 文本格式输出; 每个请求只多两次 ticks_us/mem_alloc 和几次整数加法, 可以一直开着
+import gc
+import time
+from array import array
+try:
+    import esp32
+except ImportError:
+    esp32 = None
+
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)    # 延迟直方图上界, 另有 +Inf
+_BUCKETS_US = tuple(b * 1000 for b in BUCKETS_MS)
+_LE = tuple('%d.%03d' % (b // 1000, b % 1000) for b in BUCKETS_MS) + ('+Inf',)
+
+class RouteStats:
+    def __init__(self):
+        self.hist = array('I', [0] * (len(BUCKETS_MS) + 1))
+        self.codes = {}      # 状态码 -> 次数
+        self.us = 0          # 延迟总和(微秒)
+        self.bytes = 0       # 发送的正文字节数
+        self.heap = 0        # 请求期间的堆增长(字节, 只计增长)
+        self.gc_us = 0       # 连接结束时 gc.collect 的耗时
+
+routes = {}
+
+def _stats(route):
+    st = routes.get(route)
+    if st is None:
+        st = routes[route] = RouteStats()
+    return st
+
+def begin():
+    """请求开始时调用, 返回交给 observe 的起点"""
+    return time.ticks_us(), gc.mem_alloc()
+
+def observe(route, code, start, sent):
+    us = time.ticks_diff(time.ticks_us(), start[0])
+    heap = gc.mem_alloc() - start[1]
+    st = _stats(route)
+    i = 0
+    n = len(_BUCKETS_US)
+    while i < n and us > _BUCKETS_US[i]:
+        i += 1
+    st.hist[i] += 1
+    st.us += us
+    st.bytes += sent
+    if heap > 0:
+        st.heap += heap
+    st.codes[code] = st.codes.get(code, 0) + 1
+
+def gc_time(route, us):
+    """把连接结束时回收的耗时记到 route 上"""
+    if route is not None and us:
+        _stats(route).gc_us += us
+
+def _seconds(us):
+    return '%d.%06d' % (us // 1000000, us % 1000000)
+
+def largest_free_block():
+    """IDF堆里最大的空闲块; MicroPython 的 GC 堆没有对应接口"""
+    if esp32 is None:
+        return -1
+    try:
+        return max(h[2] for h in esp32.idf_heap_info(esp32.HEAP_DATA))
+    except:
+        return -1
+
+def render(gauges=()):
+    """逐行生成 Prometheus 文本; gauges: ((名称, 类型, 说明, 值或 ((标签, 值), ...)), ...)"""
+    names = sorted(routes)
+    yield '# HELP esp_http_requests_total HTTP请求数\n# TYPE esp_http_requests_total counter\n'
+    for r in names:
+        codes = routes[r].codes
+        for code in codes:
+            yield 'esp_http_requests_total{route="%s",code="%s"} %d\n' % (r, code, codes[code])
+    yield '# HELP esp_http_request_duration_seconds 从读完请求到发完响应的时间\n# TYPE esp_http_request_duration_seconds histogram\n'
+    for r in names:
+        st = routes[r]
+        acc = 0
+        for i in range(len(_LE)):
+            acc += st.hist[i]
+            yield 'esp_http_request_duration_seconds_bucket{route="%s",le="%s"} %d\n' % (r, _LE[i], acc)
+        yield 'esp_http_request_duration_seconds_sum{route="%s"} %s\n' % (r, _seconds(st.us))
+        yield 'esp_http_request_duration_seconds_count{route="%s"} %d\n' % (r, acc)
+    for name, kind, text, attr in (('esp_http_response_bytes_total', 'counter', '发送的正文字节数', 'bytes'),
+                                   ('esp_http_heap_alloc_bytes_total', 'counter', '请求期间的堆增长', 'heap'),
+                                   ('esp_http_gc_seconds_total', 'counter', '连接结束时主动GC的耗时', 'gc_us')):
+        yield '# HELP %s %s\n# TYPE %s %s\n' % (name, text, name, kind)
+        for r in names:
+            v = getattr(routes[r], attr)
+            yield '%s{route="%s"} %s\n' % (name, r, _seconds(v) if attr == 'gc_us' else str(v))
+    base = (('esp_heap_free_bytes', 'gauge', 'GC堆空闲字节', gc.mem_free()),
+            ('esp_heap_alloc_bytes', 'gauge', 'GC堆已用字节', gc.mem_alloc()),
+            ('esp_idf_heap_largest_free_bytes', 'gauge', 'IDF堆最大空闲块', largest_free_block()))
+    for name, kind, text, value in base + tuple(gauges):
+        yield '# HELP %s %s\n# TYPE %s %s\n' % (name, text, name, kind)
+        if isinstance(value, tuple):
+            for labels, v in value:
+                yield '%s{%s} %d\n' % (name, labels, v)
+        else:
+            yield '%s %d\n' % (name, value)
+
+# 测试代码: 输出示例并测量每个请求的记录开销
+if __name__ == "__main__":
+    for i in range(20):
+        s = begin()
+        observe('handle_status', 200 if i % 5 else 404, s, 100)
+    gc_time('handle_status', 1500)
+    text = ''.join(render((('esp_threads', 'gauge', '线程数', 3),
+                           ('esp_frp_bytes_total', 'counter', '隧道字节数', (('direction="in"', 10), ('direction="out"', 20))))))
+    print(text)
+    assert 'esp_http_requests_total{route="handle_status",code="404"} 4' in text
+    assert 'esp_http_request_duration_seconds_bucket{route="handle_status",le="+Inf"} 20' in text
+    assert 'esp_frp_bytes_total{direction="out"} 20' in text
+    n = 1000
+    t = time.ticks_us()
+    for i in range(n):
+        s = begin()
+        observe('bench', 200, s, 0)
+    print("每个请求的记录开销: %d us" % (time.ticks_diff(time.ticks_us(), t) // n))
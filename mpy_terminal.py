@@ -6,52 +6,173 @@ import sys
 import micropython
 import machine
 import time
+import _thread
+import random
+import code_sandbox
+import mem_manager
+from code_sandbox import SandboxStop
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    import marshal
+except ImportError:
+    marshal = None      # 固件没有 marshal 时不做预编译, 只用内存缓存
+
+CACHE_ENTRIES = 16          # 编译缓存最多条目数
+CACHE_BYTES = 32 * 1024     # 编译缓存估算占用上限
+SAVED_SOURCE = "UserCode.py"
+SAVED_COMPILED = "UserCode.mpc"   # save_code 时预编译: 源码sha256(32字节) + marshal后的代码对象
+
+def _digest(code):
+    # 缓存的是改写过的代码, 改写规则版本也算进键里
+    h = hashlib.sha256(code_sandbox.VERSION)
+    h.update(code.encode())
+    return h.digest()
+
+class CodeCache:
+    """按源码sha256缓存编译好的代码对象, 条目数和内存都有上限, 超出时淘汰最久未用的; 两个工作线程共用, 读写都加锁"""
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = {}    # key -> (代码对象, 估算字节数)
+        self.order = []      # 最近使用的在末尾
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = _thread.allocate_lock()
+
+    def get(self, key):
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.order[-1] != key:
+                self.order.remove(key)
+                self.order.append(key)
+            return e[0]
+
+    def put(self, key, compiled, size):
+        with self.lock:
+            if key in self.entries or size > self.max_bytes:
+                return
+            while self.order and (len(self.order) >= self.max_entries or self.bytes + size > self.max_bytes):
+                old = self.order.pop(0)
+                self.bytes -= self.entries.pop(old)[1]
+            self.entries[key] = (compiled, size)
+            self.order.append(key)
+            self.bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.order = []
+            self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.order), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+code_cache = CodeCache()
+
+def _compile(code, key, mode='exec'):
+    """编译并放入缓存; 占用按编译前后的堆变化估算, 取不到时按源码长度估算"""
+    before = gc.mem_alloc() if hasattr(gc, 'mem_alloc') else 0
+    compiled = compile(code_sandbox.instrument(code), '<user_code>', mode)
+    size = gc.mem_alloc() - before if before else 0
+    if size <= 0:
+        size = len(code) * 4
+    code_cache.put(key, compiled, size)
+    return compiled
+
+def _load_saved(key):
+    """源码与已保存代码相同时直接读取预编译结果, 不经过编译器"""
+    if marshal is None:
+        return None
+    try:
+        with open(SAVED_COMPILED, "rb") as f:
+            if f.read(32) != key:
+                return None
+            data = f.read()
+        compiled = marshal.loads(data)
+    except Exception:
+        return None
+    code_cache.put(key, compiled, len(data) * 2)
+    return compiled
+
+def get_compiled(code, key=None, mode='exec'):
+    """取得改写过(带执行预算检查)的代码对象: 内存缓存 -> 预编译文件 -> 编译, 语法错误照常抛出"""
+    if key is None:
+        key = _digest(code)
+    if mode != 'exec':
+        key += b'e'
+    compiled = code_cache.get(key)
+    if compiled is None:
+        compiled = (mode == 'exec' and _load_saved(key)) or _compile(code, key, mode)
+    return compiled
+
+VERDICT_ENTRIES = 32    # 校验结果缓存条目数, 满了整体清空
+
+_verdicts = {}
+
+def check_code(code, key=None):
+    """安全检查, 通过返回 None, 否则返回带行列位置的错误信息; 结果按源码哈希缓存"""
+    if len(code) > 4096:  # 限制代码大小
+        return "错误: 代码过长（最大4096字符）"
+    if key is None:
+        key = _digest(code)
+    # 两个工作线程共用; 只查一次, 另一个线程在中间 clear() 也不会出 KeyError. 缓存的值是 None 或错误信息, 0 表示没缓存
+    err = _verdicts.get(key, 0)
+    if err != 0:
+        return err
+    err = code_sandbox.validate(code)
+    if err:
+        err = "错误: 第%d行第%d列: %s" % err
+    if len(_verdicts) >= VERDICT_ENTRIES:
+        _verdicts.clear()
+    _verdicts[key] = err
+    return err
+
+def _builtins(printer):
+    return {
+        'print': printer,
+        'len': len,
+        'str': str,
+        'int': int,
+        'float': float,
+        'list': list,
+        'dict': dict,
+        'tuple': tuple,
+        'range': range
+    }
+
+def _safe_globals(printer, builtins=None):
+    """创建安全执行环境, printer 为用户代码里的 print; 内置函数表可以复用"""
+    return {
+        'print': printer,
+        'gc': gc,
+        'uos': uos,
+        'time': time,
+        'machine': machine,
+        '__name__': '__main__',
+        '__builtins__': builtins or _builtins(printer)
+    }
+
+last_run = {}    # 最近一次执行的耗时、峰值内存和终止原因
 
 def execute_code(code, timeout=10):
-    """执行MicroPython代码"""
+    """执行MicroPython代码, 超过 timeout 秒或在检查点上超出内存配额时终止"""
+    global last_run
     try:
         # 安全检查
-        if len(code) > 4096:  # 限制代码大小
-            return "错误: 代码过长（最大4096字符）"
+        key = _digest(code)
+        err = check_code(code, key)
+        if err:
+            return err
         
-        # 禁止的危险操作
-        dangerous_keywords = [
-            "import os",
-            "import sys",
-            "__import__",
-            "eval(",
-            "exec(",
-            "compile(",
-            "open(",
-            "rm ",
-            "del ",
-            "format("
-        ]
-        
-        for keyword in dangerous_keywords:
-            if keyword in code:
-                return f"错误: 禁止的操作 '{keyword}'"
-        
-        # 创建安全执行环境
-        safe_globals = {
-            'print': safe_print,
-            'gc': gc,
-            'uos': uos,
-            'time': time,
-            'machine': machine,
-            '__name__': '__main__',
-            '__builtins__': {
-                'print': safe_print,
-                'len': len,
-                'str': str,
-                'int': int,
-                'float': float,
-                'list': list,
-                'dict': dict,
-                'tuple': tuple,
-                'range': range
-            }
-        }
+        safe_globals = _safe_globals(safe_print, _SAFE_BUILTINS)
         
         # 捕获输出
         old_stdout = sys.stdout
@@ -60,13 +181,16 @@ def execute_code(code, timeout=10):
         
         # 允许中断
         micropython.kbd_intr(3)
+        budget = code_sandbox.Budget(timeout * 1000)
         
         try:
-            # 编译并执行
-            compiled = compile(code, '<user_code>', 'exec')
-            exec(compiled, safe_globals)
+            # 编译(命中缓存时跳过)并在预算内执行
+            compiled = get_compiled(code, key)
+            code_sandbox.run(compiled, safe_globals, budget)
             result = output_buffer.getvalue()
             
+        except SandboxStop as e:
+            result = output_buffer.getvalue() + f"\n已终止: {e.reason}"
         except SyntaxError as e:
             result = f"语法错误: {e}\n在行: {e.lineno}"
         except Exception as e:
@@ -75,9 +199,10 @@ def execute_code(code, timeout=10):
             # 恢复stdout
             sys.stdout = old_stdout
             micropython.kbd_intr(-1)
+            last_run = budget.report()
         
-        # 垃圾回收
-        gc.collect()
+        # 空闲堆不多时才回收, 平时交给自动回收阈值
+        mem_manager.maybe_collect()
         
         return result.strip() or "执行完成（无输出）"
         
@@ -87,6 +212,222 @@ def execute_code(code, timeout=10):
     except Exception as e:
         return f"执行错误: {e}"
 
+class OutputRing:
+    """流式执行的输出缓冲: 固定大小的环形缓冲区, 写满时按整行丢弃最旧的输出并记下丢了多少"""
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.size = size
+        self.start = 0       # 最旧未读字节的位置
+        self.count = 0       # 未读字节数
+        self.dropped = 0     # 读取前被覆盖的字节数
+        self.lock = _thread.allocate_lock()
+
+    def write(self, s):
+        data = s.encode() if isinstance(s, str) else s
+        n = len(data)
+        with self.lock:
+            dropped = self.dropped
+            if n >= self.size:
+                self.dropped += self.count + n - self.size
+                data = data[n - self.size:]
+                n = self.size
+                self.start = self.count = 0
+            over = self.count + n - self.size
+            if over > 0:
+                self.start = (self.start + over) % self.size
+                self.count -= over
+                self.dropped += over
+            pos = (self.start + self.count) % self.size
+            first = min(n, self.size - pos)
+            self.buf[pos:pos + first] = data[:first]
+            if first < n:
+                self.buf[0:n - first] = data[first:]
+            self.count += n
+            if self.dropped != dropped:
+                self._trim()
+        return n
+
+    def _drop(self, k):
+        self.start = (self.start + k) % self.size
+        self.count -= k
+        self.dropped += k
+
+    def _trim(self):
+        # 丢掉被截断的半行: 跳到下一个换行之后; 剩下的是一整行时只退到UTF-8字符边界, 不切开中文
+        buf = self.buf
+        i = 0
+        while i < self.count and buf[(self.start + i) % self.size] != 10:
+            i += 1
+        if i < self.count - 1:
+            self._drop(i + 1)
+            return
+        while self.count and buf[self.start] & 0xC0 == 0x80:
+            self._drop(1)
+
+    def print(self, *args, **kwargs):
+        try:
+            sep = kwargs.get('sep', ' ')
+            end = kwargs.get('end', '\n')
+            self.write(sep.join(str(arg) for arg in args) + end)
+        except:
+            self.write("[打印错误]\n")
+
+    def read(self):
+        """取出全部未读输出; 有被丢弃的内容时在前面加一行说明"""
+        with self.lock:
+            if not self.count and not self.dropped:
+                return b''
+            end = self.start + self.count
+            if end <= self.size:
+                data = bytes(self.buf[self.start:end])
+            else:
+                data = bytes(self.buf[self.start:]) + bytes(self.buf[:end - self.size])
+            if self.dropped:
+                data = ("[输出过快, 省略 %d 字节]\n" % self.dropped).encode() + data
+            self.start = self.count = self.dropped = 0
+            return data
+
+def execute_stream(code, out, timeout=10):
+    """流式执行: 用户代码的 print 直接写入 out(OutputRing), 返回最后的状态行; 阻塞, 应在工作线程里调用"""
+    global last_run
+    try:
+        key = _digest(code)
+        err = check_code(code, key)
+        if err:
+            return err
+        micropython.kbd_intr(3)
+        budget = code_sandbox.Budget(timeout * 1000)
+        try:
+            code_sandbox.run(get_compiled(code, key), _safe_globals(out.print), budget)
+            return "执行完成 (" + budget.summary() + ")"
+        except SandboxStop as e:
+            return "已终止: " + e.reason + " (" + budget.summary() + ")"
+        except SyntaxError as e:
+            return f"语法错误: {e}\n在行: {e.lineno}"
+        except Exception as e:
+            return f"运行时错误: {e}"
+        finally:
+            micropython.kbd_intr(-1)
+            last_run = budget.report()
+            mem_manager.maybe_collect()
+    except MemoryError:
+        gc.collect()
+        return "错误: 内存不足，请简化代码"
+    except Exception as e:
+        return f"执行错误: {e}"
+
+MAX_SESSIONS = 3                 # 同时保留的会话数
+SESSION_IDLE_MS = 10 * 60 * 1000 # 会话空闲这么久后回收
+SESSION_MEM_CAP = 32 * 1024      # 每个会话命名空间可长期占用的堆(字节), 超出后重置
+SESSION_RING = 2048              # 会话输出缓冲区大小
+
+class Session:
+    """交互式会话: 内置函数表只建一次, 命名空间在多次执行之间保留"""
+    def __init__(self, sid):
+        self.id = sid
+        self.out = OutputRing(SESSION_RING)
+        self.builtins = _builtins(self.out.print)
+        self.reset()
+        self.busy = False
+        self.runs = 0
+        self.last_used = time.ticks_ms()
+
+    def reset(self):
+        self.env = _safe_globals(self.out.print, self.builtins)
+        self.retained = 0        # 命名空间累计占用的堆(估算)
+
+    def idle_ms(self):
+        return time.ticks_diff(time.ticks_ms(), self.last_used)
+
+    def _compiled(self, code, key):
+        # 单行代码先按表达式编译, 像 REPL 一样回显结果
+        if '\n' not in code.strip():
+            try:
+                return get_compiled(code, key, 'eval'), True
+            except SyntaxError:
+                pass
+        return get_compiled(code, key), False
+
+    def claim(self):
+        """在事件循环里提交任务之前占用会话, 已被占用时返回 False; 由 run 结束时释放"""
+        if self.busy:
+            return False
+        self.busy = True
+        return True
+
+    def run(self, code, timeout=10):
+        """在会话命名空间里执行, 输出写入 self.out, 返回状态行; 阻塞, 应在工作线程里调用"""
+        global last_run
+        budget = code_sandbox.Budget(timeout * 1000, max(1024, SESSION_MEM_CAP - self.retained))
+        try:
+            key = _digest(code)
+            err = check_code(code, key)
+            if err:
+                return err
+            compiled, expr = self._compiled(code, key)
+            try:
+                value = code_sandbox.run(compiled, self.env, budget, expr)
+            except SandboxStop as e:
+                return "已终止: " + e.reason + " (" + budget.summary() + ")"
+            if expr and value is not None:
+                self.env['_'] = value
+                self.out.print(repr(value))
+            return "执行完成 (" + budget.summary() + ")"
+        except SyntaxError as e:
+            return f"语法错误: {e}\n在行: {e.lineno}"
+        except MemoryError:
+            return "错误: 内存不足，请简化代码"
+        except Exception as e:
+            return f"运行时错误: {e}"
+        finally:
+            self.runs += 1
+            last_run = budget.report()
+            gc.collect()
+            self.retained = max(0, self.retained + budget.growth())
+            if self.retained > SESSION_MEM_CAP:
+                self.reset()
+                self.out.write("[会话占用内存超过 %d 字节, 变量已清空]\n" % SESSION_MEM_CAP)
+            self.last_used = time.ticks_ms()
+            self.busy = False
+
+    def info(self):
+        return {"session": self.id, "idle_s": self.idle_ms() // 1000, "runs": self.runs,
+                "retained": self.retained, "busy": self.busy}
+
+sessions = {}
+
+def _sweep():
+    for sid in list(sessions):
+        s = sessions[sid]
+        if not s.busy and s.idle_ms() > SESSION_IDLE_MS:
+            del sessions[sid]
+
+def open_session():
+    """新建会话; 已满时回收最久未用的空闲会话, 都在执行中则返回 None"""
+    _sweep()
+    if len(sessions) >= MAX_SESSIONS:
+        idle = [s for s in sessions.values() if not s.busy]
+        if not idle:
+            return None
+        oldest = idle[0]
+        for s in idle:
+            if s.idle_ms() > oldest.idle_ms():
+                oldest = s
+        del sessions[oldest.id]
+    sid = '%08x' % random.getrandbits(32)
+    sessions[sid] = Session(sid)
+    return sessions[sid]
+
+def get_session(sid):
+    _sweep()
+    s = sessions.get(sid)
+    if s is not None:
+        s.last_used = time.ticks_ms()
+    return s
+
+def close_session(sid):
+    return sessions.pop(sid, None) is not None
+
 def safe_print(*args, **kwargs):
     """安全的print函数"""
     try:
@@ -97,6 +438,8 @@ def safe_print(*args, **kwargs):
     except:
         sys.stdout.write("[打印错误]\n")
 
+_SAFE_BUILTINS = _builtins(safe_print)   # execute_code 每次执行都复用这张表
+
 def save_code(code):
     """保存代码到文件"""
     try:
@@ -104,14 +447,29 @@ def save_code(code):
         if len(code) > 8192:
             return False, "代码太大（最大8KB）"
         
-        with open("UserCode.py", "w") as f:
+        with open(SAVED_SOURCE, "w") as f:
             f.write(code)
+        precompiled = _save_compiled(code)
         
         gc.collect()
-        return True, "代码已保存到 UserCode.py"
+        return True, "代码已保存到 UserCode.py" + ("（已预编译）" if precompiled else "")
     except Exception as e:
         return False, f"保存失败: {e}"
 
+def _save_compiled(code):
+    """把保存的代码预编译进 flash; 有语法错误或不支持 marshal 时删掉旧的预编译文件"""
+    try:
+        key = _digest(code)
+        data = marshal.dumps(get_compiled(code))
+        with open(SAVED_COMPILED, "wb") as f:
+            f.write(key)
+            f.write(data)
+        return True
+    except Exception:
+        try: uos.remove(SAVED_COMPILED)
+        except: pass
+        return False
+
 def load_code():
     """从文件加载代码"""
     try:
@@ -194,4 +552,85 @@ print("CPU频率:", machine.freq())
     
     success, code = load_code()
     print(f"加载: {'成功' if success else '失败'}")
-    print(f"代码长度: {len(code)}")
\ No newline at end of file
+    print(f"代码长度: {len(code)}")
+    
+    # 编译缓存: 比较冷启动(每次都编译)与命中缓存的执行耗时
+    bench_code = "total = 0\n" + "".join("total += %d * %d\n" % (i, i) for i in range(60)) + "print(total)\n"
+    n = 20
+    t = time.ticks_us()
+    for i in range(n):
+        code_cache.clear()
+        execute_code(bench_code)
+    cold = time.ticks_diff(time.ticks_us(), t) // n
+    t = time.ticks_us()
+    for i in range(n):
+        execute_code(bench_code)
+    warm = time.ticks_diff(time.ticks_us(), t) // n
+    print(f"冷执行: {cold} us, 缓存命中: {warm} us")
+    code_cache.clear()
+    save_code(bench_code)
+    t = time.ticks_us()
+    execute_code(bench_code)
+    print(f"预编译文件: {time.ticks_diff(time.ticks_us(), t)} us")
+    print("缓存统计:", code_cache.stats())
+    # 两个线程同时读写一个很小的缓存, 淘汰与命中交错时不应出错
+    small = CodeCache(max_entries=3)
+    errors = []
+    finished = []
+    def hammer(base):
+        try:
+            for i in range(3000):
+                small.put(base + i % 5, None, 1)
+                small.get(i % 5)
+                small.get(base + (i + 1) % 5)
+        except Exception as e:
+            errors.append(e)
+        finished.append(base)
+    _thread.start_new_thread(hammer, (0,))
+    hammer(2)
+    while len(finished) < 2:
+        time.sleep_ms(10)
+    assert not errors, errors
+    
+    # 流式执行: 输出超过环形缓冲区时只保留最新的部分
+    ring = OutputRing(64)
+    print(execute_stream("for i in range(100):\n    print('行', i)\n", ring))
+    tail = ring.read().decode()
+    print(tail)
+    assert tail.startswith("[输出过快") and tail.endswith("行 99\n") and ring.read() == b''
+    assert all(line.startswith("行 ") for line in tail.split("\n")[1:-1]), "只丢整行"
+    ring.write("错误" * 20)           # 一整行比缓冲区还长: 只退到字符边界
+    tail = ring.read().decode()
+    assert tail.startswith("[输出过快") and tail.endswith("错误"), tail
+    ring.write("第一行\n")
+    ring.write("第二行\n")
+    assert ring.read() == "第一行\n第二行\n".encode(), "没溢出时不丢"
+    
+    # 校验结果缓存: 第一次完整校验, 之后只算哈希
+    _verdicts.clear()
+    t = time.ticks_us()
+    check_code(bench_code)
+    cold = time.ticks_diff(time.ticks_us(), t)
+    t = time.ticks_us()
+    for i in range(n):
+        check_code(bench_code)
+    print(f"校验: 首次 {cold} us, 命中缓存 {time.ticks_diff(time.ticks_us(), t) // n} us")
+    assert check_code(load_code()[1]) is None, "默认代码应通过校验"
+    print(execute_code("x = 1\nprint(getattr(x, 'real'))\n"))
+    
+    # 会话: 变量在多次执行之间保留, 单行表达式回显结果; 长期占用超过上限时清空
+    sess = open_session()
+    sess.run("n = 41")
+    print(sess.run("n + 1"), sess.out.read().decode())
+    for i in range(4):
+        print(sess.run("k%d = 'x' * 12000" % i))
+    print("会话:", sess.info(), sess.out.read().decode())
+    assert sess.claim() and not sess.claim(), "同一会话只能被占用一次"
+    sess.run("n")
+    assert not sess.busy
+    assert get_session(sess.id) is sess and close_session(sess.id)
+    
+    # 执行预算: 死循环按超时终止, 之前的输出保留
+    print(execute_code("print('开始')\nwhile True:\n    pass\n", timeout=1))
+    print("最近一次执行:", last_run)
+    assert last_run["stopped"]
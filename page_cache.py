@@ -0,0 +1,69 @@
+# page_cache.py - 页面缓存
+# 页面只渲染一次并以bytes保存, 可选gzip压缩, 带强ETag; 文件大小或修改时间变化时重新渲染
+import uos
+import hashlib
+import binascii
+import gc
+
+def _gzip(data):
+    """压缩成gzip格式, 固件不支持压缩时返回None"""
+    try:
+        import deflate, io
+        buf = io.BytesIO()
+        with deflate.DeflateIO(buf, deflate.GZIP) as d:
+            d.write(data)
+        return buf.getvalue()
+    except ImportError:
+        pass
+    except Exception as e:
+        print("页面压缩失败:", e)
+        return None
+    try:
+        import gzip
+        return gzip.compress(data)
+    except:
+        return None
+
+class PageCache:
+    def __init__(self, filename, replacements=None, use_gzip=True):
+        self.filename = filename
+        self.replacements = replacements or {}
+        self.use_gzip = use_gzip
+        self.stamp = None    # (size, mtime)
+        self.body = None
+        self.gz = None
+        self.etag = None
+
+    def _stat(self):
+        st = uos.stat(self.filename)
+        return (st[6], st[8])
+
+    def _render(self, stamp):
+        with open(self.filename) as f:
+            html = f.read()
+        for k, v in self.replacements.items():
+            html = html.replace(k, v)
+        body = html.encode('utf-8')
+        html = None
+        h = hashlib.sha256(body)
+        self.etag = binascii.hexlify(h.digest()[:8]).decode()
+        self.body = body
+        self.gz = _gzip(body) if self.use_gzip else None
+        if self.gz is not None and len(self.gz) >= len(body):
+            self.gz = None
+        self.stamp = stamp
+        gc.collect()
+        print("页面已缓存: %d 字节, gzip %s" % (len(body), len(self.gz) if self.gz else "无"))
+
+    def get(self):
+        """返回最新的缓存, 文件变化时重新渲染"""
+        stamp = self._stat()
+        if stamp != self.stamp:
+            self._render(stamp)
+        return self
+
+    def select(self, accept_encoding):
+        """按客户端能力返回 (正文, ETag, 是否gzip)"""
+        if self.gz is not None and 'gzip' in accept_encoding:
+            return self.gz, '"' + self.etag + '-gz"', True
+        return self.body, '"' + self.etag + '"', False
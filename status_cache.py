@@ -0,0 +1,165 @@
+# status_cache.py - /status 状态快照
+# 后台定时刷新快照, 数字字段写入预分配缓冲区的定宽槽位; 响应对象一直复用, 稳态下不分配内存
+from http_response import Response
+
+INT, BOOL, STR = 0, 1, 2
+INT_WIDTH = 10
+_TRUE = b'true '     # 与 false 等宽, 多出的空格是合法的JSON空白
+_FALSE = b'false'
+
+def _put_int(buf, pos, n):
+    """把整数右对齐写入定宽槽位, 左侧补空格"""
+    i = pos + INT_WIDTH - 1
+    neg = n < 0
+    if neg:
+        n = -n
+    while True:
+        buf[i] = 48 + n % 10
+        n //= 10
+        i -= 1
+        if not n or i < pos:
+            break
+    if neg and i >= pos:
+        buf[i] = 45
+        i -= 1
+    while i >= pos:
+        buf[i] = 32
+        i -= 1
+
+def _put_bool(buf, pos, v):
+    src = _TRUE if v else _FALSE
+    for j in range(5):
+        buf[pos + j] = src[j]
+
+class StatusCache:
+    def __init__(self, device_id, fields):
+        """fields: ((名称, INT/BOOL/STR), ...), 按顺序输出在 device_id 之后"""
+        self.device_id = device_id
+        self.fields = fields
+        self.index = {}
+        for i in range(len(fields)):
+            self.index[fields[i][0]] = i
+        self.values = [('' if f[1] == STR else False if f[1] == BOOL else 0) for f in fields]
+        self.slots = [0] * len(fields)
+        self.buf = None
+        self.response = None
+        self.stale = True    # 字符串字段变化后需要重建模板
+        self.version = 0     # 任一字段变化时加一
+
+    def _build(self):
+        import ujson
+        buf = bytearray(('{"device_id":' + ujson.dumps(self.device_id)).encode())
+        for i in range(len(self.fields)):
+            name, kind = self.fields[i]
+            buf.extend((',"' + name + '":').encode())
+            if kind == STR:
+                buf.extend(ujson.dumps(self.values[i]).encode())
+            else:
+                self.slots[i] = len(buf)
+                buf.extend(b' ' * (5 if kind == BOOL else INT_WIDTH))
+        buf.extend(b'}')
+        self.buf = buf
+        for i in range(len(self.fields)):
+            self._write(i)
+        self.response = Response(buf, content_type='application/json', cache_head=True)
+        self.stale = False
+
+    def _write(self, i):
+        kind = self.fields[i][1]
+        if kind == BOOL:
+            _put_bool(self.buf, self.slots[i], self.values[i])
+        elif kind == INT:
+            _put_int(self.buf, self.slots[i], self.values[i])
+
+    def set(self, name, v):
+        """更新一个字段, 数字和布尔字段直接改写槽位"""
+        i = self.index[name]
+        if self.values[i] == v:
+            return
+        self.values[i] = v
+        self.version += 1
+        if self.fields[i][1] == STR:
+            self.stale = True
+        elif not self.stale:
+            self._write(i)
+
+    def commit(self):
+        """一轮 set 之后调用, 必要时重建模板"""
+        if self.stale:
+            self._build()
+
+    def get(self, name):
+        return self.values[self.index[name]]
+
+    def as_dict(self):
+        d = {}
+        for i in range(len(self.fields)):
+            d[self.fields[i][0]] = self.values[i]
+        return d
+
+# 测试代码: 稳态刷新和完整的 /status 请求各分配多少字节
+if __name__ == "__main__":
+    import gc
+    import ujson
+    s = StatusCache("ESP32-S3-TEST", (('cpu_freq', INT), ('wifi_connected', BOOL), ('wifi_ssid', STR), ('uptime', INT)))
+    s.set('cpu_freq', 240)
+    s.set('wifi_connected', True)
+    s.set('wifi_ssid', "home")
+    s.commit()
+    print(bytes(s.buf).decode())
+    print(ujson.loads(bytes(s.buf)))
+    fresh = StatusCache("ESP32-S3-TEST", (('frp_running', BOOL), ('uptime', INT)))
+    fresh.commit()
+    assert ujson.loads(bytes(fresh.buf))['frp_running'] is False and fresh.as_dict()['frp_running'] is False
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        before = gc.mem_alloc()
+        for i in range(100):
+            s.set('uptime', i)
+            s.set('wifi_ssid', "home")
+            s.commit()
+        print("每次刷新分配:", (gc.mem_alloc() - before) // 100, "字节")
+
+        # 完整的 /status 请求: 处理函数取缓存的响应, send_response 写到假的 writer 上
+        try:
+            import asyncio
+        except ImportError:
+            import uasyncio as asyncio
+        from http_response import send_response
+
+        class _Writer:
+            def __init__(self):
+                self.n = 0
+
+            def write(self, data):
+                self.n += len(data)
+
+            async def drain(self):
+                pass
+
+        async def handle_status(req):
+            # 与 web_main.get_status_response 相同
+            if s.response is None:
+                s.commit()
+            return s.response
+
+        async def _requests(w, n):
+            for i in range(n):
+                await send_response(w, await handle_status(None), 5)
+
+        async def _measure(w, n):
+            gc.collect()
+            before = gc.mem_alloc()
+            await _requests(w, n)
+            per = (gc.mem_alloc() - before) // n
+            gc.collect()
+            return per, gc.mem_alloc() - before
+
+        async def _main(w):
+            await _requests(w, 10)      # 第一次发送时缓存响应头
+            return await _measure(w, 100), await _measure(w, 1000)
+
+        (_, kept), (per, kept2) = asyncio.run(_main(_Writer()))
+        # 分配的只有协程帧本身; 回收后的增长与请求次数无关, 稳态下每个请求不留下任何内存
+        print("每个 /status 请求分配:", per, "字节, 回收后 100 次/1000 次增长:", kept, "/", kept2, "字节")
+        assert kept2 - kept <= 0, (kept, kept2)
@@ -0,0 +1,155 @@
+# wave_engine.py - 硬件定时的波形输出
+# 方波直接用硬件PWM输出; 其他波形预先算好查找表(array('H')), 由硬件定时器回调逐点改写PWM占空比
+# 每个引脚同时只有一个波形, 新请求会替换正在输出的波形
+import math
+from array import array
+try:
+    import machine
+except ImportError:
+    machine = None
+
+CARRIER_HZ = 40000       # 查表波形的PWM载波频率
+MAX_SAMPLE_RATE = 4000   # 定时器回调最高频率(Hz), 再高会被中断延迟和GC抖动淹没
+LUT_SIZE = 64            # 每周期最多采样点数
+MIN_SAMPLES = 8          # 每周期最少采样点数, 低于此值拒绝输出
+TIMER_IDS = (0, 1, 2)    # 波形可用的硬件定时器, 3号留给采样引擎
+
+KINDS = ('square', 'sin', 'triangle', 'saw')
+PERIODIC = machine.Timer.PERIODIC if machine else 1
+
+def plan(freq):
+    """计算查表波形的采样计划: (每周期点数, 定时器频率Hz)"""
+    if freq <= 0:
+        raise ValueError("频率必须大于0")
+    samples = min(LUT_SIZE, MAX_SAMPLE_RATE // freq)
+    if samples < MIN_SAMPLES:
+        raise ValueError("频率过高, 最高 %d Hz" % (MAX_SAMPLE_RATE // MIN_SAMPLES))
+    return samples, freq * samples
+
+def build_table(kind, samples):
+    """生成一个周期的 duty_u16 查找表"""
+    lut = array('H', bytearray(2 * samples))
+    for i in range(samples):
+        x = i / samples
+        if kind == 'sin':
+            v = (math.sin(2 * math.pi * x) + 1) / 2
+        elif kind == 'triangle':
+            v = 2 * x if x < 0.5 else 2 - 2 * x
+        elif kind == 'saw':
+            v = x
+        else:
+            raise ValueError("不支持的波形")
+        lut[i] = int(v * 65535)
+    return lut
+
+class _Player:
+    """定时器回调: 只做下标递增和占空比写入, 不分配内存"""
+    def __init__(self, pwm, lut):
+        self.pwm = pwm
+        self.lut = lut
+        self.n = len(lut)
+        self.idx = 0
+
+    def tick(self, t):
+        self.pwm.duty_u16(self.lut[self.idx])
+        self.idx += 1
+        if self.idx >= self.n:
+            self.idx = 0
+
+class WaveEngine:
+    def __init__(self, pwm_factory=None, timer_factory=None):
+        self.pwm_factory = pwm_factory or (lambda pin: machine.PWM(machine.Pin(pin)))
+        self.timer_factory = timer_factory or machine.Timer
+        self.running = {}    # pin -> 状态字典(含 pwm/timer/player)
+        self.free_timers = list(TIMER_IDS)
+
+    def start(self, pin, kind='square', freq=1, duty=50):
+        """在引脚上开始输出波形, 同一引脚上已有的波形先停止"""
+        if kind not in KINDS:
+            raise ValueError("不支持的波形")
+        if kind != 'square':
+            samples, rate = plan(freq)
+        self.stop(pin)
+        if kind == 'square':
+            duty = max(0, min(100, duty))
+            pwm = self.pwm_factory(pin)
+            pwm.freq(freq)
+            pwm.duty_u16(duty * 65535 // 100)
+            self.running[pin] = {'type': kind, 'freq': freq, 'duty': duty, 'pwm': pwm, 'timer': None}
+            return self.running[pin]
+        if not self.free_timers:
+            raise ValueError("没有空闲的硬件定时器")
+        lut = build_table(kind, samples)
+        pwm = self.pwm_factory(pin)
+        pwm.freq(CARRIER_HZ)
+        pwm.duty_u16(lut[0])
+        player = _Player(pwm, lut)
+        tid = self.free_timers.pop(0)
+        timer = self.timer_factory(tid)
+        timer.init(freq=rate, mode=PERIODIC, callback=player.tick)
+        self.running[pin] = {'type': kind, 'freq': freq, 'samples': samples, 'rate': rate,
+                             'pwm': pwm, 'timer': timer, 'timer_id': tid, 'player': player}
+        return self.running[pin]
+
+    def stop(self, pin):
+        w = self.running.pop(pin, None)
+        if w is None:
+            return False
+        if w['timer'] is not None:
+            w['timer'].deinit()
+            self.free_timers.append(w['timer_id'])
+        w['pwm'].deinit()
+        return True
+
+    def stop_all(self):
+        for pin in list(self.running):
+            self.stop(pin)
+
+    def status(self):
+        """各引脚的波形参数(不含硬件对象)"""
+        out = {}
+        for pin in self.running:
+            w = self.running[pin]
+            out[str(pin)] = {k: w[k] for k in w if k in ('type', 'freq', 'duty', 'samples', 'rate')}
+        return out
+
+engine = WaveEngine() if machine else None
+
+# 测试代码: 用模拟的PWM和定时器检查采样计划与输出序列
+if __name__ == "__main__":
+    class SimPWM:
+        def __init__(self, pin):
+            self.pin = pin
+            self.log = []
+        def freq(self, f):
+            self.f = f
+        def duty_u16(self, d):
+            self.log.append(d)
+        def deinit(self):
+            pass
+
+    class SimTimer:
+        def __init__(self, tid):
+            self.tid = tid
+        def init(self, freq, mode, callback):
+            self.freq = freq
+            self.callback = callback
+        def run(self, n):
+            for _ in range(n):
+                self.callback(self)
+        def deinit(self):
+            pass
+
+    for f in (1, 50, 125, 500):
+        print("freq=%d Hz -> 每周期 %d 点, 定时器 %d Hz" % ((f,) + plan(f)))
+    eng = WaveEngine(SimPWM, SimTimer)
+    w = eng.start(14, 'sin', 100)
+    w['timer'].run(w['samples'] * 2)
+    seq = w['pwm'].log[1:]
+    assert seq[:w['samples']] == seq[w['samples']:], "两个周期的采样序列应一致"
+    assert max(seq) > 60000 and min(seq) < 1000
+    eng.start(14, 'square', 1000, 25)
+    assert 14 in eng.running and eng.running[14]['type'] == 'square'
+    assert len(eng.free_timers) == len(TIMER_IDS), "替换波形后定时器应归还"
+    print(eng.status())
+    print("波形引擎模拟测试通过")
@@ -1,10 +1,29 @@
 import network
-import socket
 import time
 import machine
 import uos
 import gc
-import frp_tunnel
+import boot_timeline
+import metrics
+import mem_manager
+import wave_engine
+import gpio_bank
+import gpio_capture
+import wifi_manager
+from http_router import Router, BadRequest, Connection, read_request
+from http_response import Response, json_response, send_response, can_keep_alive
+from page_cache import PageCache
+from status_cache import StatusCache, INT, BOOL, STR
+from worker_pool import pool, QueueFull
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+# 隧道和终端第一次用到时才导入, 不拖慢启动
+frp_tunnel = boot_timeline.lazy('frp_tunnel')
+mpy_terminal = boot_timeline.lazy('mpy_terminal')
+boot_timeline.mark('imports')
 
 print("\n" + "="*50)
 print("ESP32-S3控制台启动中...")
@@ -22,257 +41,552 @@ def get_device_id():
 device_id = get_device_id()
 ap_ssid = device_id
 ap_password = "12345678"
+AP_IP = '192.168.4.1'
+HTTP_PORT = 80
+AP_READY_TIMEOUT = 5000   # 等待热点就绪的上限(ms)
 ap = network.WLAN(network.AP_IF)
-ap.active(False)
-time.sleep(0.5)
-ap.active(True)
-time.sleep(1)
-try:
-    ap.config(ssid=ap_ssid, password=ap_password, authmode=3, channel=6)
-except: pass
-ap.ifconfig(('192.168.4.1', '255.255.255.0', '192.168.4.1', '8.8.8.8'))
-time.sleep(2)
+
+def start_ap():
+    """配置热点, 不等待; 就绪由 wait_ap_ready 在事件循环里检查"""
+    ap.active(True)
+    try:
+        ap.config(ssid=ap_ssid, password=ap_password, authmode=3, channel=6)
+    except: pass
+    ap.ifconfig((AP_IP, '255.255.255.0', AP_IP, '8.8.8.8'))
+    boot_timeline.mark('ap_config')
+
+def ap_ready():
+    try:
+        return ap.active() and ap.ifconfig()[0] == AP_IP
+    except:
+        return False
+
+async def wait_ap_ready():
+    t = time.ticks_ms()
+    while not ap_ready():
+        if time.ticks_diff(time.ticks_ms(), t) > AP_READY_TIMEOUT:
+            print("热点启动超时")
+            boot_timeline.mark('ap_timeout')
+            return False
+        await asyncio.sleep(0.02)
+    boot_timeline.mark('ap_ready')
+    return True
 global_state = {
     "device_id": device_id,
     "wifi_connected": False,
     "wifi_ssid": "",
     "start_time": time.ticks_ms(),
-    "frp_running": False,
 }
 
-def http_server():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('0.0.0.0', 80))
-    sock.listen(5)
-    while True:
-        conn = None
-        try:
-            conn, addr = sock.accept()
-            conn.settimeout(10.0)
+KEEPALIVE_TIMEOUT = 5     # 空闲连接保持秒数
+KEEPALIVE_MAX = 100       # 每个连接最多处理的请求数
+FIRST_REQUEST_TIMEOUT = 10
+RETRY_AFTER = 5           # 工作队列已满时建议客户端等待的秒数
+
+async def handle_client(reader, writer):
+    # 每个连接一个协程，处理函数等待时让出事件循环；HTTP/1.1 连接可复用, 支持流水线请求
+    route = None
+    streamed = False
+    mem_manager.begin()
+    conn = Connection(reader)
+    try:
+        timeout = FIRST_REQUEST_TIMEOUT
+        for n in range(KEEPALIVE_MAX):
+            try:
+                req = await read_request(conn, timeout)
+            except BadRequest as e:
+                route = 'bad_request'
+                start = metrics.begin()
+                metrics.observe(route, e.status, start, await send_response(writer, Response(str(e), e.status)))
+                return
+            if req is None: return
+            start = metrics.begin()
+            handler, req.params = router.match(req.method, req.path)
+            route = handler.__name__
+            failed = False
             try:
-                request = conn.recv(1024)
-                if not request: conn.close(); continue
-                request_line = request.decode('utf-8', 'ignore').split('\r\n')[0]
-                parts = request_line.split()
-                if len(parts)<2: conn.close(); continue
-                method, path = parts[0], parts[1]
-                # --- 路由分发 ----
-                if path == '/' or 'index' in path:
-                    response = get_html_response()
-                elif path.startswith('/status'): response = get_status_response()
-                elif 'wifi/connect' in path: response = handle_wifi_connect(path)
-                elif path.startswith('/wifi/disconnect'): response = handle_wifi_disconnect()
-                elif path.startswith('/wifi/scan'): response = handle_wifi_scan()
-                elif 'cpu_freq' in path: response = handle_cpu_freq(path)
-                elif path.startswith('/restart'): response = handle_restart()
-                elif '/gpio/set' in path or '/gpio/read' in path: response = handle_gpio(path)
-                elif path.startswith('/factory_reset'): response = handle_factory_reset()
-                elif '/gpio/wave' in path: response = handle_gpio_wave(path)
-                elif path.startswith('/frp/start'): response = start_frp_wrap()
-                elif path.startswith('/frp/stop'): response = stop_frp_wrap()
-                elif path.startswith('/frp/config'): response = handle_frp_config(path)
-                else: response = get_html_response()
-                conn.send(response.encode('utf-8'))
+                response = await handler(req)
+            except QueueFull:
+                response = Response("服务器繁忙, 请稍后重试", 503, headers={'Retry-After': str(RETRY_AFTER)})
             except Exception as e:
-                print('请求处理错误:',e)
+                # 处理函数出错时回 500 再关闭连接, 不让浏览器一直等
+                print('请求处理错误:', e)
+                response = Response("服务器内部错误", 500)
+                failed = True
+            http11 = req.version == 'HTTP/1.1'
+            keep = not failed and req.keep_alive() and n < KEEPALIVE_MAX - 1 and can_keep_alive(response, http11)
+            if getattr(response.body, 'long_lived', False):
+                mem_manager.stream()
+                streamed = True
+            sent = await send_response(writer, response, KEEPALIVE_TIMEOUT if keep else 0, http11)
+            if streamed and keep:
+                mem_manager.begin()
+                streamed = False
+            metrics.observe(route, response.status, start, sent)
+            boot_timeline.mark_once('first_response')
+            if not keep: return
+            timeout = KEEPALIVE_TIMEOUT
+    except Exception as e:
+        if not isinstance(e, asyncio.TimeoutError):
+            print('请求处理错误:',e)
+    finally:
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except: pass
+        metrics.gc_time(route, mem_manager.end(streamed))
+
+async def http_server():
+    asyncio.create_task(status_ticker())
+    asyncio.create_task(wifi_ticker())
+    asyncio.create_task(mem_manager.idle_collector())
+    await asyncio.start_server(handle_client, '0.0.0.0', HTTP_PORT, backlog=5)
+    boot_timeline.mark('http_listen')
+    asyncio.create_task(wait_ap_ready())
+    print("HTTP服务器已启动: http://" + AP_IP)
+    while True:
+        await asyncio.sleep(3600)
+
+page = PageCache('DOCTYPE.html', {'{device_id}': device_id})
+
+async def get_html_response(req):
+    try:
+        body, etag, gz = page.get().select(req.headers.get('accept-encoding', ''))
+    except Exception as e:
+        return Response("读取HTML失败", content_type='text/html; charset=utf-8')
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if etag in req.headers.get('if-none-match', ''):
+        return Response(b'', 304, headers=headers)
+    if gz:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, content_type='text/html; charset=utf-8', headers=headers)
+
+STATUS_TICK = 1          # 状态快照刷新间隔(秒)
+status = StatusCache(device_id, (
+    ('cpu_freq', INT), ('free_mem', INT), ('wifi_connected', BOOL), ('wifi_ssid', STR),
+    ('wifi_state', STR), ('wifi_assoc_ms', INT), ('wifi_dhcp_ms', INT), ('wifi_connect_ms', INT),
+    ('uptime', INT), ('frp_running', BOOL), ('frp_state', STR), ('frp_rtt', INT), ('frp_reconnects', INT),
+    ('pool_busy', INT), ('pool_queued', INT), ('pool_util', INT),
+))
+
+def refresh_status():
+    status.set('cpu_freq', machine.freq() // 1000000)
+    status.set('free_mem', gc.mem_free() // 1024)
+    status.set('wifi_connected', global_state["wifi_connected"])
+    status.set('wifi_ssid', global_state["wifi_ssid"])
+    conn = wifi_manager.connector
+    status.set('wifi_state', conn.state())
+    # 最近一次成功连接的耗时: 关联、DHCP、总计
+    assoc, dhcp, total = conn.last.metrics() if conn.last else (-1, -1, -1)
+    status.set('wifi_assoc_ms', assoc)
+    status.set('wifi_dhcp_ms', dhcp)
+    status.set('wifi_connect_ms', total)
+    status.set('uptime', time.ticks_diff(time.ticks_ms(), global_state["start_time"]) // 1000)
+    if frp_tunnel.module is None:
+        # 隧道模块还没用过, 不为了刷新状态去导入它
+        status.set('frp_running', False)
+        status.set('frp_state', 'down')
+        status.set('frp_rtt', -1)
+        status.set('frp_reconnects', 0)
+    else:
+        frp = frp_tunnel.tunnel
+        status.set('frp_running', frp.running)
+        status.set('frp_state', frp.state)
+        status.set('frp_rtt', frp.mux.rtt if frp.mux else -1)
+        status.set('frp_reconnects', frp.reconnects)
+    status.set('pool_busy', pool.busy)
+    status.set('pool_queued', len(pool.queue))
+    status.set('pool_util', pool.utilization())
+    status.commit()
+
+async def status_ticker():
+    while True:
+        try:
+            refresh_status()
         except Exception as e:
-            print('服务器错误:', e)
+            print('状态刷新错误:', e)
+        await asyncio.sleep(STATUS_TICK)
+
+async def get_status_response(req):
+    # 直接返回缓存的响应, 不做GC也不拼接字符串
+    if status.response is None:
+        refresh_status()
+    return status.response
+
+def status_fields():
+    """推送用的状态字段, 取自状态快照; gpio 为通过 /gpio 接口操作过的引脚电平"""
+    fields = status.as_dict()
+    fields["gpio"] = gpio_bank.levels()
+    return fields
+
+SSE_MAX_CLIENTS = 3
+SSE_INTERVAL = 2         # 默认采样间隔(秒)
+SSE_HEARTBEAT = 15       # 无变化时发送心跳的间隔(秒)
+sse_clients = 0
+
+class StatusEvents:
+    """SSE状态推送: 按固定间隔采样, 只发送变化了的字段"""
+    long_lived = True    # 推送期间不算正在处理的连接, 见 mem_manager.stream
+    def __init__(self, interval):
+        self.interval = interval
+
+    async def pump(self, write):
+        global sse_clients
+        import ujson
+        sse_clients += 1
+        sent = 0
+        last = {}
+        idle = 0
+        try:
+            await write('retry: 3000\n\n')
+            while True:
+                now = status_fields()
+                delta = {}
+                for k in now:
+                    if last.get(k) != now[k]:
+                        delta[k] = now[k]
+                if delta:
+                    msg = 'data: ' + ujson.dumps(delta) + '\n\n'
+                    await write(msg)
+                    sent += len(msg)
+                    idle = 0
+                    last = now
+                else:
+                    idle += self.interval
+                    if idle >= SSE_HEARTBEAT:
+                        await write(':\n\n')
+                        idle = 0
+                await asyncio.sleep(self.interval)
         finally:
-            if conn:
-                try: conn.close()
-                except: pass
-            gc.collect()
+            sse_clients -= 1
+        return sent
 
-def get_html_response():
+async def handle_events(req):
+    if sse_clients >= SSE_MAX_CLIENTS:
+        return Response("推送连接过多", 503, headers={'Retry-After': '30'})
     try:
-        f = open('DOCTYPE.html')
-        html = f.read()
-        f.close()
-        html = html.replace('{device_id}', device_id)
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n" + html
-    except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n读取HTML失败"
-
-def get_status_response():
-    gc.collect()
-    status = '{'
-    status += '"device_id":"' + device_id + '",'
-    status += '"cpu_freq":' + str(machine.freq() // 1000000) + ','
-    status += '"free_mem":' + str(gc.mem_free() // 1024) + ','
-    status += '"wifi_connected":' + ('true' if global_state["wifi_connected"] else 'false') + ','
-    status += '"wifi_ssid":"' + global_state["wifi_ssid"] + '",'
-    status += '"uptime":' + str((time.ticks_ms() - global_state["start_time"]) // 1000) + ','
-    status += '"frp_running":' + ('true' if global_state.get("frp_running", False) else 'false')
-    status += '}'
-    return "HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" + status
-
-def handle_wifi_connect(path):
+        interval = max(0.5, float(req.query.get('interval', SSE_INTERVAL)))
+    except ValueError:
+        interval = SSE_INTERVAL
+    return Response(StatusEvents(interval), content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+async def handle_wifi_connect(req):
+    # 立即返回任务, 连接在后台进行; 之后用 /wifi/connect/status?job= 查询. 保存过的网络可以不带密码
+    ssid = req.query.get('ssid')
+    if not ssid:
+        return json_response({'error': "缺少参数"}, 400)
+    reuse = req.query.get('reuse_ip')
     try:
-        if '?' in path:
-            params = path.split('?')[1]
-            parts = params.split('&')
-            ssid, password = None, None
-            for part in parts:
-                if part.startswith('ssid='):     ssid = part[5:].replace('%20', ' ').replace('+', ' ')
-                elif part.startswith('password='):password = part[9:].replace('%20', ' ').replace('+', ' ')
-            if ssid and password:
-                wlan = network.WLAN(network.STA_IF)
-                wlan.active(True); wlan.connect(ssid, password)
-                for i in range(20):
-                    if wlan.isconnected():
-                        global_state["wifi_connected"] = True
-                        global_state["wifi_ssid"] = ssid
-                        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nWiFi连接成功: " + ssid
-                    time.sleep(0.5)
-                return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nWiFi连接超时"
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n缺少参数"
-    except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n错误: " + str(e)
+        job = wifi_manager.connector.start(ssid, req.query.get('password') or None,
+                                           None if reuse is None else reuse == '1')
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    return json_response(job.info())
+
+async def handle_wifi_connect_status(req):
+    conn = wifi_manager.connector
+    try:
+        job = conn.get(int(req.query['job'])) if 'job' in req.query else conn.job or (conn.jobs[-1] if conn.jobs else None)
+    except ValueError:
+        job = None
+    if job is None:
+        return json_response({'error': "任务不存在"}, 404)
+    return json_response(job.info())
+
+WIFI_TICK = 0.1          # 推进连接状态机的间隔(秒), 也是连接耗时的测量精度
 
-def handle_wifi_disconnect():
+async def wifi_ticker():
+    conn = wifi_manager.connector
+    while True:
+        job = conn.step()
+        if job is not None:
+            ok = job.state == wifi_manager.CONNECTED
+            global_state["wifi_connected"] = ok
+            global_state["wifi_ssid"] = job.ssid if ok else ""
+        await asyncio.sleep(WIFI_TICK)
+
+async def handle_wifi_disconnect(req):
     try:
+        wifi_manager.connector.cancel()
         wlan = network.WLAN(network.STA_IF)
         if wlan.isconnected(): wlan.disconnect()
         wlan.active(False)
         global_state["wifi_connected"] = False; global_state["wifi_ssid"] = ""
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nWiFi已断开"
+        return Response("WiFi已断开")
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n错误: " + str(e)
+        return Response("错误: " + str(e))
+
+def _json_items(items):
+    # 逐条序列化, 不在内存里拼出整个JSON数组
+    import ujson
+    yield '['
+    for i, item in enumerate(items):
+        if i: yield ','
+        yield ujson.dumps(item)
+    yield ']'
 
-def handle_wifi_scan():
+async def handle_wifi_scan(req):
+    # 返回缓存的扫描结果(Age 头为结果年龄秒数); 结果过期时后台重新扫描, ?refresh=1 等待新结果
+    scanner = wifi_manager.scanner
     try:
-        wlan = network.WLAN(network.STA_IF)
-        wlan.active(True)
-        networks = wlan.scan()
-        wlan.active(False)
-        result = [ ]
-        for net in networks:
-            try: ssid = net[0].decode('utf-8', 'ignore')
-            except: ssid = str(net[0])
-            if not ssid: continue
-            result.append({'ssid': ssid, 'rssi': net[3], 'channel': net[2]})
-        import ujson
-        return "HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" + ujson.dumps(result)
+        networks, age = await scanner.get(req.query.get('refresh') == '1')
+    except QueueFull:
+        raise
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n扫描失败: " + str(e)
+        return Response("扫描失败: " + str(e))
+    headers = {'Age': str(age // 1000), 'Cache-Control': 'no-cache'}
+    if scanner.pending():
+        headers['X-Scan-Pending'] = '1'
+    return Response(_json_items(networks), content_type='application/json', headers=headers)
 
-def handle_cpu_freq(path):
+async def handle_cpu_freq(req):
     try:
-        if 'value=' in path:
-            parts = path.split('value=')
-            freq_str = parts[1].split('&')[0]
-            freq = int(freq_str)
+        if 'value' in req.query:
+            freq = int(req.query['value'])
             machine.freq(freq * 1000000)
-            return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nCPU频率已设置为 " + str(freq) + " MHz"
+            return Response("CPU频率已设置为 " + str(freq) + " MHz")
         else:
-            return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n缺少频率参数"
+            return Response("缺少频率参数")
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n错误: " + str(e)
+        return Response("错误: " + str(e))
 
-def handle_restart():
-    import _thread
-    def reset_async():
-        time.sleep(1)
+async def handle_restart(req):
+    async def reset_async():
+        await asyncio.sleep(1)
         machine.reset()
-    _thread.start_new_thread(reset_async, ())
-    return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n设备正在重启..."
+    asyncio.create_task(reset_async())
+    return Response("设备正在重启...")
 
-def handle_factory_reset():
+async def handle_factory_reset(req):
     try:
         files = ["wifi_config.json", "config.json", "settings.json", "frp_config.json"]
         for file in files:
             try: uos.remove(file)
             except: pass
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n恢复出厂设置完成"
+        return Response("恢复出厂设置完成")
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n恢复失败: " + str(e)
+        return Response("恢复失败: " + str(e))
 
-def handle_gpio(path):
+async def handle_gpio_set(req):
     try:
-        pin=None; value=None
-        if '/gpio/set' in path and '?' in path:
-            params = path.split('?')[1]
-            for p in params.split('&'):
-                if p.startswith('pin='): pin = int(p[4:])
-                elif p.startswith('value='): value = int(p[6:])
-            if pin is not None and value is not None:
-                p = machine.Pin(pin, machine.Pin.OUT)
-                p.value(value)
-                return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nGPIO " + str(pin) + " 设置为 " + str(value)
-        elif '/gpio/read' in path and '?' in path:
-            params = path.split('?')[1]
-            for p in params.split('&'):
-                if p.startswith('pin='):
-                    pin = int(p[4:])
-                    p = machine.Pin(pin, machine.Pin.IN)
-                    val = p.value()
-                    return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n" + str(val)
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n无效的GPIO请求"
+        if 'pin' in req.query and 'value' in req.query:
+            pin = int(req.query['pin'])
+            value = int(req.query['value'])
+            gpio_bank.get_pin(pin, machine.Pin.OUT).value(value)
+            return Response("GPIO " + str(pin) + " 设置为 " + str(value))
+        return Response("无效的GPIO请求")
+    except Exception as e:
+        return Response("GPIO错误: " + str(e))
+
+async def handle_gpio_read(req):
+    try:
+        if 'pin' in req.query:
+            pin = int(req.query['pin'])
+            val = gpio_bank.get_pin(pin, machine.Pin.IN).value()
+            return Response(str(val))
+        return Response("无效的GPIO请求")
+    except Exception as e:
+        return Response("GPIO错误: " + str(e))
+
+async def handle_gpio_batch(req):
+    # JSON 正文 {"set": {"2": 1}, "read": [5, 6]}, 或查询 ?set=2:1,4:0&read=5,6; 先写后读
+    try:
+        if req.body:
+            import ujson
+            data = ujson.loads(req.body)
+            sets, reads = data.get('set', {}), data.get('read', [])
+        else:
+            sets, reads = gpio_bank.parse_query(req.query)
+        result = {}
+        # ujson 不给整数键加引号, 转成字符串键
+        if sets:
+            done = gpio_bank.write_many(sets)
+            result['set'] = {str(pin): done[pin] for pin in done}
+        if reads:
+            levels = gpio_bank.read_many(reads)
+            result['read'] = {str(pin): levels[pin] for pin in levels}
+        return json_response(result)
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nGPIO错误: " + str(e)
+        return json_response({'error': str(e)}, 400)
 
-def handle_gpio_wave(path):
+async def handle_gpio_wave(req):
     try:
-        params = path.split('?')[1] if '?' in path else ""
-        args = {}
-        for p in params.split('&'):
-            if '=' in p:
-                k,v=p.split('=',1); args[k]=v
+        args = req.query
         pin = int(args.get('pin', 14))
         wave_type = args.get('type','square')
         freq = int(args.get('freq', 1))
         duty = int(args.get('duty', 50))  # 0-100
-        import math, _thread
+        w = wave_engine.engine.start(pin, wave_type, freq, duty)
         if wave_type == 'square':
-            def _square_wave():
-                p=machine.Pin(pin, machine.Pin.OUT)
-                t = 1/(freq*2)
-                for _ in range(2000):
-                    p.value(1); time.sleep(t*duty/50)
-                    p.value(0); time.sleep(t*(100-duty)/50)
-            _thread.start_new_thread(_square_wave, ())
-            return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n输出方波已开始"
-        elif wave_type == 'sin':
-            def _sin_wave():
-                p=machine.PWM(machine.Pin(pin))
-                p.freq(freq)
-                import math
-                for t in range(2000):
-                    v=int((math.sin(2*math.pi*freq*t/2000)+1)*511)
-                    p.duty(v)
-                    time.sleep(0.005)
-                p.deinit()
-            _thread.start_new_thread(_sin_wave, ())
-            return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n输出正弦波已开始"
+            return Response("输出方波已开始: " + str(freq) + " Hz")
+        return Response("输出波形已开始: " + str(freq) + " Hz, 每周期 " + str(w['samples']) + " 点")
+    except ValueError as e:
+        return Response("GPIO波形错误: " + str(e), 400)
+    except Exception as e:
+        return Response("GPIO波形错误: " + str(e))
+
+async def handle_gpio_wave_stop(req):
+    try:
+        if 'pin' in req.query:
+            stopped = wave_engine.engine.stop(int(req.query['pin']))
         else:
-            return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n不支持的波形"
+            wave_engine.engine.stop_all()
+            stopped = True
+        return Response("波形已停止" if stopped else "该引脚没有波形输出")
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nGPIO波形错误: " + str(e)
+        return Response("GPIO波形错误: " + str(e))
+
+async def handle_gpio_wave_status(req):
+    return json_response(wave_engine.engine.status())
+
+CAPTURE_POLL = 0.05      # 推送采样数据时检查缓冲区的间隔(秒)
+
+class CaptureStream:
+    """/capture/stream 的正文: 边采样边推送二进制块, 采样停止后结束"""
+    long_lived = True
+    def __init__(self, cap):
+        self.cap = cap
 
-def start_frp_wrap():
+    async def pump(self, write):
+        cap = self.cap
+        head = cap.stream_header()
+        await write(head)
+        sent = len(head)
+        cursor = cap.total
+        while True:
+            busy = cap.busy()
+            cursor, chunks = cap.stream_from(cursor)
+            for chunk in chunks:
+                await write(chunk)
+                sent += len(chunk)
+            if not busy:
+                break
+            await asyncio.sleep(CAPTURE_POLL)
+        return sent
+
+async def handle_capture_start(req):
     try:
-        ok = frp_tunnel.start_frp()
-        global_state["frp_running"] = True
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n隧道已启动"
+        return json_response(gpio_capture.capture.start(**gpio_capture.parse_query(req.query)))
     except Exception as e:
-        global_state["frp_running"] = False
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nFRP启动失败: " + str(e)
+        return json_response({'error': str(e)}, 400)
+
+async def handle_capture_stop(req):
+    gpio_capture.capture.stop()
+    return json_response(gpio_capture.capture.status())
+
+async def handle_capture_status(req):
+    return json_response(gpio_capture.capture.status())
 
-def stop_frp_wrap():
+async def handle_capture_data(req):
+    cap = gpio_capture.capture
+    if cap.busy():
+        return Response("采样未完成, 请先停止或使用 /capture/stream", 409)
     try:
-        ok = frp_tunnel.stop_frp()
-        global_state["frp_running"] = False
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n隧道已停止"
+        size, chunks = cap.blob()
+    except ValueError as e:
+        return Response(str(e), 404)
+    return Response(chunks, content_type='application/octet-stream', length=size,
+                    headers={'Content-Disposition': 'attachment; filename="capture.bin"'})
+
+async def handle_capture_stream(req):
+    cap = gpio_capture.capture
+    if not cap.busy():
+        return Response("没有正在进行的采样", 404)
+    return Response(CaptureStream(cap), content_type='application/octet-stream', headers={'Cache-Control': 'no-cache'})
+
+TERM_POLL = 0.05         # 流式执行时检查输出的间隔(秒)
+
+class TermStream:
+    """/term/exec 的正文: 代码在工作线程里执行, 输出经环形缓冲区边产生边写给浏览器"""
+    def __init__(self, job, out):
+        self.job = job
+        self.out = out
+
+    async def pump(self, write):
+        sent = 0
+        while True:
+            done = self.job.done
+            data = self.out.read()
+            if data:
+                # 浏览器读得慢时在这里等待, 期间缓冲区写满会丢弃最旧的输出
+                await write(data)
+                sent += len(data)
+            if done:
+                break
+            await asyncio.sleep(TERM_POLL)
+        msg = '\n' + (self.job.result if self.job.error is None else "执行错误: " + str(self.job.error)) + '\n'
+        await write(msg)
+        return sent + len(msg)
+
+async def handle_term_exec(req):
+    try:
+        code = req.body.decode() if req.body else req.query.get('code', '')
+    except UnicodeError:
+        return Response("代码不是有效的UTF-8", 400)
+    if not code:
+        return Response("缺少代码", 400)
+    sid = req.query.get('session')
+    if sid:
+        session = mpy_terminal.get_session(sid)
+        if session is None:
+            return Response("会话不存在或已过期", 404)
+        if not session.claim():
+            return Response("会话正在执行", 409)
+        out = session.out
+        out.read()      # 丢掉上次浏览器没读走的输出
+        try:
+            job = pool.submit(session.run, code)
+        except QueueFull:
+            session.busy = False
+            raise
+    else:
+        out = mpy_terminal.OutputRing()
+        job = pool.submit(mpy_terminal.execute_stream, code, out)
+    return Response(TermStream(job, out), headers={'Cache-Control': 'no-cache', 'X-Content-Type-Options': 'nosniff'})
+
+async def handle_term_session(req):
+    # POST 新建会话, DELETE ?session= 关闭, GET 列出现有会话
+    if req.method == 'POST':
+        session = mpy_terminal.open_session()
+        if session is None:
+            return Response("会话已满, 请稍后重试", 503, headers={'Retry-After': str(RETRY_AFTER)})
+        return json_response(session.info())
+    if req.method == 'DELETE':
+        ok = mpy_terminal.close_session(req.query.get('session', ''))
+        return Response("会话已关闭" if ok else "会话不存在", 200 if ok else 404)
+    return json_response([s.info() for s in mpy_terminal.sessions.values()])
+
+FRP_START_POLL = 0.1     # 上一个隧道线程还没退出时重试启动的间隔(秒)
+FRP_START_TRIES = 20
+
+async def start_frp_wrap(req):
+    try:
+        err = frp_tunnel.start_frp()
+        for i in range(FRP_START_TRIES):
+            if err != frp_tunnel.STOPPING:
+                break
+            # 在事件循环里等, 不挡住其他连接
+            await asyncio.sleep(FRP_START_POLL)
+            err = frp_tunnel.start_frp()
+        if err is None:
+            return Response("隧道已启动, 正在连接")
+        return Response("FRP启动失败: " + err)
     except Exception as e:
-        return "HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\nFRP停止失败: " + str(e)
+        return Response("FRP启动失败: " + str(e))
 
-def handle_frp_config(path):
-    import ujson
-    if '?' in path:
-        params = path.split('?', 1)[1]
-        kv_list = [x.split('=',1) for x in params.split('&') if '=' in x]
-        kv = {k: v for k, v in kv_list}
+async def stop_frp_wrap(req):
+    try:
+        frp_tunnel.stop_frp()
+        return Response("隧道已停止")
+    except Exception as e:
+        return Response("FRP停止失败: " + str(e))
+
+async def handle_frp_status(req):
+    return json_response(frp_tunnel.get_frp_status())
+
+async def handle_frp_config(req):
+    kv = req.query
+    if kv:
         changed = False
         if 'server' in kv:
             frp_tunnel.tunnel.config['server'] = kv['server']
@@ -290,10 +604,81 @@ def handle_frp_config(path):
         "port": frp_tunnel.tunnel.config.get("port",""),
         "token": frp_tunnel.tunnel.config.get("token","")
     }
-    return "HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" + ujson.dumps(config)
+    return json_response(config)
+
+async def handle_metrics(req):
+    # Prometheus 文本格式; 线程数 = 主线程 + 已启动的工作线程 + 隧道线程
+    frp = frp_tunnel.module and frp_tunnel.tunnel
+    st = frp.get_status() if frp else None
+    ps = pool.stats()
+    gauges = (
+        ('esp_threads', 'gauge', '线程数', 1 + pool.started + (1 if frp and frp.thread_alive else 0)),
+        ('esp_pool_busy', 'gauge', '忙碌的工作线程数', ps['busy']),
+        ('esp_pool_queued', 'gauge', '工作队列长度', ps['queued']),
+        ('esp_pool_jobs_total', 'counter', '工作线程池任务数',
+         (('result="completed"', ps['completed']), ('result="rejected"', ps['rejected']))),
+        ('esp_frp_bytes_total', 'counter', '隧道收发字节数',
+         (('direction="in"', st['bytes_in'] if st else 0), ('direction="out"', st['bytes_out'] if st else 0))),
+    )
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+async def handle_debug_gc(req):
+    # 回收统计; ?policy=always|adaptive 切换策略, 用于对比
+    p = req.query.get('policy')
+    if p in (mem_manager.ADAPTIVE, mem_manager.ALWAYS):
+        mem_manager.policy = p
+    return json_response(mem_manager.stats())
+
+async def handle_debug_boot(req):
+    return json_response(boot_timeline.report())
+
+async def method_not_allowed(req):
+    return Response("不支持的请求方法", 405, headers={'Allow': req.params['allow']})
+
+def build_router():
+    r = Router(fallback=get_html_response, not_allowed=method_not_allowed)
+    r.add('/', get_html_response)
+    r.add('/index.html', get_html_response)
+    r.add('/status', get_status_response)
+    r.add('/events', handle_events)
+    r.add('/wifi/connect', handle_wifi_connect)
+    r.add('/wifi/connect/status', handle_wifi_connect_status)
+    r.add('/wifi/disconnect', handle_wifi_disconnect)
+    r.add('/wifi/scan', handle_wifi_scan)
+    r.add('/system/cpu_freq', handle_cpu_freq)
+    r.add('/restart', handle_restart)
+    r.add('/system/restart', handle_restart)
+    r.add('/factory_reset', handle_factory_reset)
+    r.add('/system/factory_reset', handle_factory_reset)
+    r.add('/gpio/set', handle_gpio_set)
+    r.add('/gpio/read', handle_gpio_read)
+    r.add('/gpio/batch', handle_gpio_batch, ('GET', 'POST'))
+    r.add('/gpio/wave', handle_gpio_wave)
+    r.add('/gpio/wave/stop', handle_gpio_wave_stop)
+    r.add('/gpio/wave/status', handle_gpio_wave_status)
+    r.add('/capture/start', handle_capture_start)
+    r.add('/capture/stop', handle_capture_stop)
+    r.add('/capture/status', handle_capture_status)
+    r.add('/capture/data', handle_capture_data)
+    r.add('/capture/stream', handle_capture_stream)
+    r.add('/term/exec', handle_term_exec, ('GET', 'POST'))
+    r.add('/term/session', handle_term_session, ('GET', 'POST', 'DELETE'))
+    r.add('/frp/start', start_frp_wrap)
+    r.add('/frp/stop', stop_frp_wrap)
+    r.add('/frp/status', handle_frp_status)
+    r.add('/frp/config', handle_frp_config)
+    r.add('/debug/boot', handle_debug_boot)
+    r.add('/debug/gc', handle_debug_gc)
+    r.add('/metrics', handle_metrics)
+    return r
+
+router = build_router()
+boot_timeline.mark('setup')
 
 def main():
-    http_server()
+    mem_manager.setup()
+    start_ap()
+    asyncio.run(http_server())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
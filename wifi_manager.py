@@ -1,39 +1,216 @@
 # wifi_manager.py - WiFi连接管理
 import network
 import time
-import ujson
 import gc
+import binascii
+from worker_pool import pool
+
+SCAN_TTL_MS = 30000      # 扫描结果有效期, 过期后先返回旧结果, 同时在后台重新扫描
+CONNECT_TIMEOUT_MS = 30000   # 完整连接(全信道扫描+DHCP)的超时
+FAST_TIMEOUT_MS = 6000       # 按保存的BSSID/信道快速重连的超时, 超时后退回完整连接
+CONNECT_POLL_MS = 100        # 连接过程中检查状态的间隔
+MAX_PROFILES = 8             # 保存的网络数量上限
+MAX_JOBS = 4                 # 保留的连接任务记录数
+
+# 连接任务状态: 关联中 -> 获取IP中 -> 已连接/失败
+ASSOC, DHCP, CONNECTED, FAILED = 'assoc', 'dhcp', 'connected', 'failed'
+
+class ConnectJob:
+    def __init__(self, jid, ssid, password, profile, reuse_ip):
+        self.id = jid
+        self.ssid = ssid
+        self.password = password
+        self.profile = profile
+        self.reuse_ip = reuse_ip
+        self.state = ASSOC
+        self.fast = bool(profile and profile.get('bssid'))
+        self.fell_back = False
+        self.t0 = time.ticks_ms()
+        self.t_try = self.t0     # 本次尝试(快速或完整)开始的时间
+        self.t_assoc = None
+        self.t_done = None
+        self.error = None
+        self.ip = None
+
+    def finished(self):
+        return self.state in (CONNECTED, FAILED)
+
+    def metrics(self):
+        """(关联ms, DHCP ms, 总计ms), 未完成的阶段为 -1; 关联和DHCP从最后一次尝试算起"""
+        assoc = time.ticks_diff(self.t_assoc, self.t_try) if self.t_assoc is not None else -1
+        dhcp = time.ticks_diff(self.t_done, self.t_assoc) if self.t_done is not None and self.t_assoc is not None else -1
+        total = time.ticks_diff(self.t_done if self.t_done is not None else time.ticks_ms(), self.t0)
+        return assoc, dhcp, total
+
+    def info(self):
+        assoc, dhcp, total = self.metrics()
+        return {'job': self.id, 'ssid': self.ssid, 'state': self.state, 'fast': self.fast,
+                'fell_back': self.fell_back, 'assoc_ms': assoc, 'dhcp_ms': dhcp,
+                'total_ms': total, 'ip': self.ip, 'error': self.error}
+
+class Connector:
+    """后台WiFi连接: start() 立即返回任务, 由 step() 定时推进, 不阻塞调用方.
+    保存过的网络先用上次的BSSID/信道直接关联, 跳过全信道扫描; 失败再退回完整连接"""
+    def __init__(self, wlan=None):
+        self.wlan = wlan or (lambda: network.WLAN(network.STA_IF))
+        self.job = None          # 正在进行的任务
+        self.jobs = []           # 最近的任务
+        self.next_id = 1
+        self.last = None         # 最近一次成功连接的任务, 提供连接耗时
+
+    def start(self, ssid, password=None, reuse_ip=None):
+        """开始连接; password 为空时使用保存的密码. reuse_ip: 快速重连时沿用上次的地址跳过DHCP,
+        只适合地址固定分配的网络, 为 None 时沿用保存的选择"""
+        profile = get_profile(ssid)
+        if password is None:
+            if not profile:
+                raise ValueError("没有保存的密码")
+            password = profile.get('password', '')
+        self.cancel("被新的连接取代")
+        if reuse_ip is None:
+            reuse_ip = bool(profile and profile.get('reuse_ip'))
+        job = ConnectJob(self.next_id, ssid, password, profile, reuse_ip)
+        self.next_id += 1
+        self.jobs.append(job)
+        if len(self.jobs) > MAX_JOBS:
+            self.jobs.pop(0)
+        self.job = job
+        try:
+            self._begin(job)
+        except Exception as e:
+            self._fail(job, str(e))
+        return job
+
+    def get(self, jid):
+        for job in self.jobs:
+            if job.id == jid:
+                return job
+        return None
+
+    def cancel(self, reason="已取消"):
+        if self.job is not None:
+            self._fail(self.job, reason)
+
+    def state(self):
+        if self.job is not None:
+            return self.job.state
+        return self.jobs[-1].state if self.jobs else 'idle'
+
+    def _begin(self, job):
+        w = self.wlan()
+        w.active(True)
+        if w.isconnected():
+            w.disconnect()
+        job.t_try = time.ticks_ms()
+        job.t_assoc = None
+        job.state = ASSOC
+        if job.fast:
+            p = job.profile
+            try: w.config(channel=p['channel'])    # 信道只是提示, 固件不支持时忽略
+            except: pass
+            if job.reuse_ip and p.get('ifconfig'):
+                try: w.ifconfig(tuple(p['ifconfig']))   # 沿用上次的地址, 跳过DHCP
+                except: pass
+            w.connect(job.ssid, job.password, bssid=binascii.unhexlify(p['bssid'].replace(':', '')))
+        else:
+            w.connect(job.ssid, job.password)
+
+    def _fallback(self, job):
+        """快速重连失败: 清掉静态地址, 改为完整连接"""
+        w = self.wlan()
+        try: w.disconnect()
+        except: pass
+        if job.reuse_ip:
+            try: w.ifconfig('dhcp')
+            except: pass
+        job.fast = False
+        job.fell_back = True
+        self._begin(job)
+
+    def _fail(self, job, reason):
+        job.state = FAILED
+        job.error = reason
+        job.t_done = time.ticks_ms()
+        if self.job is job:
+            self.job = None
+
+    def _associated(self, w):
+        # 已关联但还没拿到IP时 status('rssi') 可以读到信号强度
+        try: return bool(w.status('rssi'))
+        except: return False
+
+    def step(self):
+        """推进当前任务一步, 返回刚结束的任务(没有则返回 None)"""
+        job = self.job
+        if job is None:
+            return None
+        w = self.wlan()
+        now = time.ticks_ms()
+        try:
+            if w.isconnected():
+                if job.t_assoc is None:
+                    job.t_assoc = now
+                job.t_done = now
+                job.state = CONNECTED
+                job.ip = w.ifconfig()[0]
+                self.job = None
+                self.last = job
+                self._remember(job, w)
+                return job
+            st = w.status()
+            bad = st in (network.STAT_WRONG_PASSWORD, network.STAT_NO_AP_FOUND, network.STAT_CONNECT_FAIL)
+            if job.t_assoc is None and not bad and self._associated(w):
+                job.t_assoc = now
+                job.state = DHCP
+            limit = FAST_TIMEOUT_MS if job.fast else CONNECT_TIMEOUT_MS
+            if st == network.STAT_WRONG_PASSWORD:
+                self._fail(job, "密码错误")
+            elif bad or time.ticks_diff(now, job.t_try) > limit:
+                if job.fast:
+                    self._fallback(job)
+                    return None
+                self._fail(job, "找不到网络" if st == network.STAT_NO_AP_FOUND else "连接超时")
+            else:
+                return None
+        except Exception as e:
+            self._fail(job, str(e))
+        return job
+
+    def _remember(self, job, w):
+        """记下这次连接的BSSID/信道/地址, 下次快速重连; BSSID取自扫描缓存里信号最强的同名网络"""
+        p = {'password': job.password, 'ifconfig': list(w.ifconfig()), 'reuse_ip': job.reuse_ip}
+        best = None
+        for net in scanner.networks or ():
+            if net['ssid'] == job.ssid and net.get('bssid') and (best is None or net['rssi'] > best['rssi']):
+                best = net
+        if best:
+            p['bssid'] = best['bssid']
+            p['channel'] = best['channel']
+        elif job.fast and not job.fell_back:
+            p['bssid'] = job.profile['bssid']
+            p['channel'] = job.profile.get('channel')
+        try:
+            ch = w.config('channel')
+            if ch:
+                p['channel'] = ch
+        except: pass
+        save_profile(job.ssid, p)
+
+connector = Connector()
 
 def connect_wifi(ssid, password):
-    """连接WiFi网络"""
+    """连接WiFi网络(阻塞等待, 最多约36秒)"""
     try:
         print(f"正在连接WiFi: {ssid}")
-        
-        # 激活STA模式
-        sta_if = network.WLAN(network.STA_IF)
-        sta_if.active(True)
-        
-        # 断开现有连接
-        if sta_if.isconnected():
-            sta_if.disconnect()
-            time.sleep(1)
-        
-        # 连接新网络
-        sta_if.connect(ssid, password)
-        
-        # 等待连接
-        for i in range(30):  # 30秒超时
-            if sta_if.isconnected():
-                print(f"WiFi连接成功!")
-                print(f"IP地址: {sta_if.ifconfig()[0]}")
-                
-                # 保存配置
-                save_wifi_config(ssid, password)
-                
-                return True
-            time.sleep(1)
-        
-        print("WiFi连接超时")
+        job = connector.start(ssid, password)
+        while not job.finished():
+            time.sleep_ms(CONNECT_POLL_MS)
+            connector.step()
+        if job.state == CONNECTED:
+            print(f"WiFi连接成功! 耗时 {job.metrics()[2]} ms")
+            print(f"IP地址: {job.ip}")
+            return True
+        print(f"WiFi连接失败: {job.error}")
         return False
         
     except Exception as e:
@@ -52,37 +229,46 @@ def disconnect_wifi():
     except:
         return True
 
+def _scan():
+    """扫描并整理结果, 出错时抛出异常; STA原来是关闭的才在扫描后关闭, 不影响已有连接"""
+    sta_if = network.WLAN(network.STA_IF)
+    was_active = sta_if.active()
+    if not was_active:
+        sta_if.active(True)
+    try:
+        networks = sta_if.scan()
+    finally:
+        if not was_active:
+            sta_if.active(False)
+    
+    result = []
+    for net in networks:
+        try:
+            ssid = net[0].decode('utf-8', 'ignore')
+            if ssid and len(ssid) > 0:
+                rssi = net[3]
+                channel = net[2]
+                
+                # 获取安全类型
+                authmode = net[4]
+                security = get_security_type(authmode)
+                
+                result.append({
+                    "ssid": ssid,
+                    "bssid": binascii.hexlify(net[1]).decode(),
+                    "rssi": rssi,
+                    "channel": channel,
+                    "security": security
+                })
+        except:
+            continue
+    return result
+
 def scan_wifi():
     """扫描WiFi网络"""
     try:
         print("正在扫描WiFi...")
-        
-        sta_if = network.WLAN(network.STA_IF)
-        sta_if.active(True)
-        networks = sta_if.scan()
-        sta_if.active(False)
-        
-        result = []
-        for net in networks:
-            try:
-                ssid = net[0].decode('utf-8', 'ignore')
-                if ssid and len(ssid) > 0:
-                    rssi = net[3]
-                    channel = net[2]
-                    
-                    # 获取安全类型
-                    authmode = net[4]
-                    security = get_security_type(authmode)
-                    
-                    result.append({
-                        "ssid": ssid,
-                        "rssi": rssi,
-                        "channel": channel,
-                        "security": security
-                    })
-            except:
-                continue
-        
+        result = _scan()
         print(f"发现 {len(result)} 个网络")
         return result
         
@@ -90,6 +276,59 @@ def scan_wifi():
         print(f"WiFi扫描错误: {e}")
         return []
 
+class ScanCache:
+    """WiFi扫描结果缓存: 扫描在工作线程里进行, 同时到来的请求共用一次扫描"""
+    def __init__(self, ttl_ms=SCAN_TTL_MS):
+        self.ttl_ms = ttl_ms
+        self.networks = None
+        self.stamp = 0
+        self.job = None          # 正在进行的扫描
+        self.error = None
+        self.scans = 0
+
+    def _collect(self):
+        job = self.job
+        if job is not None and job.done:
+            self.job = None
+            if job.error is None:
+                self.networks = job.result
+                self.stamp = time.ticks_ms()
+                self.error = None
+                self.scans += 1
+            else:
+                self.error = str(job.error)    # 保留上次的结果
+
+    def age_ms(self):
+        if self.networks is None:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self.stamp)
+
+    def refresh(self):
+        """没有扫描在进行时提交一次, 返回正在进行的扫描; 队列满时抛出 QueueFull"""
+        self._collect()
+        if self.job is None:
+            self.job = pool.submit(_scan)
+        return self.job
+
+    async def get(self, refresh=False):
+        """返回 (网络列表, 结果年龄ms). 还没有结果或要求刷新时等扫描完成; 结果过期时立即返回旧结果并在后台刷新"""
+        self._collect()
+        if self.networks is None or refresh:
+            await self.refresh().wait()
+            self._collect()
+            return self.networks, 0
+        age = self.age_ms()
+        if age > self.ttl_ms:
+            try: self.refresh()
+            except: pass         # 队列满就下次再刷新
+        return self.networks, age
+
+    def pending(self):
+        self._collect()
+        return self.job is not None
+
+scanner = ScanCache()
+
 def get_security_type(authmode):
     """获取安全类型"""
     authmodes = {
@@ -97,14 +336,32 @@ def get_security_type(authmode):
         1: "WEP",
         2: "WPA-PSK",
         3: "WPA2-PSK",
-        4: "WPA/WPA2-PSK"
+        4: "WPA/WPA2-PSK",
+        5: "WPA2-企业",
+        6: "WPA3-PSK",
+        7: "WPA2/WPA3-PSK"
     }
     return authmodes.get(authmode, "未知")
 
 def save_wifi_config(ssid, password):
     """保存WiFi配置"""
+    return save_profile(ssid, {"password": password})
+
+def save_profile(ssid, fields):
+    """更新一个网络的保存信息(密码、BSSID、信道、上次的地址), 并设为默认网络; 超过上限时删掉最久没用的"""
     try:
-        config = {"ssid": ssid, "password": password}
+        config = load_wifi_config() or {}
+        profiles = config.get("profiles", {})
+        p = profiles.get(ssid, {})
+        p.update(fields)
+        seq = max([q.get("seq", 0) for q in profiles.values()] + [0]) + 1
+        p["seq"] = seq
+        profiles[ssid] = p
+        while len(profiles) > MAX_PROFILES:
+            oldest = min(profiles, key=lambda k: profiles[k].get("seq", 0))
+            del profiles[oldest]
+        config.update({"ssid": ssid, "password": p.get("password", ""), "profiles": profiles})
+        import ujson
         with open("wifi_config.json", "w") as f:
             ujson.dump(config, f)
         print(f"WiFi配置已保存: {ssid}")
@@ -112,9 +369,17 @@ def save_wifi_config(ssid, password):
     except:
         return False
 
+def get_profile(ssid):
+    config = load_wifi_config() or {}
+    p = config.get("profiles", {}).get(ssid)
+    if p is None and config.get("ssid") == ssid:
+        p = {"password": config.get("password", "")}     # 旧格式的配置文件
+    return p
+
 def load_wifi_config():
     """加载WiFi配置"""
     try:
+        import ujson
         with open("wifi_config.json", "r") as f:
             config = ujson.load(f)
         return config
@@ -136,4 +401,93 @@ if __name__ == "__main__":
     # 测试WiFi扫描
     networks = scan_wifi()
     for net in networks:
-        print(f"{net['ssid']} - 信号:{net['rssi']}dBm")
\ No newline at end of file
+        print(f"{net['ssid']} - 信号:{net['rssi']}dBm")
+
+    # 用模拟的 WLAN 测试连接状态机: 完整连接要扫描全部信道, 带BSSID的快速重连直接关联, 沿用地址时跳过DHCP
+    class FakeWLAN:
+        BSSID = b'\xaa\xbb\xcc\x00\x00\x01'
+        SCAN_MS, ASSOC_MS, DHCP_MS = 1200, 100, 400
+
+        def __init__(self):
+            self.t = None
+            self.ok = self.lost = self.static = False
+            self.assoc = 0
+            self._active = False
+
+        def active(self, v=None):
+            if v is None:
+                return self._active
+            self._active = v
+
+        def config(self, *a, **k):
+            if a:
+                return 6
+
+        def connect(self, ssid, password, bssid=None):
+            self.t = time.ticks_ms()
+            self.ok = password == 'secret'
+            self.lost = bssid is not None and bssid != self.BSSID
+            self.assoc = self.ASSOC_MS + (0 if bssid else self.SCAN_MS)
+
+        def disconnect(self):
+            self.t = None
+
+        def ifconfig(self, c=None):
+            if c is None:
+                return ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+            self.static = c != 'dhcp'
+
+        def _ms(self):
+            return time.ticks_diff(time.ticks_ms(), self.t) if self.t is not None else -1
+
+        def status(self, *a):
+            ms = self._ms()
+            if a:
+                return -55 if self.ok and not self.lost and ms >= self.assoc else 0
+            if self.lost and ms > 200:
+                return network.STAT_NO_AP_FOUND
+            if not self.ok and ms > self.assoc:
+                return network.STAT_WRONG_PASSWORD
+            return network.STAT_CONNECTING
+
+        def isconnected(self):
+            return self.ok and not self.lost and self._ms() >= self.assoc + (20 if self.static else self.DHCP_MS)
+
+    try:
+        with open("wifi_config.json") as f:
+            saved = f.read()
+    except:
+        saved = None
+    fake = FakeWLAN()
+    conn = Connector(lambda: fake)
+
+    def run(*args, **kw):
+        job = conn.start(*args, **kw)
+        while not job.finished():
+            time.sleep_ms(20)
+            conn.step()
+        print(job.info())
+        return job
+
+    try:
+        scanner.networks = [{'ssid': 'lab', 'bssid': 'aabbcc000001', 'rssi': -50, 'channel': 6}]
+        full = run('lab', 'secret')
+        assert full.state == CONNECTED and not full.fast and get_profile('lab')['bssid'] == 'aabbcc000001'
+        fast = run('lab')                           # 用保存的密码和BSSID
+        assert fast.state == CONNECTED and fast.fast and fast.metrics()[2] < full.metrics()[2]
+        static = run('lab', reuse_ip=True)
+        assert static.state == CONNECTED and static.metrics()[1] < fast.metrics()[1]
+        save_profile('lab', {'bssid': 'aabbcc000002'})      # AP换了: 快速重连失败后退回完整连接
+        moved = run('lab')
+        assert moved.state == CONNECTED and moved.fell_back and not fake.static
+        bad = run('lab', 'wrong')
+        assert bad.state == FAILED and bad.error == "密码错误"
+        print("完整连接 %d ms, 快速重连 %d ms, 沿用地址 %d ms" % (full.metrics()[2], fast.metrics()[2], static.metrics()[2]))
+    finally:
+        if saved is None:
+            import uos
+            try: uos.remove("wifi_config.json")
+            except: pass
+        else:
+            with open("wifi_config.json", "w") as f:
+                f.write(saved)
\ No newline at end of file
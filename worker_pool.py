@@ -0,0 +1,100 @@
+# worker_pool.py - 固定大小的工作线程池
+# 慢操作(WiFi扫描、代码执行)交给少量工作线程, 队列有上限, 满了直接拒绝
+# 空闲的工作线程阻塞在 ready 锁上, 提交任务时才被唤醒, 不占用事件循环的时间
+import _thread
+import time
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+    async def wait(self):
+        """在事件循环里等待任务完成, 不阻塞其他连接"""
+        while not self.done:
+            await asyncio.sleep(0.02)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class WorkerPool:
+    def __init__(self, workers=2, max_queue=4):
+        self.size = workers
+        self.max_queue = max_queue
+        self.queue = []
+        self.lock = _thread.allocate_lock()
+        self.ready = _thread.allocate_lock()    # 队列里有任务时处于未锁定状态, 只在持有 lock 时释放
+        self.ready.acquire()
+        self.started = 0
+        self.busy = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_ms = 0
+        self.t0 = time.ticks_ms()
+
+    def _worker(self):
+        while True:
+            self.ready.acquire()
+            with self.lock:
+                if not self.queue:
+                    continue            # 别的线程已经取走了, 继续等
+                job = self.queue.pop(0)
+                self.busy += 1
+                if self.queue and self.ready.locked():
+                    self.ready.release()    # 还有任务, 唤醒下一个空闲线程
+            t = time.ticks_ms()
+            try:
+                job.result = job.fn(*job.args)
+            except Exception as e:
+                job.error = e
+            job.done = True
+            with self.lock:
+                self.busy -= 1
+                self.completed += 1
+                self.busy_ms += time.ticks_diff(time.ticks_ms(), t)
+
+    def submit(self, fn, *args):
+        """提交任务, 队列已满时抛出 QueueFull; 工作线程在第一次提交时才启动"""
+        job = Job(fn, args)
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            self.queue.append(job)
+            if self.ready.locked():
+                self.ready.release()
+            start = self.started < self.size
+            if start:
+                self.started += 1
+        if start:
+            _thread.start_new_thread(self._worker, ())
+        return job
+
+    def utilization(self):
+        """启动以来工作线程忙碌时间占比(百分比)"""
+        elapsed = time.ticks_diff(time.ticks_ms(), self.t0) * self.size
+        if elapsed <= 0:
+            return 0
+        return min(100, self.busy_ms * 100 // elapsed)
+
+    def stats(self):
+        return {
+            "workers": self.size,
+            "busy": self.busy,
+            "queued": len(self.queue),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "utilization": self.utilization(),
+        }
+
+pool = WorkerPool()